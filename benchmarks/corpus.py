@@ -0,0 +1,271 @@
+"""
+Generate a synthetic XDG data directory tree full of desktop entries and icons
+for benchmarking the scanner.
+"""
+import os
+import random
+import struct
+import zlib
+
+from dee.icontheme import icon_name_hash
+
+ICON_MIXES = ("mixed", "png", "svg", "absolute", "missing", "none")
+
+LOCALES = ("af", "ar", "bg", "ca", "cs", "da", "de", "el", "en_GB", "eo", "es",
+           "et", "eu", "fa", "fi", "fr", "ga", "gl", "he", "hi", "hr", "hu",
+           "id", "it", "ja", "ko", "lt", "lv", "ms", "nb", "nl", "pl", "pt",
+           "pt_BR", "ro", "ru", "sk", "sl", "sr", "sr@latin", "sv", "ta", "th",
+           "tr", "uk", "vi", "zh_CN", "zh_HK", "zh_TW")
+
+CATEGORIES = ("AudioVideo", "Development", "Education", "Game", "Graphics",
+              "Network", "Office", "Science", "Settings", "System", "Utility")
+
+MIME_TYPES = ("text/plain", "text/html", "image/png", "image/jpeg",
+              "application/pdf", "audio/mpeg", "video/mp4",
+              "application/x-tar", "inode/directory")
+
+SVG_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<svg xmlns="http://www.w3.org/2000/svg" width="48" height="48">
+  <rect x="4" y="4" width="40" height="40" rx="6" fill="#%06x"/>
+  <circle cx="24" cy="24" r="12" fill="#%06x"/>
+</svg>
+"""
+
+
+def _png_chunk(kind, data):
+    chunk = kind + data
+    return (struct.pack(">I", len(data)) + chunk +
+            struct.pack(">I", zlib.crc32(chunk) & 0xffffffff))
+
+
+def make_png(size, rgb):
+    """
+    Return the bytes of a solid size x size RGBA PNG image.
+    """
+    r, g, b = (rgb >> 16) & 0xff, (rgb >> 8) & 0xff, rgb & 0xff
+    row = "\0" + struct.pack("4B", r, g, b, 255) * size
+    header = struct.pack(">IIBBBBB", size, size, 8, 6, 0, 0, 0)
+    return ("\x89PNG\r\n\x1a\n" +
+            _png_chunk("IHDR", header) +
+            _png_chunk("IDAT", zlib.compress(row * size)) +
+            _png_chunk("IEND", ""))
+
+
+def _write(filename, data):
+    path = os.path.dirname(filename)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    with open(filename, "wb") as f:
+        f.write(data)
+
+
+def write_icon_cache(theme_dir):
+    """
+    Write an icon-theme.cache for theme_dir in the format of
+    gtk-update-icon-cache, without image data, and return its file name.
+    """
+    flags = {".xpm": 1, ".svg": 2, ".png": 4}
+    directories = []
+    icons = {}
+    for path, dirnames, filenames in os.walk(theme_dir):
+        dirnames.sort()
+        directory = os.path.relpath(path, theme_dir)
+        for filename in sorted(filenames):
+            name, ext = os.path.splitext(filename)
+            if ext not in flags:
+                continue
+            if not directories or directories[-1] != directory:
+                directories.append(directory)
+            images = icons.setdefault(name, {})
+            index = len(directories) - 1
+            images[index] = images.get(index, 0) | flags[ext]
+
+    n_buckets = max(1, len(icons))
+    buckets = [[] for i in range(n_buckets)]
+    for name in sorted(icons):
+        buckets[icon_name_hash(name) % n_buckets].append(name)
+
+    # header, hash table, icons, image lists, then the strings
+    hash_offset = 12
+    offset = hash_offset + 4 + 4 * n_buckets
+    icon_offsets = {}
+    for name in sorted(icons):
+        icon_offsets[name] = offset
+        offset += 12
+    image_offsets = {}
+    for name in sorted(icons):
+        image_offsets[name] = offset
+        offset += 4 + 8 * len(icons[name])
+    dir_list_offset = offset
+    offset += 4 + 4 * len(directories)
+    strings = []
+    string_offsets = {}
+    for string in sorted(icons) + directories:
+        string_offsets[string] = offset
+        strings.append(string + "\0")
+        offset += len(string) + 1
+
+    data = [struct.pack(">HHII", 1, 0, hash_offset, dir_list_offset),
+            struct.pack(">I", n_buckets)]
+    for bucket in buckets:
+        data.append(struct.pack(">I", icon_offsets[bucket[0]] if bucket
+                                else 0xffffffff))
+    for name in sorted(icons):
+        bucket = buckets[icon_name_hash(name) % n_buckets]
+        position = bucket.index(name)
+        chain = (icon_offsets[bucket[position + 1]]
+                 if position + 1 < len(bucket) else 0xffffffff)
+        data.append(struct.pack(">III", chain, string_offsets[name],
+                                image_offsets[name]))
+    for name in sorted(icons):
+        images = sorted(icons[name].items())
+        data.append(struct.pack(">I", len(images)))
+        for index, image_flags in images:
+            data.append(struct.pack(">HHI", index, image_flags, 0))
+    data.append(struct.pack(">I", len(directories)))
+    for directory in directories:
+        data.append(struct.pack(">I", string_offsets[directory]))
+    data.extend(strings)
+
+    filename = os.path.join(theme_dir, "icon-theme.cache")
+    _write(filename, "".join(data))
+    return filename
+
+
+def _icon_for(index, icons, unique_icons, pixmaps_dir):
+    """
+    Return the Icon value and the kind of icon for entry number index.
+    """
+    n = index % unique_icons
+    if icons == "none":
+        return None, None
+    if icons == "mixed":
+        kind = ("png", "svg", "absolute", "missing")[index % 4]
+    else:
+        kind = icons
+    if kind == "png":
+        return "bench-png-%d" % n, kind
+    elif kind == "svg":
+        return "bench-svg-%d" % n, kind
+    elif kind == "absolute":
+        return os.path.join(pixmaps_dir, "bench-abs-%d.png" % n), kind
+    return "bench-missing-%d" % n, kind
+
+
+def _desktop_entry(index, rng, locales, icon):
+    """
+    Return the text of a desktop entry with locales localized Name, GenericName
+    and Comment keys.
+    """
+    name = "Benchmark App %d" % index
+    lines = ["[Desktop Entry]",
+             "Type=Application",
+             "Version=1.0",
+             "Name=%s" % name,
+             "GenericName=Synthetic Application",
+             "Comment=Synthetic launcher number %d for benchmarking" % index,
+             "Exec=bench-app-%d %%U" % index,
+             "TryExec=bench-app-%d" % index,
+             "Terminal=false",
+             "Categories=%s;" % ";".join(rng.sample(CATEGORIES, 2)),
+             "MimeType=%s;" % ";".join(rng.sample(MIME_TYPES, 3)),
+             "Keywords=bench;synthetic;app%d;" % index]
+    if icon:
+        lines.append("Icon=%s" % icon)
+    for locale in LOCALES[:locales]:
+        lines.append("Name[%s]=%s (%s)" % (locale, name, locale))
+        lines.append("GenericName[%s]=Synthetic Application (%s)" % (locale,
+                                                                   locale))
+        lines.append("Comment[%s]=Synthetic launcher %d (%s)" % (locale, index,
+                                                                 locale))
+    lines.extend(["Actions=new-window;",
+                  "",
+                  "[Desktop Action new-window]",
+                  "Name=New Window",
+                  "Exec=bench-app-%d --new-window" % index])
+    for locale in LOCALES[:locales]:
+        lines.append("Name[%s]=New Window (%s)" % (locale, locale))
+    return "\n".join(lines) + "\n"
+
+
+def _broken_entry(index, rng):
+    """
+    Return the text of a desktop entry which fails to parse.
+    """
+    if rng.random() < 0.5:
+        return "[Desktop Entry]\nName=Broken %d\nthis line has no equals sign\n" % index
+    return "Name=Broken %d\nType=Application\n" % index
+
+
+def generate_corpus(root, entries=1000, locales=10, broken=0.01,
+                    icons="mixed", unique_icons=200, data_dirs=2, seed=0):
+    """
+    Generate a corpus below root and return a dict describing it, including
+    the "applications" directories to scan in order of precedence.
+
+    entries       -- number of desktop files
+    locales       -- number of locales each localized key is translated to
+    broken        -- fraction of desktop files which fail to parse
+    icons         -- one of ICON_MIXES
+    unique_icons  -- number of distinct icons shared by the entries
+    data_dirs     -- number of XDG data dirs the entries are spread over
+    """
+    if icons not in ICON_MIXES:
+        raise ValueError("icons must be one of %s" % ", ".join(ICON_MIXES))
+    rng = random.Random(seed)
+    locales = min(locales, len(LOCALES))
+    unique_icons = max(1, unique_icons)
+
+    data_dir_paths = [os.path.join(root, "data%d" % i)
+                      for i in range(max(1, data_dirs))]
+    icon_dir = os.path.join(data_dir_paths[-1], "icons", "hicolor")
+    pixmaps_dir = os.path.join(data_dir_paths[-1], "pixmaps")
+
+    for n in range(unique_icons):
+        if icons in ("mixed", "png"):
+            for size in (16, 48):
+                _write(os.path.join(icon_dir, "%dx%d" % (size, size), "apps",
+                                    "bench-png-%d.png" % n),
+                       make_png(size, rng.randint(0, 0xffffff)))
+        if icons in ("mixed", "svg"):
+            _write(os.path.join(icon_dir, "scalable", "apps",
+                                "bench-svg-%d.svg" % n),
+                   SVG_TEMPLATE % (rng.randint(0, 0xffffff),
+                                   rng.randint(0, 0xffffff)))
+        if icons in ("mixed", "absolute"):
+            _write(os.path.join(pixmaps_dir, "bench-abs-%d.png" % n),
+                   make_png(48, rng.randint(0, 0xffffff)))
+    _write(os.path.join(icon_dir, "index.theme"),
+           "[Icon Theme]\nName=Hicolor\n"
+           "Directories=16x16/apps,48x48/apps,scalable/apps\n\n"
+           "[16x16/apps]\nSize=16\nType=Threshold\n\n"
+           "[48x48/apps]\nSize=48\nType=Threshold\n\n"
+           "[scalable/apps]\nSize=48\nMinSize=8\nMaxSize=512\nType=Scalable\n")
+
+    n_broken = 0
+    kinds = {}
+    for index in range(entries):
+        path = os.path.join(data_dir_paths[index % len(data_dir_paths)],
+                            "applications", "bench-app-%d.desktop" % index)
+        if rng.random() < broken:
+            n_broken += 1
+            _write(path, _broken_entry(index, rng))
+            continue
+        icon, kind = _icon_for(index, icons, unique_icons, pixmaps_dir)
+        kinds[kind] = kinds.get(kind, 0) + 1
+        _write(path, _desktop_entry(index, rng, locales, icon))
+
+    return {
+        "root": root,
+        "data_dirs": data_dir_paths,
+        "application_dirs": [os.path.join(path, "applications")
+                             for path in data_dir_paths],
+        "icon_theme_dir": icon_dir,
+        "entries": entries,
+        "broken": n_broken,
+        "locales": locales,
+        "icons": icons,
+        "icon_kinds": kinds,
+        "unique_icons": unique_icons,
+        "seed": seed,
+    }
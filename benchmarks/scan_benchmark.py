@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+"""
+Headless benchmark of the launcher scanning code.
+
+Generates synthetic XDG data dirs with corpus.py, then times each phase of
+loading the launcher list (glob, full and header-only parse, read-only check,
+icon resolution with and without an icon-theme.cache, icon decoding with and
+without the rendered icon cache, and model fill) as well as complete cold and
+warm runs of dee.scanner.Scanner. Results are printed as JSON. No display is
+needed.
+
+    python benchmarks/scan_benchmark.py --entries 1000,10000 -o results.json
+"""
+import os
+import sys
+import gc
+import glob
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'src'))
+sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+
+from gi.repository import GLib, GObject, Gtk
+from xdg.Exceptions import ParsingError
+
+from corpus import ICON_MIXES, generate_corpus, write_icon_cache
+from dee.catalog import Catalog
+from dee.entry import Entry, read_entry_summary
+from dee.icondiskcache import IconDiskCache, decode_icon_file
+from dee.icontheme import IconResolver
+from dee.scanner import Scanner
+
+ICON_SIZE = 16
+
+
+def timed(func, *args):
+    """
+    Return (seconds, result) for calling func(*args).
+    """
+    gc.collect()
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def phase_glob(dirs):
+    files = []
+    for path in dirs:
+        files.extend(glob.glob(os.path.join(path, "*.desktop")))
+    return files
+
+
+def phase_parse(files):
+    entries = []
+    errors = 0
+    for desktop_file in files:
+        try:
+            entries.append(Entry(desktop_file))
+        except ParsingError:
+            errors += 1
+    return entries, errors
+
+
+def phase_parse_header(files):
+    summaries = []
+    errors = 0
+    for desktop_file in files:
+        try:
+            summaries.append(read_entry_summary(desktop_file))
+        except ParsingError:
+            errors += 1
+    return summaries, errors
+
+
+def phase_read_only(entries):
+    return sum(1 for entry in entries if entry.isReadOnly())
+
+
+def phase_icons(entries, base_dirs):
+    """
+    Resolve the icon of every entry with a fresh IconResolver, as the first
+    scan after starting does.
+    """
+    resolver = IconResolver("hicolor", base_dirs)
+    resolved = {}
+    for entry in entries:
+        icon = entry.getIcon()
+        if icon not in resolved:
+            resolved[icon] = resolver.lookup(icon, ICON_SIZE)
+    return resolved
+
+
+def phase_decode(filenames):
+    decoded = 0
+    for filename in filenames:
+        if decode_icon_file(filename, ICON_SIZE) is not None:
+            decoded += 1
+    return decoded
+
+
+def phase_disk_cache(filenames, cache_file):
+    """
+    Render every icon through an IconDiskCache loaded from cache_file,
+    decoding and storing the icons it does not have, then write it.
+    """
+    cache = IconDiskCache(cache_file)
+    cache.load()
+    rendered = 0
+    for filename in filenames:
+        key = (filename, os.stat(filename).st_mtime, ICON_SIZE, 1, "hicolor")
+        pixbuf = cache.get(key)
+        if pixbuf is None:
+            pixbuf = decode_icon_file(filename, ICON_SIZE)
+            if pixbuf is not None:
+                cache.put(key, pixbuf)
+        if pixbuf is not None:
+            rendered += 1
+    cache.save()
+    return rendered, cache.hits
+
+
+def phase_model_fill(entries):
+    model = Gtk.ListStore(GObject.TYPE_STRING, GObject.TYPE_STRING,
+                          GObject.TYPE_STRING, GObject.TYPE_STRING,
+                          GObject.TYPE_STRING, GObject.TYPE_BOOLEAN)
+    model.set_sort_column_id(1, Gtk.SortType.ASCENDING)
+    for entry in entries:
+        name = entry.getName()
+        tooltip = GLib.markup_escape_text(entry.getGenericName() or name)
+        markup = GLib.markup_escape_text(name)
+        model.append((entry.getIcon(), name, entry.filename, tooltip, markup,
+                      False))
+    return len(model)
+
+
+def run_scanner(dirs, catalog):
+    """
+    Run a complete Scanner pass in a GLib main loop and return the number of
+    results.
+    """
+    loop = GLib.MainLoop()
+    results = []
+    scanner = Scanner(catalog=catalog)
+    scanner.scan(results.extend, finished_callback=loop.quit, dirs=dirs)
+    loop.run()
+    return len(results)
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def benchmark(corpus, repeat):
+    """
+    Time every phase over the corpus, keeping the best of repeat runs.
+    """
+    dirs = corpus["application_dirs"]
+    phases = {}
+
+    def record(name, func, *args):
+        best = None
+        for i in range(repeat):
+            seconds, result = timed(func, *args)
+            if best is None or seconds < best:
+                best = seconds
+        phases[name] = {"seconds": round(best, 6)}
+        return result
+
+    files = record("glob", phase_glob, dirs)
+    phases["glob"]["files"] = len(files)
+    entries, errors = record("parse", phase_parse, files)
+    phases["parse"]["entries"] = len(entries)
+    phases["parse"]["errors"] = errors
+    summaries, errors = record("parse_header", phase_parse_header, files)
+    phases["parse_header"]["entries"] = len(summaries)
+    phases["parse_header"]["errors"] = errors
+    del summaries
+    phases["read_only"] = {}
+    phases["read_only"]["read_only"] = record("read_only", phase_read_only,
+                                              entries)
+    base_dirs = []
+    for path in corpus["data_dirs"]:
+        base_dirs.extend((os.path.join(path, "icons"),
+                          os.path.join(path, "pixmaps")))
+    record("icon_resolution_uncached", phase_icons, entries, base_dirs)
+    write_icon_cache(corpus["icon_theme_dir"])
+    resolved = record("icon_resolution", phase_icons, entries, base_dirs)
+    filenames = set(f for f in resolved.values() if f)
+    phases["icon_resolution"]["icons"] = len(resolved)
+    phases["icon_resolution"]["resolved"] = len(filenames)
+    phases["icon_decode"] = {}
+    phases["icon_decode"]["decoded"] = record("icon_decode", phase_decode,
+                                              sorted(filenames))
+    icon_cache_dir = tempfile.mkdtemp(prefix="dee-bench-icons-")
+    try:
+        icon_cache_file = os.path.join(icon_cache_dir, "icons.cache")
+        for name in ("icon_disk_cache_cold", "icon_disk_cache_warm"):
+            seconds, (rendered, hits) = timed(phase_disk_cache,
+                                              sorted(filenames),
+                                              icon_cache_file)
+            phases[name] = {"seconds": round(seconds, 6),
+                            "rendered": rendered, "hits": hits}
+    finally:
+        shutil.rmtree(icon_cache_dir, ignore_errors=True)
+    phases["model_fill"] = {}
+    phases["model_fill"]["rows"] = record("model_fill", phase_model_fill,
+                                          entries)
+    del entries
+
+    catalog_dir = tempfile.mkdtemp(prefix="dee-bench-catalog-")
+    try:
+        catalog_file = os.path.join(catalog_dir, "catalog.cache")
+        seconds, count = timed(run_scanner, dirs, None)
+        phases["scan_uncached"] = {"seconds": round(seconds, 6),
+                                   "results": count}
+        seconds, count = timed(run_scanner, dirs, Catalog(catalog_file))
+        phases["scan_cold_catalog"] = {"seconds": round(seconds, 6),
+                                       "results": count}
+        time.sleep(0.5) # the catalog is saved from a background thread
+        seconds, count = timed(run_scanner, dirs, Catalog(catalog_file))
+        phases["scan_warm_catalog"] = {"seconds": round(seconds, 6),
+                                       "results": count}
+    finally:
+        shutil.rmtree(catalog_dir, ignore_errors=True)
+
+    return phases
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--entries", default="1000",
+                        help="comma separated corpus sizes (default: 1000)")
+    parser.add_argument("--locales", type=int, default=10,
+                        help="translations per localized key (default: 10)")
+    parser.add_argument("--broken", type=float, default=0.01,
+                        help="fraction of broken files (default: 0.01)")
+    parser.add_argument("--icons", choices=ICON_MIXES, default="mixed",
+                        help="kind of icons the entries use (default: mixed)")
+    parser.add_argument("--unique-icons", type=int, default=200,
+                        help="number of distinct icons (default: 200)")
+    parser.add_argument("--data-dirs", type=int, default=2,
+                        help="number of XDG data dirs (default: 2)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="runs per phase, the best is kept (default: 1)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the generated corpus")
+    parser.add_argument("-o", "--output",
+                        help="write the JSON results to a file")
+    args = parser.parse_args(argv)
+
+    runs = []
+    for entries in [int(n) for n in args.entries.split(",")]:
+        root = tempfile.mkdtemp(prefix="dee-bench-corpus-")
+        try:
+            seconds, corpus = timed(generate_corpus, root, entries,
+                                    args.locales, args.broken, args.icons,
+                                    args.unique_icons, args.data_dirs,
+                                    args.seed)
+            sys.stderr.write("Generated %d entries in %.2fs, benchmarking...\n"
+                             % (entries, seconds))
+            phases = benchmark(corpus, max(1, args.repeat))
+        finally:
+            if not args.keep:
+                shutil.rmtree(root, ignore_errors=True)
+        for key in ("data_dirs", "application_dirs", "icon_theme_dir"):
+            del corpus[key]
+        if not args.keep:
+            del corpus["root"]
+        runs.append({"corpus": corpus,
+                     "phases": phases,
+                     "max_rss_kb": max_rss_kb()})
+
+    report = {
+        "benchmark": "scan",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "runs": runs,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print text
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
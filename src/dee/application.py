@@ -1,9 +1,7 @@
 import os
-import glob
+import re
 import sys
 import logging
-import subprocess
-import tempfile
 
 import gi
 gi.require_version('Gtk', '3.0')
@@ -11,22 +9,44 @@ gi.require_version('Gdk', '3.0')
 gi.require_version('Pango', '1.0')
 gi.require_version('GtkSource', '3.0')
 from gi.repository import GObject, Gio
-from gi.repository import Pango
 from gi.repository import Gdk, GdkPixbuf, Gtk, GLib
-from gi.repository import GtkSource
+# Pango and GtkSource are imported when the tabs using them are first shown
 
-from dee.entry import Entry, get_icon_pixbuf
+from dee.entry import Entry, EntrySummary, get_pixbuf_cache
+from dee.bulkedit import BulkEditor, KeyChange
+from dee.catalog import Catalog
 from dee.exceptiondialog import ExceptionDialog
+from dee.fileaccess import get_access_cache
+from dee.icondiskcache import get_icon_disk_cache
+from dee.iconloader import IconLoader
+from dee.launcher import Launch, expand_exec
+from dee.mimeindex import MimeIndex
+from dee.mimelookup import MimeLookup
+from dee.monitor import ApplicationsMonitor
+from dee.scanner import Scanner, application_dirs, desktop_files, is_broken
+from dee.search import SearchIndex
+from dee.undo import UndoHistory
+from dee.validationreport import ValidationReport
+from dee.validator import BulkValidator, LiveValidator, ValidationCache
 from xdg.Exceptions import  ParsingError, ValidationError
 from xdg.BaseDirectory import xdg_data_dirs, xdg_data_home
 
 
 SETTINGS_SCHEMA = "apps.desktop-entry-editor"
+SEARCH_DELAY_MS = 150
+# keys offered by the bulk edit dialog
+BULK_EDIT_KEYS = ("NoDisplay", "Hidden", "NotShowIn", "OnlyShowIn", "Terminal",
+                  "StartupNotify", "Categories", "Keywords", "Icon")
+# errors listed in the dialog when a bulk edit fails
+BULK_EDIT_MAX_ERRORS = 10
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.ERROR)
 
+# the launcher list is loaded from worker threads
+GObject.threads_init()
+
 class Application(object):
 
     APP_NAME = "Desktop Entry Editor"
@@ -37,6 +57,7 @@ class Application(object):
     BASIC_TAB = 0
     ADVANCED_TAB = 1
     SOURCE_TAB = 2
+    LOG_TAB = 3
 
     # http://standards.freedesktop.org/desktop-entry-spec/latest/ar01s05.html
     ALL_KEYS = (
@@ -66,6 +87,7 @@ class Application(object):
         Close the currently open desktop entry file.
         """
         self._entry = None
+        self._history.clear()
         self._load_desktop_entry_ui()
         # TODO deselect tree view
 
@@ -77,18 +99,23 @@ class Application(object):
         if not os.path.exists(path):
             os.makedirs(path)
 
-    def error_dialog(self, message):
+    def error_dialog(self, message, message_type=Gtk.MessageType.ERROR,
+                     title="Error"):
         """ Display a very basic error dialog. """
         logger.warn(message)
         dialog = Gtk.MessageDialog(self.window,
                                    Gtk.DialogFlags.MODAL |
                                    Gtk.DialogFlags.DESTROY_WITH_PARENT,
-                                   Gtk.MessageType.ERROR, Gtk.ButtonsType.OK,
+                                   message_type, Gtk.ButtonsType.OK,
                                    message)
-        dialog.set_title("Error")
+        dialog.set_title(title)
         dialog.run()
         dialog.destroy()
 
+    def warning_dialog(self, message):
+        """ Display a very basic warning dialog. """
+        self.error_dialog(message, Gtk.MessageType.WARNING, "Warning")
+
     def overwrite_existing_file_dialog(self, filename):
         """
         Prompt the user to overwrite an existing file.
@@ -153,6 +180,9 @@ class Application(object):
         logger.debug("  DATA DIR: " + self.DATA_DIR)
         logger.debug("-"*60)
 
+        # forks the validation helper, so it must come before any thread
+        self._bulk_validator = BulkValidator(ValidationCache())
+
         builder = Gtk.Builder()
         try:
             builder.add_from_file(os.path.join(self.UI_DIR, "main_window.ui"))
@@ -164,12 +194,22 @@ class Application(object):
         self._notebook = builder.get_object("notebook")
         self._statusbar = builder.get_object("statusbar")
         self._statusbar_ctx = self._statusbar.get_context_id("Selected entry.")
+        self._validation_ctx = self._statusbar.get_context_id("Validation.")
+        self._launch_ctx = self._statusbar.get_context_id("Test launch.")
         self._init_settings()
         self._init_menu_and_toolbar(builder)
         self._init_treeview(builder)
         self._init_basic_tab(builder)
-        self._init_advanced_tab(builder)
-        self._init_source_tab(builder)
+        # the other tabs are built the first time they are shown
+        self._advanced_treeview = builder.get_object("advanced_treeview")
+        self._advanced_tab_ready = False
+        self._source_scrolled_window = builder.get_object(
+                                                    "source_scrolled_window")
+        self._sourceview = None
+        self._init_log_tab()
+        self._validation_report = None
+        self._live_validator = LiveValidator(self._on_entry_validated)
+        self._bulk_editor = BulkEditor()
 
         self._type_application_widgets = (
             builder.get_object("terminal_label"),
@@ -187,6 +227,9 @@ class Application(object):
         )
 
         builder.connect_signals(self)
+        self._title = None
+        self._save_sensitive = None
+        self._update_ui_id = None
         self._state = self.STATE_NORMAL
         self.close_file()
 
@@ -197,12 +240,34 @@ class Application(object):
         self._settings = Gio.Settings.new(SETTINGS_SCHEMA)
         self._settings.connect("changed::show-read-only-files",
                                lambda settings,key: self._load_treeview())
+        self._settings.connect("changed::show-shadowed-files",
+                               lambda settings,key: self._load_treeview())
+        self._settings.connect("changed::icon-cache-size",
+                               lambda settings,key: self._apply_icon_cache_size())
+        self._settings.connect("changed::icon-disk-cache-size",
+                               lambda settings,key: self._apply_icon_cache_size())
+        self._apply_icon_cache_size()
+        self._history = UndoHistory(self._settings.get_int("undo-depth"))
+        self._settings.connect("changed::undo-depth",
+                               lambda settings,key: self._history.set_depth(
+                                   settings.get_int(key)))
+
+    def _apply_icon_cache_size(self):
+        """
+        Set the memory and disk budgets of the shared icon caches from the
+        settings.
+        """
+        size = self._settings.get_int("icon-cache-size")
+        get_pixbuf_cache().set_max_bytes(max(0, size) * 1024)
+        size = self._settings.get_int("icon-disk-cache-size")
+        get_icon_disk_cache().set_max_bytes(max(0, size) * 1024)
 
-    def _init_source_tab(self, builder):
+    def _init_source_tab(self):
         """
         Initialize a GtkSourceView to show the desktop entry in the 'Source' tab
         """
-        scrolled_window = builder.get_object("source_scrolled_window")
+        from gi.repository import GtkSource, Pango
+        scrolled_window = self._source_scrolled_window
         # why do I have to explicity create the buffer?
         self._sourceview = GtkSource.View.new_with_buffer(GtkSource.Buffer())
         buffer = self._sourceview.get_buffer()
@@ -217,6 +282,35 @@ class Application(object):
         # temporary until code for editing source is fixed
         self._sourceview.set_editable(False)
 
+    def _init_log_tab(self):
+        """
+        Add a tab showing the output of programs started with the test launch
+        buttons. The text view is created by _get_log_textview().
+        """
+        self._log_textview = None
+        self._log_scrolled_window = Gtk.ScrolledWindow()
+        self._log_scrolled_window.set_shadow_type(Gtk.ShadowType.IN)
+        self._log_scrolled_window.set_border_width(2)
+        self._log_scrolled_window.show()
+        label = Gtk.Label.new_with_mnemonic("Launch _Log")
+        self._notebook.append_page(self._log_scrolled_window, label)
+        self._launches = {}     # Launch -> statusbar message ID
+
+    def _get_log_textview(self):
+        """
+        Return the text view of the launch log, creating it the first time
+        the tab is shown or a program writes output.
+        """
+        if self._log_textview is None:
+            from gi.repository import Pango
+            self._log_textview = Gtk.TextView()
+            self._log_textview.set_editable(False)
+            self._log_textview.set_cursor_visible(False)
+            font_desc = Pango.FontDescription("monospace 10")
+            self._log_textview.modify_font(font_desc)
+            self._log_scrolled_window.add(self._log_textview)
+            self._log_textview.show()
+        return self._log_textview
 
     def _init_treeview(self, builder):
         """
@@ -225,32 +319,60 @@ class Application(object):
         self._treeview = builder.get_object("treeview")
         # why doesn't button-press-event work when defined in Glade?
         self._treeview.connect("button-press-event", self.on_treeview_button_press_event)
-        model = Gtk.ListStore(GdkPixbuf.Pixbuf,         # icon
+        model = Gtk.ListStore(GObject.TYPE_STRING,      # icon
                               GObject.TYPE_STRING,      # name
                               GObject.TYPE_STRING,      # desktop entry file
                               GObject.TYPE_STRING,      # tooltip
-                              GObject.TYPE_STRING)      # markup
+                              GObject.TYPE_STRING,      # markup
+                              GObject.TYPE_BOOLEAN)     # broken
         model.set_sort_column_id(1, Gtk.SortType.ASCENDING)
-        self._treeview.set_model(model)
+        self._model = model
+        # the tree view shows the rows matching the search box
+        self._filter = model.filter_new()
+        self._filter.set_visible_func(self._filter_visible_func)
+        self._treeview.set_model(self._filter)
         self._treeview.set_headers_visible(False)
-
+        self._search_entry = builder.get_object("search_entry")
+        self._search_index = SearchIndex()
+        self._search_matches = None
+        self._refilter_id = None
+        self._broken_only = False
+
+        # icons are only rendered for rows as they are drawn, and fixed height
+        # mode keeps the tree view from measuring every row up front
         column = Gtk.TreeViewColumn("Launchers")
+        column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        column.set_expand(True)
         cell = Gtk.CellRendererPixbuf()
         column.pack_start(cell, False)
-        column.add_attribute(cell, "pixbuf", 0)
+        column.set_cell_data_func(cell, self._icon_cell_data_func)
         cell = Gtk.CellRendererText()
         column.pack_start(cell, True)
         column.add_attribute(cell, "markup", 4)
         self._treeview.append_column(column)
+        self._treeview.set_fixed_height_mode(True)
 
         self._missing_pixbuf = self.window.render_icon_pixbuf(Gtk.STOCK_MISSING_IMAGE,
                                                               Gtk.IconSize.MENU)
-
-    def _init_advanced_tab(self, builder):
+        self._placeholder_pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB,
+                                                        True, 8, 16, 16)
+        self._placeholder_pixbuf.fill(0)
+        self._icon_loader = IconLoader(16, self._on_icons_loaded)
+        self._icon_entry_pending = False
+        self._scanner = Scanner(catalog=Catalog())
+        self._rows = {}
+        self._mime_index = MimeIndex()
+        self._apply_mime_cache_dirs()
+        self._settings.connect("changed::write-system-mime-caches",
+                               lambda settings,key: self._apply_mime_cache_dirs())
+        self._mime_lookup = None
+        self._monitor = ApplicationsMonitor(application_dirs(),
+                                            self._on_applications_changed)
+
+    def _init_advanced_tab(self):
         """
         Initialize the advanced tab with a treeview of key/values.
         """
-        self._advanced_treeview = builder.get_object("advanced_treeview")
         treeview = self._advanced_treeview
         model = Gtk.ListStore(GObject.TYPE_STRING,      # key
                               GObject.TYPE_STRING,      # value (as string)
@@ -272,6 +394,7 @@ class Application(object):
         column.pack_start(cell, True)
         column.add_attribute(cell, "text", 1)
         treeview.append_column(column)
+        self._advanced_tab_ready = True
 
     def _init_basic_tab(self, builder):
         """
@@ -310,6 +433,7 @@ class Application(object):
         self._app_actions = Gtk.ActionGroup("AppActions")
         self._app_actions.add_actions([
             ('File', None, '_File', None, None, None),
+            ('Edit', None, '_Edit', None, None, None),
             ('View', None, '_View', None, None, None),
             ('Tools', None, '_Tools', None, None, None),
             ('Help', None, '_Help', None, None, None),
@@ -323,11 +447,25 @@ class Application(object):
                 self.on_view_refresh_activate),
             ('About', Gtk.STOCK_ABOUT, None, None, None,
                 self.on_help_about_activate),
+            ('ValidateAll', None, "Validate _All", None,
+                "Validate every installed desktop file",
+                self.on_tools_validate_all_activate),
+            ('MimeLookup', None, "_MIME Type Handlers", None,
+                "Find the applications which handle a MIME type",
+                self.on_tools_mime_lookup_activate),
         ])
         self._app_actions.add_toggle_actions([
             ('ViewReadOnly', None, "Show _read-only files", None, None,
                 self.on_view_read_only_toggled,
                 self._settings.get_boolean("show-read-only-files")),
+            ('ViewBrokenOnly', None, "Show _broken files only", None,
+                "Only show launchers whose program is not installed",
+                self.on_view_broken_only_toggled, False),
+            ('ViewShadowed', None, "Show _shadowed files", None,
+                "Show files overridden by a file with the same ID in a "
+                "directory of higher precedence",
+                self.on_view_shadowed_toggled,
+                self._settings.get_boolean("show-shadowed-files")),
             #('ViewToolbar', None, "_Toolbar", None, None,
             #    self.on_view_toolbar_toggled, False),
         ])
@@ -339,6 +477,25 @@ class Application(object):
         ])
         self._save_actions.set_sensitive(False)
 
+        self._history_actions = Gtk.ActionGroup("HistoryActions")
+        self._history_actions.add_actions([
+            ('Undo', Gtk.STOCK_UNDO, None, "<control>z", "Undo the last change",
+                self.on_edit_undo_activate),
+            ('Redo', Gtk.STOCK_REDO, None, "<control><shift>z",
+                "Redo the last undone change", self.on_edit_redo_activate),
+        ])
+        self._history_actions.get_action("Undo").set_sensitive(False)
+        self._history_actions.get_action("Redo").set_sensitive(False)
+
+        # actions on the launchers selected in the tree view
+        self._selection_actions = Gtk.ActionGroup("SelectionActions")
+        self._selection_actions.add_actions([
+            ('BulkEdit', None, "_Set or Remove Key...", None,
+                "Set or remove a key in every selected file",
+                self.on_tools_bulk_edit_activate),
+        ])
+        self._selection_actions.set_sensitive(False)
+
         self._open_actions = Gtk.ActionGroup("OpenActions")
         self._open_actions.add_actions([
             ('SaveAs', Gtk.STOCK_SAVE_AS, None, None, None,
@@ -351,7 +508,9 @@ class Application(object):
 
         manager.insert_action_group(self._app_actions)
         manager.insert_action_group(self._save_actions)
+        manager.insert_action_group(self._history_actions)
         manager.insert_action_group(self._open_actions)
+        manager.insert_action_group(self._selection_actions)
 
         ui_file = os.path.join(self.UI_DIR, 'menu_toolbar.ui')
         manager.add_ui_from_file(ui_file)
@@ -403,8 +562,13 @@ class Application(object):
         self._update_ui()
         if not entry:
             # clear all
+            self._live_validator.cancel()
+            self._show_validation(None)
             self._status_pop()
-            self._sourceview.get_buffer().set_text("")
+            if self._sourceview:
+                self._sourceview.get_buffer().set_text("")
+            if self._advanced_tab_ready:
+                self._advanced_treeview.get_model().clear()
             self._type_combo.set_active_id("Application")
             self._name_entry.set_text("")
             self._icon_entry.set_text("")
@@ -422,58 +586,258 @@ class Application(object):
         # populate basic tab
         self._update_basic_tab()
 
-        # populate advanced tab
-
-        # load file into source view
-        self._update_source_tab()
+        # the other tabs are updated when they are shown
+        self._update_tab(self._notebook.get_current_page())
 
         self._open_actions.set_sensitive(True)
         self._notebook.set_sensitive(True)
         self._state = self.STATE_NORMAL
+        self._live_validator.schedule(entry)
 
     def _load_treeview(self):
         """
-        Load the treeview with the .desktop entries found at path.
+        Load the treeview with the .desktop entries found in the XDG data dirs.
+        The entries are parsed in the background and added in batches.
         """
+        if self._scanner.is_running():
+            self._scanner.cancel()
+        else:
+            self._treeview.get_bin_window().set_cursor(Gdk.Cursor(Gdk.CursorType.WATCH))
+            self._status_push("Loading...")
+
+        self._model.clear()
+        self._rows.clear()
+        self._search_index.clear()
+        self._show_ro = self._settings.get_boolean('show-read-only-files')
+        self._show_shadowed = self._settings.get_boolean('show-shadowed-files')
+        self._scanner.include_shadowed = self._show_shadowed
+        self._scanner.parser = self._settings.get_string('listing-parser')
+        self._scanner.scan(self._on_scan_batch,
+                           self._on_scan_progress,
+                           self._on_scan_finished)
+        self._mime_index.set_index(self._scanner.index)
+        self._mime_index.start_scan()
+
+    def _on_scan_batch(self, results):
+        """
+        Add a batch of EntrySummary objects from the scanner to the treeview.
+        """
+        for result in results:
+            self._set_row(result)
+
+    def _set_row(self, result):
+        """
+        Insert or update the treeview row for an EntrySummary, or remove it if the
+        entry should not be shown.
+        """
+        self._mime_index.update(result)
+        if result.read_only and not self._show_ro:
+            self._remove_row(result.filename)
+            return # skip read-only per settings
+
+        shadowed_by = None
+        if self._scanner.index is not None:
+            shadowed_by = self._scanner.index.shadowed_by(result.filename)
+        if shadowed_by and not self._show_shadowed:
+            self._remove_row(result.filename)
+            return # only the effective entry of each desktop file ID
+
+        if result.generic_name:
+            tooltip = result.generic_name
+        else:
+            tooltip = result.name
+        tooltip = GLib.markup_escape_text(tooltip)
+
+        markup = GLib.markup_escape_text(result.name)
+        if result.read_only or result.broken:
+            markup = "<span color='#888888'>%s</span>" % markup
+        if result.broken:
+            tooltip += GLib.markup_escape_text("\nProgram not found: %s" %
+                                               result.program)
+        if shadowed_by:
+            markup = "<i>%s</i>" % markup
+            tooltip += GLib.markup_escape_text("\nShadowed by %s" % shadowed_by)
+
+        file_id = None
+        if self._scanner.index is not None:
+            file_id = self._scanner.index.get_id(result.filename)
+        self._search_index.add(result.filename, u"\n".join((
+                               result.name, result.generic_name,
+                               u" ".join(result.categories), result.search_text,
+                               file_id or os.path.basename(result.filename))))
+        if self._search_matches is not None:
+            self._queue_refilter()
+
+        row = (result.icon or "", result.name, result.filename, tooltip, markup,
+               result.broken)
+        model = self._model
+        iter = self._rows.get(result.filename)
+        if iter:
+            model.set(iter, range(len(row)), row)
+        else:
+            self._rows[result.filename] = model.append(row)
 
-        self._treeview.get_bin_window().set_cursor(Gdk.Cursor(Gdk.CursorType.WATCH))
-        self._status_push("Loading...")
-        while Gtk.events_pending():
-            Gtk.main_iteration()
+    def _icon_cell_data_func(self, column, cell, model, iter, data=None):
+        """
+        Render the icon of a visible row, showing a placeholder until the icon
+        has been loaded in the background.
+        """
+        icon = model.get_value(iter, 0)
+        pixbuf = self._icon_loader.lookup(icon)
+        if pixbuf is None:
+            pixbuf = self._placeholder_pixbuf
+            self._icon_loader.request(icon)
+        cell.set_property("pixbuf", pixbuf)
 
-        model = self._treeview.get_model()
-        model.clear()
-        #
-        show_ro = self._settings.get_boolean('show-read-only-files')
-        for path in xdg_data_dirs:
-            path = os.path.join(path, "applications")
-            logger.debug("Loading desktop entries from %s" % path)
-            for desktop_file in glob.glob(os.path.join(path, "*.desktop")):
-                #logger.debug(desktop_file)
-                try:
-                    entry = Entry(desktop_file)
-                except ParsingError, e:
-                    logger.warn(e)
-                    continue # skip entries with parse errors
-
-                pixbuf = entry.getIconPixbuf(16)
-
-                if entry.getGenericName():
-                    tooltip = entry.getGenericName()
-                else:
-                    tooltip = entry.getName()
-                tooltip = GLib.markup_escape_text(tooltip)
-
-                markup = GLib.markup_escape_text(entry.getName())
-                if entry.isReadOnly():
-                    if show_ro:
-                        markup = "<span color='#888888'>%s</span>" % markup
-                    else:
-                        continue # skip read-only per settings
-
-                model.append((pixbuf, entry.getName(), desktop_file, tooltip, markup,))
+    def _remove_row(self, filename):
+        """
+        Remove the treeview row for filename, if there is one.
+        """
+        iter = self._rows.pop(filename, None)
+        if iter:
+            self._model.remove(iter)
+        self._search_index.remove(filename)
+
+    def _filter_visible_func(self, model, iter, data=None):
+        if self._broken_only and not model.get_value(iter, 5):
+            return False
+        matches = self._search_matches
+        return matches is None or model.get_value(iter, 2) in matches
+
+    def _queue_refilter(self):
+        """
+        Search the index for the text in the search box and update the
+        filter once the text and the list stop changing for a moment.
+        """
+        if self._refilter_id is not None:
+            GLib.source_remove(self._refilter_id)
+        self._refilter_id = GLib.timeout_add(SEARCH_DELAY_MS,
+                                             self._on_refilter_timeout)
+
+    def _on_refilter_timeout(self):
+        self._refilter_id = None
+        self._search_matches = self._search_index.search(
+                                    self._search_entry.get_text().decode('utf-8'))
+        self._filter.refilter()
+        return False
+
+    def _update_row_for_entry(self, entry):
+        """
+        Update or insert the treeview row for an Entry which was just saved,
+        keeping the scroll position and selecting the row. Files saved outside
+        the applications directories are not listed.
+        """
+        index = self._scanner.index
+        if index is None or index.locate(entry.filename)[0] is None:
+            return
+        shadowed = index.add(entry.filename)
+        if shadowed:
+            # the saved file now takes the place of another one
+            self._update_rows([shadowed])
+        result = EntrySummary.from_entry(entry)
+        result.broken = is_broken(result)
+        try:
+            self._scanner.catalog.store(entry.filename, os.stat(entry.filename),
+                                        result)
+        except OSError:
+            pass
+
+        vadjustment = self._treeview.get_vadjustment()
+        scroll_position = vadjustment.get_value()
+        self._set_row(result)
+        self._mime_index_changed()
+        iter = self._rows.get(entry.filename)
+        if iter:
+            path = self._filter.convert_child_path_to_path(
+                                                    self._model.get_path(iter))
+            selection = self._treeview.get_selection()
+            if path and not selection.path_is_selected(path):
+                selection.unselect_all()
+                selection.select_path(path)
+        vadjustment.set_value(scroll_position)
+
+    def _on_applications_changed(self, filenames):
+        """
+        Apply a batch of changes reported by the applications monitor to the
+        treeview, touching only the affected rows.
+        """
+        index = self._scanner.index
+        removed = [f for f in filenames if not os.path.exists(f)]
+        changed = set(f for f in filenames if f not in removed)
+        for filename in removed:
+            self._scanner.catalog.remove(filename)
+            self._remove_row(filename)
+            self._mime_index.remove(filename)
+            if index is not None:
+                # a shadowed copy may take its place
+                effective = index.remove(filename)
+                if effective:
+                    changed.add(effective)
+        if index is not None:
+            for filename in list(changed):
+                shadowed = index.add(filename)
+                if shadowed:
+                    changed.add(shadowed)
+        if changed:
+            self._update_rows(list(changed))
+
+    def _update_rows(self, filenames):
+        """
+        Parse filenames again in the background and update their rows.
+        """
+        updated = set()
+        def on_batch(results):
+            for result in results:
+                updated.add(result.filename)
+                self._set_row(result)
+        def on_finished():
+            # files which no longer parse are dropped from the list
+            for filename in filenames:
+                if filename not in updated:
+                    self._remove_row(filename)
+                    self._mime_index.remove(filename)
+            self._mime_index_changed()
+        self._scanner.update(filenames, on_batch, on_finished)
+
+    def _on_scan_progress(self, done, total):
+        """
+        Show the scanner's progress in the statusbar.
+        """
+        self._status_pop()
+        self._status_push("Loading... (%d of %d)" % (done, total))
+
+    def _on_scan_finished(self):
+        """
+        Restore the cursor and statusbar once the scanner is done.
+        """
         self._treeview.get_bin_window().set_cursor(None)
         self._status_pop()
+        self._mime_index.finish_scan()
+        self._mime_index_changed()
+        logger.debug("Icon cache: %s" % get_pixbuf_cache().stats())
+        logger.debug("Icon disk cache: %s" % get_icon_disk_cache().stats())
+
+    def _apply_mime_cache_dirs(self):
+        """
+        Let the MIME index write the caches of system directories only if the
+        settings say so.
+        """
+        if self._settings.get_boolean("write-system-mime-caches"):
+            self._mime_index.write_dirs = None
+            self._mime_index_changed()
+        else:
+            self._mime_index.write_dirs = [os.path.join(xdg_data_home,
+                                                        "applications")]
+
+    def _mime_index_changed(self):
+        """
+        Write the mimeinfo.cache files which are out of date and refresh the
+        MIME type lookup window.
+        """
+        if self._settings.get_boolean("write-mime-cache"):
+            self._mime_index.queue_save()
+        if self._mime_lookup:
+            self._mime_lookup.refresh()
 
     def new_file(self):
         """
@@ -487,6 +851,7 @@ class Application(object):
                 filename = filename + ".desktop"
             self._entry.new(filename)
             self._entry.set("Name", "Untitled")
+            self._history.clear()
             logger.debug(self._entry.getName())
             self.save_file(filename)
             return
@@ -499,11 +864,11 @@ class Application(object):
         model = treeview.get_model()
         key = model[path][0]
         model[path][1] = new_text
-        self._ui_value_changed(key, new_text)
+        self._ui_value_changed(key, new_text, merge=False)
 
     def on_type_combo_changed(self, combo, data=None):
         type_str = combo.get_model()[combo.get_active()][0]
-        self._ui_value_changed("Type", type_str)
+        self._ui_value_changed("Type", type_str, merge=False)
         if self._entry:
             self._update_basic_tab()
 
@@ -512,13 +877,38 @@ class Application(object):
 
     def on_exec_entry_icon_press(self, entry, icon_pos, event, data=None):
         """
-        Execute the command when the user presses the icon in the entry.
+        Execute the command when the user presses the primary icon in the
+        entry. The secondary icon shows the validation problems.
         """
-        # TODO async? Wait for retval?
-        if not self._entry:
+        if not self._entry or icon_pos != Gtk.EntryIconPosition.PRIMARY:
             return
-        retval = subprocess.call(self._entry.getExec(), shell=True)
-        logger.debug("Exited with code " + str(retval))
+        entry = self._entry
+        try:
+            argv = expand_exec(entry.getExec(), icon=entry.getIcon(),
+                               name=entry.getName(), filename=entry.filename)
+        except ValueError, e:
+            self.error_dialog(str(e))
+            return
+        if entry.getTerminal():
+            terminal = (GLib.find_program_in_path("x-terminal-emulator") or
+                        "xterm")
+            argv = [terminal, "-e"] + argv
+        self._test_launch(argv, entry.getPath() or None)
+
+    def on_edit_redo_activate(self, action, data=None):
+        if self._entry and self._history.redo(self._entry):
+            self._history_changed()
+
+    def on_edit_undo_activate(self, action, data=None):
+        if self._entry and self._history.undo(self._entry):
+            self._history_changed()
+
+    def _history_changed(self):
+        """
+        Show the entry after a step was undone or redone.
+        """
+        self._entry.is_modified = not self._history.is_saved()
+        self._load_desktop_entry_ui()
 
     def on_file_close_activate(self, action, data=None):
         self.close_file()
@@ -561,8 +951,29 @@ class Application(object):
         """
         icon = entry.get_text()
         self._ui_value_changed("Icon", icon)
+        self._update_icon_entry_pixbuf()
 
-        entry.set_property("primary-icon-pixbuf", get_icon_pixbuf(icon, 16))
+    def _update_icon_entry_pixbuf(self):
+        """
+        Show the icon named in the icon entry, loading it in the background
+        like the icons of the launcher list if needed.
+        """
+        icon = self._icon_entry.get_text()
+        pixbuf = self._icon_loader.lookup(icon)
+        if pixbuf is None:
+            self._icon_loader.request(icon)
+            pixbuf = self._icon_loader.lookup(icon)
+        self._icon_entry_pending = pixbuf is None
+        if pixbuf is not None:
+            self._icon_entry.set_property("primary-icon-pixbuf", pixbuf)
+
+    def _on_icons_loaded(self):
+        """
+        Called by the IconLoader when icons were loaded in the background.
+        """
+        self._treeview.queue_draw()
+        if self._icon_entry_pending:
+            self._update_icon_entry_pixbuf()
 
     def on_icon_entry_icon_press(self, entry, icon_pos, event, data=None):
         """
@@ -592,8 +1003,12 @@ class Application(object):
     def on_save_button_clicked(self, button, data=None):
         self.save_file(self._entry.filename)
 
+    def on_search_entry_changed(self, entry, data=None):
+        self._queue_refilter()
+
     def on_terminal_button_toggled(self, button, data=None):
-        self._ui_value_changed("Terminal", str(button.get_active()).lower())
+        self._ui_value_changed("Terminal", str(button.get_active()).lower(),
+                               merge=False)
 
     def on_tools_validate_activate(self, action, data=None):
         """
@@ -608,6 +1023,148 @@ class Application(object):
         self.info_dialog("%s is valid." % os.path.basename(self._entry.filename),
                          "Validation")
 
+    def on_tools_validate_all_activate(self, action, data=None):
+        """
+        Validate every installed desktop file in the background and stream the
+        problems into a report window.
+        """
+        if self._validation_report:
+            self._validation_report.present()
+            return
+        report = ValidationReport(self.window, self.open_file)
+        report.connect("destroy", self.on_validation_report_destroy)
+        report.show()
+        self._validation_report = report
+        self._bulk_validator.validate(desktop_files(), report.add_results,
+                                      report.set_progress, report.set_finished)
+
+    def on_tools_mime_lookup_activate(self, action, data=None):
+        """
+        Show the window listing the applications which handle a MIME type.
+        """
+        if self._mime_lookup:
+            self._mime_lookup.present()
+            return
+        self._mime_lookup = MimeLookup(self._mime_index, self.window,
+                                       self.open_file)
+        self._mime_lookup.connect("destroy", self.on_mime_lookup_destroy)
+        self._mime_lookup.show()
+
+    def on_mime_lookup_destroy(self, window, data=None):
+        self._mime_lookup = None
+
+    def on_tools_bulk_edit_activate(self, action, data=None):
+        """
+        Ask for a key to set or remove and apply it to every selected file in
+        the background.
+        """
+        filenames = self._selected_filenames()
+        if not filenames:
+            return
+        change = self._bulk_edit_dialog(len(filenames))
+        if change is None:
+            return
+        self._selection_actions.set_sensitive(False)
+        self._status_push("Applying %s to %d files..." % (change,
+                                                          len(filenames)))
+        self._bulk_editor.apply(filenames, change, self._on_bulk_edit_finished,
+                                self._on_bulk_edit_progress)
+
+    def _bulk_edit_dialog(self, count):
+        """
+        Return the KeyChange the user wants to apply to count files, or None if
+        the user cancels.
+        """
+        dialog = Gtk.Dialog("Set or Remove Key", self.window,
+                            Gtk.DialogFlags.MODAL |
+                            Gtk.DialogFlags.DESTROY_WITH_PARENT,
+                            (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                             Gtk.STOCK_APPLY, Gtk.ResponseType.OK))
+        dialog.set_default_response(Gtk.ResponseType.OK)
+        key_combo = Gtk.ComboBoxText.new_with_entry()
+        for key in BULK_EDIT_KEYS:
+            key_combo.append_text(key)
+        key_combo.get_child().set_activates_default(True)
+        value_entry = Gtk.Entry()
+        value_entry.set_activates_default(True)
+        set_radio = Gtk.RadioButton.new_with_mnemonic(None, "_Set to:")
+        remove_radio = Gtk.RadioButton.new_with_mnemonic_from_widget(set_radio,
+                                                                     "_Remove")
+        set_radio.connect("toggled", lambda button: value_entry.set_sensitive(
+                                                        button.get_active()))
+
+        grid = Gtk.Grid(row_spacing=6, column_spacing=12)
+        grid.set_border_width(6)
+        label = Gtk.Label("Change the [Desktop Entry] group of %d files. "
+                          "Either every file is changed or none." % count)
+        label.set_line_wrap(True)
+        label.set_alignment(0, 0.5)
+        grid.attach(label, 0, 0, 2, 1)
+        key_label = Gtk.Label.new_with_mnemonic("_Key:")
+        key_label.set_mnemonic_widget(key_combo)
+        key_label.set_alignment(0, 0.5)
+        grid.attach(key_label, 0, 1, 1, 1)
+        grid.attach(key_combo, 1, 1, 1, 1)
+        grid.attach(set_radio, 0, 2, 1, 1)
+        grid.attach(value_entry, 1, 2, 1, 1)
+        grid.attach(remove_radio, 0, 3, 2, 1)
+        dialog.get_content_area().pack_start(grid, True, True, 0)
+        dialog.show_all()
+
+        change = None
+        while dialog.run() == Gtk.ResponseType.OK:
+            key = (key_combo.get_active_text() or "").strip()
+            if not re.match(r"^[A-Za-z0-9-]+(\[[^\]]+\])?$", key):
+                self.error_dialog("Keys may only contain A-Z, a-z, 0-9 and -, "
+                                  "optionally followed by a [locale].")
+                continue
+            if remove_radio.get_active():
+                change = KeyChange(key)
+            else:
+                change = KeyChange(key, value_entry.get_text())
+            break
+        dialog.destroy()
+        return change
+
+    def _on_bulk_edit_progress(self, done, total):
+        self._status_pop()
+        self._status_push("Preparing %d of %d files..." % (done, total))
+
+    def _on_bulk_edit_finished(self, result):
+        """
+        Refresh only the rows of the files a bulk edit changed, or tell the
+        user why nothing was changed.
+        """
+        self._status_pop()
+        self._selection_actions.set_sensitive(bool(self._selected_filenames()))
+        if not result.is_committed():
+            errors = ["%s: %s" % (os.path.basename(filename), message)
+                      for filename, message in result.errors]
+            if len(errors) > BULK_EDIT_MAX_ERRORS:
+                errors[BULK_EDIT_MAX_ERRORS:] = ["and %d more" % (
+                                        len(errors) - BULK_EDIT_MAX_ERRORS)]
+            self.error_dialog("Could not %s, no file was changed.\n\n%s" %
+                              (result.change, "\n".join(errors)))
+            return
+        self._status_push("Changed %d files, %d already up to date" %
+                          (len(result.changed), len(result.unchanged)))
+        if result.warnings:
+            warnings = result.warnings[:BULK_EDIT_MAX_ERRORS]
+            if len(result.warnings) > BULK_EDIT_MAX_ERRORS:
+                warnings.append("and %d more" % (len(result.warnings) -
+                                                 BULK_EDIT_MAX_ERRORS))
+            self.warning_dialog("\n".join(warnings))
+        if result.changed:
+            self._update_rows(result.changed)
+        # reload the open entry unless that would lose the user's changes
+        entry = self._entry
+        if entry and not entry.isModified() and entry.filename in result.changed:
+            self.open_file(entry.filename)
+
+    def on_validation_report_destroy(self, window, data=None):
+        self._bulk_validator.cancel()
+        self._validation_report = None
+
     def on_treeview_button_press_event(self, treeview, event, data=None):
         # if user needs to save...
             # return True
@@ -621,27 +1178,50 @@ class Application(object):
     def on_main_window_show(self, window, data=None):
         self._ensure_user_dir()
         self._load_treeview()
-        pass
+        self._monitor.start()
 
     def on_name_entry_changed(self, entry, data=None):
         self._ui_value_changed("Name", entry.get_text())
 
-    def on_notebook_switch_page(self, notebook, page, data=None):
-        index = self._notebook.get_current_page()
-        if index == self.SOURCE_TAB:
+    def on_notebook_switch_page(self, notebook, page, page_num):
+        # the current page is still the old one while the signal is emitted
+        if page_num == self.BASIC_TAB:
+            if self._entry:
+                self._update_basic_tab()
+        else:
+            self._update_tab(page_num)
+
+    def _update_tab(self, index):
+        """
+        Update the advanced or source tab, building it if it is shown for the
+        first time, or create the launch log.
+        """
+        if index == self.LOG_TAB:
+            self._get_log_textview()
+        elif not self._entry:
+            return
+        elif index == self.SOURCE_TAB:
             self._update_source_tab()
         elif index == self.ADVANCED_TAB:
             self._update_advanced_tab()
-        else:
-            self._update_basic_tab()
 
     def on_treeview_selection_changed(self, selection, data=None):
         """
-        Change the currently selected desktop entry.
+        Change the currently selected desktop entry. Selecting several rows
+        keeps the open entry and enables the actions on the selection.
         """
-        model, iter = selection.get_selected()
-        if model and iter:
-            self.open_file(model.get_value(iter, 2))
+        model, paths = selection.get_selected_rows()
+        editing = self._bulk_editor.is_running()
+        self._selection_actions.set_sensitive(bool(paths) and not editing)
+        if len(paths) == 1:
+            filename = model[paths[0]][2]
+            if self._entry and self._entry.filename == filename:
+                return # already open, e.g. the row was selected after a save
+            self.open_file(filename)
+
+    def _selected_filenames(self):
+        model, paths = self._treeview.get_selection().get_selected_rows()
+        return [model[path][2] for path in paths]
 
     def on_url_entry_changed(self, entry, data=None):
         self._ui_value_changed("URL", entry.get_text())
@@ -649,14 +1229,69 @@ class Application(object):
     def on_url_entry_icon_press(self, entry, icon_pos, event, data=None):
         if not self._entry:
             return
-        subprocess.call(["xdg-open", self._entry.getURL()])
+        self._test_launch(["xdg-open", self._entry.getURL()])
+
+    def _test_launch(self, argv, cwd=None):
+        """
+        Start argv in the background and log its output in the log tab.
+        """
+        launch = Launch(argv, self._on_launch_output, self._on_launch_exited, cwd)
+        try:
+            launch.start()
+        except GLib.GError, e:
+            self._log("Failed to start %s: %s\n" % (argv[0], e.message))
+            self.error_dialog(e.message)
+            return
+        self._log("[%s] Started %s\n" % (launch.pid, " ".join(argv)))
+        self._launches[launch] = self._statusbar.push(self._launch_ctx,
+                                                      "Started %s" % argv[0])
+
+    def _on_launch_output(self, launch, stream_name, line):
+        self._log("[%s %s] %s\n" % (launch.pid, stream_name, line))
+
+    def _on_launch_exited(self, launch):
+        message_id = self._launches.pop(launch, None)
+        if message_id is not None:
+            self._statusbar.remove(self._launch_ctx, message_id)
+        if launch.exit_status is not None:
+            status = "exited with status %d" % launch.exit_status
+        else:
+            status = "was killed by signal %s" % launch.term_signal
+        if launch.startup_time is not None:
+            startup = ", first output after %.3fs" % launch.startup_time
+        else:
+            startup = ""
+        self._log("[%s] %s %s after %.3fs%s\n" % (launch.pid, launch.argv[0],
+                                                 status, launch.elapsed,
+                                                 startup))
+
+    def _log(self, text):
+        """
+        Append text to the launch log and scroll to it.
+        """
+        textview = self._get_log_textview()
+        buffer = textview.get_buffer()
+        buffer.insert(buffer.get_end_iter(), text)
+        buffer.place_cursor(buffer.get_end_iter())
+        textview.scroll_mark_onscreen(buffer.get_insert())
 
     def on_view_read_only_toggled(self, action, data=None):
         self._settings.set_boolean("show-read-only-files",
                                     action.get_active())
 
+    def on_view_broken_only_toggled(self, action, data=None):
+        self._broken_only = action.get_active()
+        self._filter.refilter()
+
+    def on_view_shadowed_toggled(self, action, data=None):
+        self._settings.set_boolean("show-shadowed-files",
+                                    action.get_active())
+
     def on_view_refresh_activate(self, action, data=None):
+        get_access_cache().clear()
         self._load_treeview()
+        # directories may have been created while nothing watched them
+        self._monitor.refresh()
 
     def on_view_toolbar_toggled(self, action, data=None):
         # TODO
@@ -697,6 +1332,7 @@ class Application(object):
         except ParsingError, e:
             self.error_dialog(e)
             return
+        self._history.clear()
 
         self._load_desktop_entry_ui()
         # validate in save
@@ -713,6 +1349,12 @@ class Application(object):
         Used as callback for both user quit (File > Quit) and window manager
         killing the window.
         """
+        self._bulk_validator.cancel()
+        # never leave a bulk edit half applied
+        self._bulk_editor.cancel(wait=True)
+        get_icon_disk_cache().save()
+        if self._settings.get_boolean("write-mime-cache"):
+            self._mime_index.save()
         Gtk.main_quit()
 
     def run(self):
@@ -752,8 +1394,16 @@ class Application(object):
 
     def save_file(self, filename):
         # TODO confirm user wants to save if the file is invalid
-        self._entry.write(filename)
-        self._load_treeview()
+        try:
+            warnings = self._entry.write(filename)
+        except (IOError, OSError), e:
+            self.error_dialog("Could not save %s.\n\n%s" % (filename, e))
+            return
+        if warnings:
+            self.warning_dialog("\n".join(warnings))
+        get_access_cache().invalidate(filename)
+        self._update_row_for_entry(self._entry)
+        self._history.mark_saved()
         self.set_modified(False)
         self._load_desktop_entry_ui()
 
@@ -762,7 +1412,21 @@ class Application(object):
         Set the modified flag on the entry and update the titlebar
         """
         self._entry.is_modified = modified
+        self._queue_update_ui()
+
+    def _queue_update_ui(self):
+        """
+        Update the UI from an idle callback before the next redraw, so that
+        any number of changes in between result in one update.
+        """
+        if self._update_ui_id is None:
+            self._update_ui_id = GLib.idle_add(self._on_update_ui_idle,
+                                               priority=GLib.PRIORITY_HIGH_IDLE)
+
+    def _on_update_ui_idle(self):
+        self._update_ui_id = None
         self._update_ui()
+        return False
 
     def _status_pop(self):
         """
@@ -776,24 +1440,58 @@ class Application(object):
         """
         self._statusbar.push(self._statusbar_ctx, status)
 
-    def _ui_value_changed(self, key, value):
+    def _ui_value_changed(self, key, value, merge=True):
         """
-        Generic method to handle user changes to the Entry via the GUI.
+        Generic method to handle user changes to the Entry via the GUI. The
+        change is recorded in the undo history, merged with the previous one
+        if it changed the same key and merge is True.
         """
-        if self._state == self.STATE_NORMAL:
-            self.set_modified(True)
-        else:
+        if self._state != self.STATE_NORMAL:
             return # do not continue if we're loading UI
 
-        if not value:
-            self._entry.removeKey(key)
-        else:
-            self._entry.set(key, value)
+        if self._history.change(self._entry, key, value, merge=merge):
+            self.set_modified(True)
+            self._live_validator.schedule(self._entry)
+
+    def _on_entry_validated(self, result):
+        """
+        Called by the LiveValidator when the entry being edited was validated.
+        """
+        self._show_validation(result)
+
+    def _show_validation(self, result):
+        """
+        Show the problems of a ValidationResult in the statusbar and as icons
+        in the fields they concern, or clear them if result is None.
+        """
+        self._statusbar.remove_all(self._validation_ctx)
+        if result and not result.is_valid():
+            self._statusbar.push(self._validation_ctx,
+                                 "%d errors, %d warnings" % (len(result.errors),
+                                                            len(result.warnings)))
+        for key, widget in (("Name", self._name_entry),
+                            ("Exec", self._exec_entry)):
+            pattern = re.compile(r"\b%s\b" % key)
+            icon_name = None
+            messages = []
+            if result:
+                for name, problems in (("dialog-warning", result.warnings),
+                                       ("dialog-error", result.errors)):
+                    found = [m for m in problems if pattern.search(m)]
+                    if found:
+                        icon_name = name
+                        messages.extend(found)
+            widget.set_icon_from_icon_name(Gtk.EntryIconPosition.SECONDARY,
+                                           icon_name)
+            widget.set_icon_tooltip_text(Gtk.EntryIconPosition.SECONDARY,
+                                         "\n".join(messages) or None)
 
     def _update_advanced_tab(self):
         """
         Update the advanced tab based on the current state of the Entry.
         """
+        if not self._advanced_tab_ready:
+            self._init_advanced_tab()
         model = self._advanced_treeview.get_model()
         model.clear()
         for key, tooltip, t in self.ALL_KEYS:
@@ -835,26 +1533,9 @@ class Application(object):
         Update the source tab with the contents of what the .desktop file would
         look like based on the current, possibly unsaved entry.
         """
-        # temporarily change entry filename to a temp file to write it's output
-        entry = self._entry
-        original_filename = self._entry.filename
-        (fd, filename) = tempfile.mkstemp(suffix=".desktop")
-        entry.write(filename)
-
-        # load temp file into sourceview
-        #self._sourceview.set_editable(False)
-        buffer = self._sourceview.get_buffer()
-        with open(entry.filename, 'r') as f:
-            buffer.set_text(f.read())
-        f.closed
-        #self._sourceview.set_editable(True)
-
-        # clean up
-        if fd:
-            os.close(fd)
-        if filename:
-            os.remove(filename)
-        entry.filename = original_filename
+        if self._sourceview is None:
+            self._init_source_tab()
+        self._sourceview.get_buffer().set_text(self._entry.toString())
 
     def _update_ui(self):
         """
@@ -864,19 +1545,31 @@ class Application(object):
 
         # titlebar
         if not entry:
-            self.window.set_title(self.APP_NAME)
+            title = self.APP_NAME
+            is_read_only = False
         else:
+            is_read_only = entry.isReadOnly()
             read_only = modified_indicator = ""
-            if entry.isReadOnly():
+            if is_read_only:
                 read_only = "(read-only)"
             if entry.is_modified:
                 modified_indicator = "*"
-            self.window.set_title("%s%s %s - %s" % (modified_indicator,
-                                                    os.path.basename(entry.filename),
-                                                    read_only,
-                                                    self.APP_NAME))
+            title = "%s%s %s - %s" % (modified_indicator,
+                                      os.path.basename(entry.filename),
+                                      read_only,
+                                      self.APP_NAME)
+        if title != self._title:
+            self.window.set_title(title)
+            self._title = title
+
+        # undo and redo
+        self._history_actions.get_action("Undo").set_sensitive(
+            bool(entry) and self._history.can_undo())
+        self._history_actions.get_action("Redo").set_sensitive(
+            bool(entry) and self._history.can_redo())
+
         # save buttons
-        if entry and entry.isModified() and not entry.isReadOnly():
-            self._save_actions.set_sensitive(True)
-        else:
-            self._save_actions.set_sensitive(False)
+        sensitive = bool(entry and entry.isModified() and not is_read_only)
+        if sensitive != self._save_sensitive:
+            self._save_actions.set_sensitive(sensitive)
+            self._save_sensitive = sensitive
@@ -0,0 +1,278 @@
+"""
+Crash-safe replacement of desktop files.
+
+A file is never rewritten in place. The new contents go to a temporary file
+in the same directory, which gets the mode and ownership of the file it
+replaces and is flushed to disk before being renamed over it. A crash or a
+full disk therefore leaves either the old or the new file, never a truncated
+one. Once renamed, the directory is synced so the rename itself survives a
+crash. A WriteBatch does this for many files at once and syncs each directory
+only once, so N files in one directory cost N + 1 fsyncs instead of 2N.
+
+A writable file in a directory which is not writable cannot be replaced this
+way. Such files are rewritten in place when the batch is committed instead,
+which is not crash-safe but is what saving them did before.
+"""
+import os
+import time
+import errno
+import shutil
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+TMP_SUFFIX = ".tmp"
+BACKUP_SUFFIX = ".bak"
+
+# mode of new files, the umask cannot be read without changing it
+_umask = os.umask(0)
+os.umask(_umask)
+NEW_FILE_MODE = 0666 & ~_umask
+
+
+def _fsync_dir(path):
+    """
+    Flush the directory entries of path to disk. Not every file system
+    supports this, so errors are only logged.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError, e:
+        logger.debug("Could not sync directory %s: %s" % (path, e))
+
+
+def _unlink(filename):
+    try:
+        os.unlink(filename)
+    except OSError:
+        pass
+
+
+class StagedFile(object):
+    """
+    The new contents of filename, written and synced to tmp_filename. If the
+    batch keeps backups, backup_filename is a link to the original. A file
+    rewritten in place has no tmp_filename but its new contents in data and,
+    with backups, the original contents in original.
+    """
+    __slots__ = ('filename', 'tmp_filename', 'backup_filename', 'data',
+                 'original', 'mode', 'seconds')
+
+    def __init__(self, filename, tmp_filename):
+        self.filename = filename
+        self.tmp_filename = tmp_filename
+        self.backup_filename = None
+        self.data = None
+        self.original = None
+        self.mode = None
+        self.seconds = 0.0
+
+
+def _write_in_place(filename, data, mode=None):
+    with open(filename, "r+b") as f:
+        f.write(data)
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+    if mode is not None:
+        os.chmod(filename, mode)
+
+
+def atomic_write(filename, data, mode=None):
+    """
+    Replace filename with the string data, or create it, without ever leaving
+    a partially written file. mode, if given, replaces the permission bits of
+    the file. Returns the list of warnings of the WriteBatch. Raises IOError
+    or OSError.
+    """
+    batch = WriteBatch()
+    batch.add(filename, data, mode)
+    batch.commit()
+    return batch.warnings
+
+
+class WriteBatch(object):
+    """
+    Files which are replaced together. add() writes and syncs the new
+    contents next to each file and may be called from several threads;
+    commit() renames them over the originals and then syncs every directory
+    involved once. With backup set, commit() replaces either every file or,
+    if a rename fails, restores the ones already replaced before raising, so
+    the batch is all or nothing. abort() throws the staged files away.
+
+    warnings lists a message for every file which could not keep its owner.
+    """
+    def __init__(self, backup=False):
+        self.backup = backup
+        self.fsyncs = 0
+        self.warnings = []
+        self._staged = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._staged)
+
+    def add(self, filename, data, mode=None):
+        """
+        Stage data as the new contents of filename. The file keeps its mode
+        unless mode is given, which is set before the file is renamed into
+        place. Raises IOError or OSError, in which case nothing is staged for
+        filename.
+        """
+        start = time.time()
+        # replace the target of a symbolic link, not the link
+        filename = os.path.realpath(filename)
+        path, basename = os.path.split(filename)
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+        try:
+            st = os.stat(filename)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            st = None
+        if (st is not None and not os.access(path or os.curdir, os.W_OK) and
+                os.access(filename, os.W_OK)):
+            self._add_in_place(filename, data, mode)
+            return
+        fd, tmp_filename = tempfile.mkstemp(prefix="." + basename + ".",
+                                            suffix=TMP_SUFFIX, dir=path)
+        staged = StagedFile(filename, tmp_filename)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            if mode is None:
+                mode = NEW_FILE_MODE if st is None else st.st_mode & 07777
+            os.chmod(tmp_filename, mode)
+            if (st is not None and
+                    (st.st_uid, st.st_gid) != (os.getuid(), os.getgid())):
+                try:
+                    os.chown(tmp_filename, st.st_uid, st.st_gid)
+                except OSError, e:
+                    message = ("Could not keep the owner of %s, it will "
+                               "belong to you: %s" % (filename, e.strerror))
+                    logger.warn(message)
+                    with self._lock:
+                        self.warnings.append(message)
+            if self.backup and st is not None:
+                staged.backup_filename = (tmp_filename[:-len(TMP_SUFFIX)] +
+                                          BACKUP_SUFFIX)
+                try:
+                    os.link(filename, staged.backup_filename)
+                except OSError:
+                    shutil.copy2(filename, staged.backup_filename)
+        except:
+            self._discard(staged)
+            raise
+        staged.seconds = time.time() - start
+        with self._lock:
+            self._staged.append(staged)
+            self.fsyncs += 1
+
+    def _add_in_place(self, filename, data, mode):
+        """
+        Stage filename to be rewritten in place, as its directory is not
+        writable.
+        """
+        logger.debug("Will rewrite %s in place, its directory is not "
+                     "writable" % filename)
+        staged = StagedFile(filename, None)
+        staged.data = data
+        staged.mode = mode
+        if self.backup:
+            with open(filename, "rb") as f:
+                staged.original = f.read()
+        with self._lock:
+            self._staged.append(staged)
+
+    def _discard(self, staged):
+        for filename in (staged.tmp_filename, staged.backup_filename):
+            if filename:
+                _unlink(filename)
+        staged.tmp_filename = staged.backup_filename = None
+
+    def abort(self):
+        """
+        Remove every staged file, leaving the originals untouched.
+        """
+        with self._lock:
+            staged, self._staged = self._staged, []
+        for item in staged:
+            self._discard(item)
+
+    def commit(self):
+        """
+        Rename every staged file over its original, or rewrite it in place,
+        and sync the directories. Returns the list of replaced file names.
+        Raises OSError with the filename attribute set if a file cannot be
+        replaced.
+        """
+        start = time.time()
+        with self._lock:
+            staged, self._staged = self._staged, []
+        committed = []
+        try:
+            for item in staged:
+                rename_start = time.time()
+                try:
+                    if item.tmp_filename is None:
+                        _write_in_place(item.filename, item.data, item.mode)
+                        self.fsyncs += 1
+                    else:
+                        os.rename(item.tmp_filename, item.filename)
+                except (IOError, OSError), e:
+                    if item.original is not None:
+                        # the file may be partially rewritten
+                        committed.append(item)
+                    raise OSError(e.errno, e.strerror, item.filename)
+                item.tmp_filename = None
+                item.seconds += time.time() - rename_start
+                committed.append(item)
+        except OSError:
+            if self.backup:
+                self._restore(committed)
+                committed = []
+            raise
+        finally:
+            self._sync_dirs(staged)
+            for item in staged:
+                self._discard(item)
+        for item in committed:
+            logger.debug("Wrote %s in %.1fms" % (item.filename,
+                                                 item.seconds * 1000))
+        logger.debug("Committed %d files in %.1fms with %d fsyncs" %
+                     (len(committed), (time.time() - start) * 1000,
+                      self.fsyncs))
+        return [item.filename for item in committed]
+
+    def _restore(self, committed):
+        """
+        Put the originals of the committed files back from their backups or
+        the original contents kept in memory.
+        """
+        for item in reversed(committed):
+            try:
+                if item.original is not None:
+                    _write_in_place(item.filename, item.original)
+                elif item.backup_filename:
+                    os.rename(item.backup_filename, item.filename)
+                    item.backup_filename = None
+                else:
+                    # there was no original
+                    os.unlink(item.filename)
+            except (IOError, OSError), e:
+                logger.error("Could not restore %s: %s" % (item.filename, e))
+
+    def _sync_dirs(self, staged):
+        for path in sorted(set(os.path.dirname(item.filename)
+                               for item in staged)):
+            _fsync_dir(path or os.curdir)
+            self.fsyncs += 1
@@ -0,0 +1,256 @@
+"""
+Setting or removing a key in many desktop files at once.
+
+The files are prepared in a pool of threads: each one is parsed, changed and
+staged in a WriteBatch which keeps backups. Only once every file has been
+staged is the batch committed, so a bulk edit changes all of its files or
+none. If a rename fails, the files replaced so far are restored from their
+backups.
+"""
+import errno
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from gi.repository import GLib
+from xdg.Exceptions import ParsingError
+
+from dee.atomicwrite import WriteBatch
+from dee.entry import Entry
+from dee.fileaccess import get_access_cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THREADS = 4
+DESKTOP_ENTRY_GROUP = "Desktop Entry"
+
+
+class KeyChange(object):
+    """
+    Set key to value in group, or remove key and its translations if value is
+    None.
+    """
+    def __init__(self, key, value=None, group=DESKTOP_ENTRY_GROUP):
+        self.key = key
+        self.value = value
+        self.group = group
+
+    def __str__(self):
+        if self.value is None:
+            return "remove %s" % self.key
+        return "set %s=%s" % (self.key, self.value)
+
+    def apply(self, entry):
+        """
+        Change entry and return True, or return False if it already has the
+        wanted state.
+        """
+        group = entry.content.get(self.group)
+        if group is None:
+            if self.value is None:
+                return False
+            entry.addGroup(self.group)
+            group = entry.content[self.group]
+        if self.value is None:
+            names = [name for name in group if name == self.key or
+                     name.startswith(self.key + "[")]
+            if not names:
+                return False
+            for name in names:
+                del group[name]
+        else:
+            if group.get(self.key) == self.value:
+                return False
+            group[self.key] = self.value
+        return True
+
+
+def prepare_file(filename, change, batch):
+    """
+    Stage filename with change applied in the WriteBatch batch. Returns False
+    if the file does not need to change. Raises ParsingError, IOError or
+    OSError.
+    """
+    if get_access_cache().is_read_only(filename):
+        raise IOError(errno.EACCES, "File is read-only", filename)
+    entry = Entry(filename)
+    if not change.apply(entry):
+        return False
+    batch.add(filename, entry.toString())
+    return True
+
+
+class BulkEditResult(object):
+    """
+    The outcome of a BulkEditJob. changed lists the files which were written,
+    unchanged the ones which already had the wanted state and errors holds
+    (filename, message) for every file which failed, in which case no file
+    was changed. warnings lists messages about changed files, e.g. the ones
+    which could not keep their owner.
+    """
+    def __init__(self, change):
+        self.change = change
+        self.changed = []
+        self.unchanged = []
+        self.errors = []
+        self.warnings = []
+        self.cancelled = False
+
+    def is_committed(self):
+        return not self.errors and not self.cancelled
+
+
+class BulkEditJob(object):
+    """
+    A single run of the BulkEditor.
+    """
+    def __init__(self, filenames, change, progress_callback,
+                 finished_callback, threads):
+        self._filenames = list(set(filenames))
+        self._change = change
+        self._progress_callback = progress_callback
+        self._finished_callback = finished_callback
+        self._threads = threads
+        self._cancelled = threading.Event()
+        # set once the batch cannot be committed anymore
+        self._failed = threading.Event()
+        self._lock = threading.Lock()
+        self._done = 0
+        self._progress_pending = False
+        self._finished = False
+        self._committing = False
+        self._thread = None
+        self.result = BulkEditResult(change)
+        self._batch = WriteBatch(backup=True)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel(self, wait=False):
+        """
+        Stop before the files are committed. No callbacks are invoked after
+        this returns. A job which already started renaming the files cannot
+        be stopped; with wait set, block until it is done so that the process
+        does not exit with the batch half applied.
+        """
+        with self._lock:
+            self._cancelled.set()
+            committing = self._committing
+        if committing and wait:
+            self._thread.join()
+
+    def is_running(self):
+        return not (self._finished or self._cancelled.is_set())
+
+    def _prepare(self, filename):
+        """
+        Prepare a single file in the thread pool. Returns (filename, whether
+        it was staged, error message or None).
+        """
+        if self._failed.is_set() or self._cancelled.is_set():
+            return filename, False, None
+        try:
+            return filename, prepare_file(filename, self._change,
+                                          self._batch), None
+        except (ParsingError, IOError, OSError, UnicodeError), e:
+            self._failed.set()
+            return filename, False, str(e)
+
+    def _run(self):
+        result = self.result
+        staged = []
+        pool = ThreadPool(self._threads)
+        try:
+            for filename, is_staged, error in pool.imap_unordered(
+                                            self._prepare, self._filenames):
+                if error is not None:
+                    result.errors.append((filename, error))
+                elif is_staged:
+                    staged.append(filename)
+                elif not self._failed.is_set():
+                    result.unchanged.append(filename)
+                with self._lock:
+                    self._done += 1
+                    self._schedule_progress()
+        finally:
+            pool.close()
+            pool.join()
+
+        with self._lock:
+            commit = not (result.errors or self._cancelled.is_set())
+            self._committing = commit
+        if not commit:
+            result.cancelled = self._cancelled.is_set()
+            self._batch.abort()
+        else:
+            try:
+                self._batch.commit()
+                result.changed = staged
+                result.warnings = self._batch.warnings
+            except OSError, e:
+                result.errors.append((e.filename, e.strerror or str(e)))
+            for filename in staged:
+                get_access_cache().invalidate(filename)
+        logger.debug("Bulk edit (%s): %d changed, %d unchanged, %d errors" %
+                     (self._change, len(result.changed), len(result.unchanged),
+                      len(result.errors)))
+        GLib.idle_add(self._finish)
+
+    def _schedule_progress(self):
+        """
+        Schedule an idle callback reporting the progress. Must hold the lock.
+        """
+        if not self._progress_pending and self._progress_callback:
+            self._progress_pending = True
+            GLib.idle_add(self._report_progress)
+
+    def _report_progress(self):
+        with self._lock:
+            self._progress_pending = False
+            done = self._done
+        if not self._cancelled.is_set():
+            self._progress_callback(done, len(self._filenames))
+        return False
+
+    def _finish(self):
+        self._finished = True
+        if not self._cancelled.is_set() and self._finished_callback:
+            self._finished_callback(self.result)
+        return False
+
+
+class BulkEditor(object):
+    """
+    Applies a KeyChange to many desktop files on a pool of threads. Starting
+    a new run cancels the one in progress.
+    """
+    def __init__(self, threads=DEFAULT_THREADS):
+        self.threads = threads
+        self._job = None
+
+    def cancel(self, wait=False):
+        """
+        Cancel the job in progress. With wait set, a job which is already
+        committing its files is waited for, see BulkEditJob.cancel().
+        """
+        if self._job:
+            self._job.cancel(wait)
+            self._job = None
+
+    def is_running(self):
+        return self._job is not None and self._job.is_running()
+
+    def apply(self, filenames, change, finished_callback,
+              progress_callback=None):
+        """
+        Apply change to every file in filenames. The callbacks are invoked
+        from the main loop: progress_callback(done, total) while the files are
+        prepared and finished_callback(result) with a BulkEditResult.
+        """
+        self.cancel()
+        self._job = BulkEditJob(filenames, change, progress_callback,
+                                finished_callback, self.threads)
+        self._job.start()
+        return self._job
@@ -0,0 +1,196 @@
+"""
+Persistent on-disk index of the desktop entries found by the scanner.
+
+The catalog stores the handful of fields the launcher list needs for each
+desktop file, keyed by path and validated against the file's (mtime, size,
+inode). On a warm start only files which changed since the last scan have to be
+parsed again. Names are stored localized, and the summaries differ slightly
+between the scanner's parsers, so a catalog written for another locale or
+parser is discarded.
+"""
+import os
+import logging
+import marshal
+import threading
+import zlib
+
+import xdg.Locale
+from xdg.BaseDirectory import xdg_cache_home
+
+from dee.entry import EntrySummary
+
+logger = logging.getLogger(__name__)
+
+CATALOG_MAGIC = "DEECAT"
+CATALOG_VERSION = 8
+
+
+def default_catalog_path():
+    """
+    Return the path of the catalog file in the user's XDG cache directory.
+    """
+    return os.path.join(xdg_cache_home, "desktop-entry-editor", "catalog.cache")
+
+
+def catalog_header(parser=None):
+    """
+    Return the header of the catalog file, which includes the locale chain
+    the names were localized for and the name of the parser which read them.
+    """
+    return "%s%s%s\n%s\n" % (CATALOG_MAGIC, chr(CATALOG_VERSION),
+                             ":".join(xdg.Locale.langs), parser or "")
+
+
+def stat_key(st):
+    """
+    Return the tuple used to decide if a cached record is still valid. The
+    mode and owner are included as the record stores whether the file is
+    read-only.
+    """
+    return (st.st_mtime, st.st_size, st.st_ino, st.st_mode, st.st_uid,
+            st.st_gid)
+
+
+class Catalog(object):
+    """
+    A cache of parsed desktop entries. Records are tuples of
+    (key, values, error) where key is the stat_key() of the file when it was
+    parsed, values is EntrySummary.to_tuple() and error is the parse error
+    message, or None if the file parsed cleanly. parser names the parser the
+    records come from.
+
+    All methods are safe to call from the scanner's worker threads.
+    """
+    def __init__(self, filename=None, parser=None):
+        if filename is None:
+            filename = default_catalog_path()
+        self.filename = filename
+        self.parser = parser
+        self._records = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._dirty = False
+
+    def __len__(self):
+        return len(self._records)
+
+    def set_parser(self, parser):
+        """
+        Set the parser the records come from, dropping the records of another
+        parser.
+        """
+        with self._lock:
+            if parser == self.parser:
+                return
+            self.parser = parser
+            if self._records:
+                logger.debug("Discarding the catalog records of another "
+                             "parser")
+                self._records = {}
+                self._dirty = True
+
+    def load(self):
+        """
+        Load the catalog from disk. A missing, corrupt or outdated file results
+        in an empty catalog, never an exception.
+        """
+        records = {}
+        try:
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+            header = catalog_header(self.parser)
+            if data.startswith(header):
+                records = marshal.loads(zlib.decompress(data[len(header):]))
+            elif data.startswith(CATALOG_MAGIC + chr(CATALOG_VERSION)):
+                logger.debug("Discarding catalog %s written for another "
+                             "locale or parser" % self.filename)
+            else:
+                raise ValueError("unknown header")
+            if not isinstance(records, dict):
+                raise ValueError("unexpected type %s" % type(records))
+            # round trip through EntrySummary to share repeated strings
+            for filename, (key, values, error) in records.iteritems():
+                if values is not None:
+                    values = EntrySummary.from_tuple(filename, values).to_tuple()
+                    records[filename] = (key, values, error)
+        except IOError:
+            pass # no catalog yet
+        except (ValueError, EOFError, TypeError, zlib.error), e:
+            logger.warn("Discarding corrupt catalog %s: %s" % (self.filename, e))
+            records = {}
+        with self._lock:
+            self._records = records
+            self._loaded = True
+            self._dirty = False
+        logger.debug("Loaded %d catalog records from %s" % (len(records),
+                                                            self.filename))
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def save(self):
+        """
+        Write the catalog to disk if it changed since it was loaded. The file
+        is replaced atomically so a crash never leaves a truncated catalog.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            data = marshal.dumps(self._records)
+            header = catalog_header(self.parser)
+            self._dirty = False
+        path = os.path.dirname(self.filename)
+        tmp_filename = self.filename + ".tmp"
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            with open(tmp_filename, 'wb') as f:
+                f.write(header)
+                f.write(zlib.compress(data))
+            os.rename(tmp_filename, self.filename)
+        except (IOError, OSError), e:
+            logger.warn("Could not save catalog %s: %s" % (self.filename, e))
+
+    def lookup(self, filename, st):
+        """
+        Return (summary, error) for filename if its record is still valid for
+        the stat result st, otherwise None. summary is an EntrySummary or None
+        if the file failed to parse with the message error.
+        """
+        record = self._records.get(filename)
+        if record is None or record[0] != stat_key(st):
+            return None
+        key, values, error = record
+        if values is None:
+            return (None, error)
+        return (EntrySummary.from_tuple(filename, values), None)
+
+    def store(self, filename, st, summary, error=None):
+        """
+        Store the EntrySummary for filename as parsed with the stat result st,
+        or the parse error message if summary is None.
+        """
+        values = summary.to_tuple() if summary is not None else None
+        record = (stat_key(st), values, error)
+        with self._lock:
+            self._records[filename] = record
+            self._dirty = True
+
+    def remove(self, filename):
+        with self._lock:
+            if self._records.pop(filename, None) is not None:
+                self._dirty = True
+
+    def prune(self, filenames):
+        """
+        Drop the records for every file not in filenames and return the list
+        of dropped filenames.
+        """
+        with self._lock:
+            stale = [f for f in self._records if f not in filenames]
+            for filename in stale:
+                del self._records[filename]
+            if stale:
+                self._dirty = True
+        return stale
@@ -1,17 +1,60 @@
 import os
+import re
+import stat
+import xdg.Locale
 from xdg.DesktopEntry import DesktopEntry
+from xdg.Exceptions import ParsingError
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import GdkPixbuf, Gtk
 
-def get_icon_pixbuf(icon, size):
-    if os.path.isfile(icon):
-        try:
-            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(icon, size, size)
-            # work around failing to scale xpm's (gdk bug #686910)
-            return pixbuf.scale_simple(size, size, GdkPixbuf.InterpType.NEAREST)
-        except:
-            pass
+from dee.atomicwrite import NEW_FILE_MODE, atomic_write
+from dee.executables import program_name
+from dee.fileaccess import get_access_cache
+from dee.iconcache import PixbufCache
+from dee.icondiskcache import render_icon_file
+from dee.icontheme import get_icon_resolver
+
+_pixbuf_cache = None
+
+def get_pixbuf_cache():
+    """
+    Return the PixbufCache shared by everything rendering icons, creating it
+    the first time. The cache is cleared when the icon theme changes.
+    """
+    global _pixbuf_cache
+    if _pixbuf_cache is None:
+        _pixbuf_cache = PixbufCache()
+        icon_theme = Gtk.IconTheme.get_default()
+        if icon_theme:
+            icon_theme.connect("changed", _on_icon_theme_changed)
+    return _pixbuf_cache
+
+def _on_icon_theme_changed(icon_theme):
+    _pixbuf_cache.clear()
+    get_icon_resolver(get_icon_theme_name()).invalidate()
+
+def get_icon_theme_name():
+    """
+    Return the name of the current icon theme. Only call this from the main
+    thread.
+    """
+    settings = Gtk.Settings.get_default()
+    if settings:
+        return settings.get_property("gtk-icon-theme-name")
+    return None
+
+def _load_icon_pixbuf(icon, size, is_file):
+    theme = get_icon_theme_name()
+    if is_file:
+        filename = icon
+    else:
+        # most icons are found without asking the GTK+ icon theme
+        filename = get_icon_resolver(theme).lookup(icon, size)
+    if filename:
+        pixbuf = render_icon_file(filename, size, theme)
+        if pixbuf is not None:
+            return pixbuf
     icon_theme = Gtk.IconTheme.get_default()
     if icon_theme.has_icon(icon):
         try:
@@ -26,6 +69,258 @@ def get_icon_pixbuf(icon, size):
                                       Gtk.IconLookupFlags.USE_BUILTIN)
     return default
 
+def get_icon_cache_key(icon, size):
+    """
+    Return the key of icon rendered at size in the shared pixbuf cache.
+    """
+    return (icon, size, get_icon_theme_name())
+
+def get_icon_pixbuf(icon, size):
+    """
+    Return a GdkPixbuf for icon, which is either a file path or an icon name
+    in the current theme, rendered at size. Pixbufs are served from the shared
+    cache unless the icon's file changed since it was cached.
+    """
+    mtime = None
+    try:
+        st = os.stat(icon)
+        if stat.S_ISREG(st.st_mode):
+            mtime = st.st_mtime
+    except (OSError, TypeError, ValueError):
+        pass
+
+    cache = get_pixbuf_cache()
+    key = get_icon_cache_key(icon, size)
+    pixbuf = cache.get(key, mtime)
+    if pixbuf is None:
+        pixbuf = _load_icon_pixbuf(icon, size, mtime is not None)
+        cache.put(key, pixbuf, mtime)
+    return pixbuf
+
+_interned = {}
+
+def intern_string(value):
+    """
+    Return a shared copy of value. Unlike the intern() builtin this also works
+    for unicode strings, which is what pyxdg returns.
+    """
+    return _interned.setdefault(value, value)
+
+# keys searched by the launcher list, untranslated and for the current locale
+SEARCH_KEYS = ("Name", "GenericName", "Comment", "Keywords", "Exec")
+
+def _join_search_text(values):
+    """
+    Return the distinct, non-empty values as one string, a line each.
+    """
+    lines = []
+    for value in values:
+        value = value.strip()
+        if value and value not in lines:
+            lines.append(value)
+    return u"\n".join(lines)
+
+class EntrySummary(object):
+    """
+    The few fields of a desktop entry which the launcher list needs. Listing
+    thousands of launchers keeps one of these per file instead of a complete
+    Entry, and strings which repeat across entries are interned. search_text
+    holds the values of the SEARCH_KEYS for the search index, program is
+    the executable the launcher needs (see program_name()) and mime_types the
+    MIME types it handles. broken is not stored, the scanner sets it if
+    program is not installed.
+    """
+    __slots__ = ('filename', 'name', 'generic_name', 'icon', 'type',
+                 'categories', 'no_display', 'hidden', 'read_only',
+                 'search_text', 'program', 'mime_types', 'broken')
+
+    def __init__(self, filename, name=u"", generic_name=u"", icon=u"",
+                 entry_type=u"", categories=(), no_display=False, hidden=False,
+                 read_only=False, search_text=u"", program=u"", mime_types=()):
+        self.filename = filename
+        self.name = name
+        self.generic_name = generic_name
+        self.icon = intern_string(icon)
+        self.type = intern_string(entry_type)
+        self.categories = tuple([intern_string(c) for c in categories])
+        self.no_display = no_display
+        self.hidden = hidden
+        self.read_only = read_only
+        self.search_text = search_text
+        self.program = intern_string(program)
+        self.mime_types = tuple([intern_string(m) for m in mime_types])
+        self.broken = False
+
+    @classmethod
+    def from_entry(cls, entry):
+        """
+        Return the summary of a parsed Entry.
+        """
+        group = entry.content.get(entry.defaultGroup, {})
+        values = []
+        for key in SEARCH_KEYS:
+            values.append(group.get(key, u""))
+            for lang in xdg.Locale.langs:
+                values.append(group.get("%s[%s]" % (key, lang), u""))
+        return cls(entry.filename, entry.getName(), entry.getGenericName(),
+                   entry.getIcon(), entry.getType(), entry.getCategories(),
+                   entry.getNoDisplay(), entry.getHidden(), entry.isReadOnly(),
+                   _join_search_text(values),
+                   program_name(entry.getTryExec(), entry.getExec()),
+                   _get_mime_types(group.get("MimeType", u"")))
+
+    @classmethod
+    def from_tuple(cls, filename, values):
+        """
+        Return a summary from the values returned by to_tuple().
+        """
+        return cls(filename, *values)
+
+    def to_tuple(self):
+        """
+        Return every field but the filename as a tuple of builtin types, which
+        is how the summary is stored in the catalog.
+        """
+        return (self.name, self.generic_name, self.icon, self.type,
+                self.categories, self.no_display, self.hidden, self.read_only,
+                self.search_text, self.program, self.mime_types)
+
+# headers accepted for the main group, in the order pyxdg selects them
+MAIN_GROUPS = ("Desktop Entry", "KDE Desktop Entry")
+# patterns match from the newline before a line, which is much faster than
+# multiline mode
+_GROUP_RE = re.compile(r"\n[ \t\r\f\v]*\[")
+_PREFERRED_GROUP_RE = re.compile(r"\n[ \t\r\f\v]*\[%s\][ \t\r\f\v]*(?=\n|$)"
+                                 % re.escape(MAIN_GROUPS[0]))
+_summary_res = {}
+
+def _get_summary_re(langs):
+    """
+    Return a pattern matching the lines of the keys an EntrySummary needs,
+    including the localized variants for langs but no other locale.
+    """
+    langs = tuple(langs)
+    pattern = _summary_res.get(langs)
+    if pattern is None:
+        if langs:
+            locale = r"(\[(?:%s)\])?" % "|".join([re.escape(l) for l in langs])
+        else:
+            locale = r"()"
+        pattern = re.compile(r"\n[ \t\r\f\v]*(?:(Type|Categories|NoDisplay|"
+                             r"Hidden|Exec|TryExec|MimeType)|(Name|GenericName|"
+                             r"Icon|Comment|Keywords)%s)[ \t\r\f\v]*=([^\n]*)" %
+                             locale)
+        _summary_res[langs] = pattern
+    return pattern
+
+def _first_content_line(text):
+    """
+    Return the first line in text which is neither blank nor a comment.
+    """
+    for line in text.split("\n"):
+        line = line.strip()
+        if line and line[0] != "#":
+            return line
+    return None
+
+def _get_list(value):
+    # same splitting rules as xdg.IniFile.getList()
+    if re.search(r"(?<!\\);", value):
+        values = re.split(r"(?<!\\);", value)
+    elif re.search(r"(?<!\\)\|", value):
+        values = re.split(r"(?<!\\)\|", value)
+    elif re.search(r"(?<!\\),", value):
+        values = re.split(r"(?<!\\),", value)
+    else:
+        values = [value]
+    if values[-1] == "":
+        values.pop()
+    return values
+
+def _get_mime_types(value):
+    return [m.strip() for m in _get_list(value) if m.strip()]
+
+def read_entry_summary(filename):
+    """
+    Read the EntrySummary of a desktop file from its main group only. Nothing
+    after the main group is looked at, only the keys the summary needs are
+    extracted and only the localized variants for the current locale are
+    kept. Raises ParsingError with the same messages as the full parser for
+    errors in the main group.
+    """
+    if not os.path.isfile(filename):
+        raise ParsingError("File not found", filename)
+    with open(filename, 'rb') as fd:
+        data = "\n" + fd.read()
+
+    header = _GROUP_RE.search(data)
+    if header is None or _first_content_line(data[:header.start()]):
+        # keys outside of a group or no group at all, let the full parser
+        # raise the appropriate error
+        return EntrySummary.from_entry(Entry(filename))
+    start = data.find("\n", header.end())
+    if start < 0:
+        start = len(data)
+    group = data[header.start():start].strip().lstrip("[").rstrip("]")
+    if group not in MAIN_GROUPS or (group != MAIN_GROUPS[0] and
+                                    _PREFERRED_GROUP_RE.search(data, start)):
+        # unusual layout, e.g. a [KDE Desktop Entry] before the [Desktop
+        # Entry] pyxdg prefers, let the full parser sort it out
+        return EntrySummary.from_entry(Entry(filename))
+    next_header = _GROUP_RE.search(data, start)
+    end = next_header.start() if next_header else len(data)
+    block = data[start:end]
+
+    invalid = _first_content_line("\n".join([line for line in block.split("\n")
+                                             if "=" not in line]))
+    if invalid:
+        raise ParsingError("Invalid line: " +
+                           invalid.decode('utf-8', 'replace'), filename)
+
+    langs = xdg.Locale.langs
+    values = {}
+    localized = {}
+    for key, localized_key, lang, value in _get_summary_re(langs).findall(block):
+        if key:
+            values[key] = value
+        elif lang:
+            localized.setdefault(localized_key, {})[lang[1:-1]] = value
+        else:
+            values[localized_key] = value
+
+    def get(key):
+        return values.get(key, "").strip().decode('utf-8', 'replace')
+
+    def get_locale(key):
+        if key not in values:
+            return u""
+        variants = localized.get(key)
+        if variants:
+            for lang in langs:
+                if lang in variants:
+                    return variants[lang].strip().decode('utf-8', 'replace')
+        return get(key)
+
+    def get_boolean(key):
+        return get(key) in ("true", "True")
+
+    search_values = []
+    for key in SEARCH_KEYS:
+        search_values.append(get(key))
+        variants = localized.get(key, {})
+        for lang in langs:
+            if lang in variants:
+                search_values.append(variants[lang].decode('utf-8', 'replace'))
+
+    read_only = get_access_cache().is_read_only(filename)
+    return EntrySummary(filename, get_locale("Name"),
+                        get_locale("GenericName"), get_locale("Icon"),
+                        get("Type"), _get_list(get("Categories")),
+                        get_boolean("NoDisplay"), get_boolean("Hidden"),
+                        read_only, _join_search_text(search_values),
+                        program_name(get("TryExec"), get("Exec")),
+                        _get_mime_types(get("MimeType")))
+
 class Entry(DesktopEntry):
 
     def __init__(self, filename=None):
@@ -37,12 +332,74 @@ class Entry(DesktopEntry):
 
     def isReadOnly(self):
         """
-        Return True if the entry's file is read-only for this user.
+        Return True if the entry's file is read-only for this user. The answer
+        is shared with the scanner and cached until the file changes.
         """
-        if self.filename and not os.access(self.filename, os.W_OK):
-            return True
+        if self.filename:
+            return get_access_cache().is_read_only(self.filename)
         return False
 
+    def toString(self, trusted=False):
+        """
+        Return the contents write() would save for the current, possibly
+        unsaved, state of the entry as a UTF-8 encoded string, without touching
+        the filesystem.
+        """
+        lines = []
+        if trusted:
+            lines.append(u"#!/usr/bin/env xdg-open\n")
+        if self.defaultGroup:
+            lines.append(u"[%s]\n" % self.defaultGroup)
+            for (key, value) in self.content[self.defaultGroup].items():
+                lines.append(u"%s=%s\n" % (key, value))
+            lines.append(u"\n")
+        for (name, group) in self.content.items():
+            if name != self.defaultGroup:
+                lines.append(u"[%s]\n" % name)
+                for (key, value) in group.items():
+                    lines.append(u"%s=%s\n" % (key, value))
+                lines.append(u"\n")
+        return u"".join(lines).encode('utf-8')
+
+    def write(self, filename=None, trusted=False):
+        """
+        Save the entry to filename, or the file it was loaded from. Unlike
+        IniFile.write() the file is replaced atomically, so a crash or a full
+        disk never leaves a truncated desktop file. Returns a list of warning
+        messages, e.g. if the file could not keep its owner. Raises IOError or
+        OSError.
+        """
+        if not filename and not self.filename:
+            raise ParsingError("File not found", "")
+        if filename:
+            self.filename = filename
+        else:
+            filename = self.filename
+        mode = None
+        if trusted:
+            # the executable bits mark the file as trusted
+            try:
+                mode = os.stat(filename).st_mode & 07777
+            except OSError:
+                mode = NEW_FILE_MODE
+            mode |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+        warnings = atomic_write(filename, self.toString(trusted), mode)
+        self.tainted = False
+        return warnings
+
+    def copy(self):
+        """
+        Return a snapshot of the entry which can be used from another thread
+        while this one is being edited.
+        """
+        entry = Entry()
+        entry.filename = self.filename
+        entry.defaultGroup = self.defaultGroup
+        entry.content = dict((name, dict(group))
+                             for (name, group) in self.content.items())
+        entry.is_modified = self.is_modified
+        return entry
+
     def getIconPixbuf(self, size):
         """
         Render the icon to a GdkPixbuf for the icon at the specified sized.
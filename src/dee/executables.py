@@ -0,0 +1,182 @@
+"""
+Index of the executables on $PATH, used to find launchers whose program is
+not installed.
+
+Each directory is listed once and its listing is kept until the directory's
+mtime changes, so checking thousands of launchers costs about one listing per
+$PATH element instead of a stat() per launcher and directory.
+"""
+import os
+import re
+import logging
+import threading
+
+from dee.launcher import split_exec
+
+logger = logging.getLogger(__name__)
+
+_executable_index = None
+
+
+def get_executable_index():
+    """
+    Return the ExecutableIndex shared by the scanner and the editor, creating
+    it the first time.
+    """
+    global _executable_index
+    if _executable_index is None:
+        _executable_index = ExecutableIndex()
+    return _executable_index
+
+
+# options of env(1) without an argument, and those taking the next argument
+_ENV_FLAGS = frozenset("0iv")
+_ENV_LONG_FLAGS = frozenset(["--ignore-environment", "--null", "--debug",
+                             "--list-signal-handling"])
+_ENV_ARG_OPTIONS = frozenset("uCP")
+_ENV_LONG_ARG_OPTIONS = frozenset(["--unset", "--chdir"])
+# long options whose argument is optional and must follow "="
+_ENV_LONG_OPTIONAL_ARG_OPTIONS = frozenset(["--default-signal",
+                                            "--ignore-signal",
+                                            "--block-signal"])
+# quotes, escapes and variables in a split string of env -S
+_ENV_QUOTING_RE = re.compile(r"[\\'\"$#]")
+
+
+def _env_command(argv):
+    """
+    Return the arguments of the command run by "env argv", or None if they
+    cannot be told apart from the options of env.
+    """
+    argv = list(argv)
+    while argv:
+        arg = argv.pop(0)
+        if arg == "--":
+            while argv and "=" in argv[0]:
+                argv.pop(0)
+            break
+        elif arg.startswith("--"):
+            name, equals, value = arg.partition("=")
+            if name == "--split-string":
+                if not equals:
+                    if not argv:
+                        return None
+                    value = argv.pop(0)
+                if _ENV_QUOTING_RE.search(value):
+                    return None
+                argv[:0] = value.split()
+            elif name in _ENV_LONG_ARG_OPTIONS and not equals:
+                if not argv:
+                    return None
+                argv.pop(0)
+            elif not (name in _ENV_LONG_FLAGS and not equals or
+                      name in _ENV_LONG_ARG_OPTIONS or
+                      name in _ENV_LONG_OPTIONAL_ARG_OPTIONS):
+                return None
+        elif arg.startswith("-") and arg != "-":
+            # grouped short options, the last may take an argument
+            for i, flag in enumerate(arg[1:], 2):
+                if flag in _ENV_FLAGS:
+                    continue
+                if flag not in _ENV_ARG_OPTIONS and flag != "S":
+                    return None
+                value = arg[i:]
+                if not value:
+                    if not argv:
+                        return None
+                    value = argv.pop(0)
+                if flag == "S":
+                    if _ENV_QUOTING_RE.search(value):
+                        return None
+                    argv[:0] = value.split()
+                break
+        elif "=" in arg:
+            pass # an environment variable
+        else:
+            argv.insert(0, arg)
+            break
+    return argv
+
+
+def program_name(try_exec, command):
+    """
+    Return the program a launcher needs: TryExec if set, otherwise the first
+    argument of the Exec key command, skipping an "env" prefix with its
+    options and variables. Returns an empty string if there is none or if an
+    option of env is not known, as the program cannot be told apart from its
+    argument.
+    """
+    if try_exec:
+        return try_exec
+    try:
+        argv = split_exec(command or "")
+    except ValueError:
+        return ""
+    if argv and os.path.basename(argv[0]) == "env":
+        argv = _env_command(argv[1:])
+    return argv[0] if argv else ""
+
+
+class ExecutableIndex(object):
+    """
+    The names of the files in each $PATH directory, and in the directories of
+    programs given as absolute paths. Listings are only checked against the
+    directories' mtime when refresh() is called, so call it once before
+    checking a batch of launchers. Safe to use from the scanner's threads.
+    """
+    def __init__(self, path=None):
+        self._path = path
+        self._dirs = {} # directory -> (mtime, frozenset of names)
+        self._lock = threading.Lock()
+
+    def _search_path(self):
+        path = self._path
+        if path is None:
+            path = os.environ.get("PATH", os.defpath)
+        return [p for p in path.split(os.pathsep) if p]
+
+    def _list(self, path, force=False):
+        """
+        Return the names in directory path, listing it if it is not known yet
+        or force is set and its mtime changed.
+        """
+        listing = self._dirs.get(path)
+        if listing is not None and not force:
+            return listing[1]
+        try:
+            mtime = os.stat(path).st_mtime
+            if listing is not None and listing[0] == mtime:
+                return listing[1]
+            names = frozenset(os.listdir(path))
+        except OSError:
+            mtime, names = None, frozenset()
+        with self._lock:
+            self._dirs[path] = (mtime, names)
+        return names
+
+    def refresh(self):
+        """
+        List again every known directory whose mtime changed, and the $PATH
+        directories which are not known yet.
+        """
+        for path in set(self._search_path()) | set(self._dirs):
+            self._list(path, True)
+
+    def find(self, program):
+        """
+        Return the path of program, or None if it is not installed.
+        """
+        if not program:
+            return None
+        if os.path.isabs(program):
+            path, name = os.path.split(program)
+            return program if name in self._list(path) else None
+        if os.sep in program:
+            return program if os.path.exists(program) else None
+        for path in self._search_path():
+            if program in self._list(path):
+                return os.path.join(path, program)
+        return None
+
+    def is_installed(self, program):
+        return self.find(program) is not None
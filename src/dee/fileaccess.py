@@ -0,0 +1,84 @@
+"""
+Cached write access checks for desktop files.
+
+Whether a desktop file is read-only is needed for every row of the launcher
+list and on every update of the editor, which is a lot of access() calls on a
+networked home directory. The answer is worked out once per file, or once per
+directory for directories on a read-only file system, and kept until the file
+or its directory is reported as changed.
+"""
+import os
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_access_cache = None
+
+
+def get_access_cache():
+    """
+    Return the AccessCache shared by the scanner and the editor, creating it
+    the first time.
+    """
+    global _access_cache
+    if _access_cache is None:
+        _access_cache = AccessCache()
+    return _access_cache
+
+
+def _is_read_only_mount(path):
+    """
+    Return True if path is on a file system mounted read-only.
+    """
+    try:
+        return bool(os.statvfs(path).f_flag & os.ST_RDONLY)
+    except (OSError, AttributeError):
+        return False
+
+
+class AccessCache(object):
+    """
+    Remembers whether files are read-only for this user. Safe to use from the
+    scanner's worker threads.
+    """
+    def __init__(self):
+        self._files = {}
+        self._dirs = {}
+        self._lock = threading.Lock()
+
+    def is_read_only(self, filename):
+        """
+        Return True if filename cannot be written by this user.
+        """
+        read_only = self._files.get(filename)
+        if read_only is not None:
+            return read_only
+        path = os.path.dirname(filename)
+        dir_read_only = self._dirs.get(path)
+        if dir_read_only is None:
+            dir_read_only = _is_read_only_mount(path)
+        # a read-only mount answers for every file in it
+        read_only = dir_read_only or not os.access(filename, os.W_OK)
+        with self._lock:
+            self._dirs[path] = dir_read_only
+            self._files[filename] = read_only
+        return read_only
+
+    def invalidate(self, path):
+        """
+        Forget what is known about path, which is either a file or a
+        directory. Forgetting a directory forgets the files in it too.
+        """
+        with self._lock:
+            self._files.pop(path, None)
+            if self._dirs.pop(path, None) is not None:
+                prefix = os.path.join(path, "")
+                for filename in [f for f in self._files if f.startswith(prefix)]:
+                    del self._files[filename]
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+            self._dirs.clear()
+        logger.debug("Access cache cleared")
@@ -0,0 +1,140 @@
+"""
+Memory bounded LRU cache for rendered icon pixbufs.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+
+
+def pixbuf_size(pixbuf):
+    """
+    Return the approximate number of bytes used by the pixbuf's pixel data.
+    """
+    return pixbuf.get_rowstride() * pixbuf.get_height()
+
+
+class PixbufCache(object):
+    """
+    An LRU cache of GdkPixbuf objects bounded by the total size of their pixel
+    data. Keys are (icon, size, theme) tuples where icon is an icon name or
+    file path. Each item can carry the mtime of the file it was loaded from so
+    that a stale pixbuf is never returned after the file changes.
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, mtime=None):
+        """
+        Return the cached pixbuf for key, or None if it is not cached or was
+        cached for a different mtime.
+        """
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return None
+            pixbuf, cached_mtime, size = item
+            if cached_mtime != mtime:
+                self._bytes -= size
+                self.misses += 1
+                return None
+            self._items[key] = item
+            self.hits += 1
+            return pixbuf
+
+    def peek(self, key):
+        """
+        Return the cached pixbuf for key regardless of the mtime it was cached
+        for, or None. Used where a stat() per lookup would be too expensive,
+        such as drawing tree view rows.
+        """
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items[key] = item
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, pixbuf, mtime=None):
+        """
+        Add pixbuf to the cache, evicting the least recently used pixbufs if
+        the memory budget is exceeded. Returns False if the pixbuf alone is
+        larger than the budget and was not cached.
+        """
+        size = pixbuf_size(pixbuf)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            if size > self._max_bytes:
+                logger.debug("Not caching %s, %d bytes exceed the budget" %
+                             (key, size))
+                return False
+            self._items[key] = (pixbuf, mtime, size)
+            self._bytes += size
+            self._evict()
+        return True
+
+    def _evict(self):
+        """
+        Drop the oldest items until the cache fits its budget. Must hold the
+        lock.
+        """
+        while self._bytes > self._max_bytes and self._items:
+            key, (pixbuf, mtime, size) = self._items.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+    def set_max_bytes(self, max_bytes):
+        """
+        Change the memory budget, evicting items if necessary.
+        """
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    def invalidate(self, icon):
+        """
+        Drop every cached size of icon.
+        """
+        with self._lock:
+            for key in [key for key in self._items if key[0] == icon]:
+                self._bytes -= self._items.pop(key)[2]
+
+    def clear(self):
+        """
+        Drop every cached pixbuf, for example when the icon theme changes.
+        """
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+        logger.debug("Pixbuf cache cleared")
+
+    def stats(self):
+        """
+        Return a dict of counters for debugging.
+        """
+        with self._lock:
+            return {
+                'items': len(self._items),
+                'bytes': self._bytes,
+                'max_bytes': self._max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,312 @@
+"""
+Persistent cache of rendered icons for fast cold starts.
+
+Decoding hundreds of PNG and SVG files to get the small launcher list icons
+dominates a cold start. Rendered icons are therefore also kept on disk as raw
+pixel data in a single file, together with an index keyed by (icon file, its
+mtime, size, scale, theme). The file is memory-mapped at start-up and a
+cached icon is turned back into a pixbuf without decoding anything. The file
+is bounded in size, dropping the icons which were not used for the longest
+time whenever it is written.
+"""
+import os
+import time
+import logging
+import marshal
+import mmap
+import struct
+import threading
+
+from gi.repository import GdkPixbuf, GLib
+from xdg.BaseDirectory import xdg_cache_home
+
+logger = logging.getLogger(__name__)
+
+ICON_CACHE_MAGIC = "DEEICO"
+ICON_CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+# seconds between storing a new icon and writing the cache file
+SAVE_DELAY = 10
+
+_HEADER = ICON_CACHE_MAGIC + chr(ICON_CACHE_VERSION)
+# the index offset and length are at the end of the file
+_TRAILER = struct.Struct(">II")
+
+_icon_disk_cache = None
+
+
+def get_icon_disk_cache():
+    """
+    Return the IconDiskCache shared by everything rendering icons, creating
+    and loading it the first time.
+    """
+    global _icon_disk_cache
+    if _icon_disk_cache is None:
+        _icon_disk_cache = IconDiskCache()
+        _icon_disk_cache.load()
+    return _icon_disk_cache
+
+
+def default_icon_disk_cache_path():
+    """
+    Return the path of the icon cache file in the user's XDG cache directory.
+    """
+    return os.path.join(xdg_cache_home, "desktop-entry-editor", "icons.cache")
+
+
+def decode_icon_file(filename, size):
+    """
+    Decode an icon file to a size x size pixbuf. This is safe to call from any
+    thread. Returns None if the file cannot be decoded.
+    """
+    try:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(filename, size, size)
+        # force scale, even for wrong-sized images (gdk bug #686852)
+        return pixbuf.scale_simple(size, size, GdkPixbuf.InterpType.NEAREST)
+    except GLib.GError:
+        return None
+
+
+def render_icon_file(filename, size, theme=None, scale=1):
+    """
+    Return the icon file rendered at size from the shared disk cache, decoding
+    and caching it if needed, or None if it cannot be decoded. This is safe to
+    call from any thread.
+    """
+    try:
+        mtime = os.stat(filename).st_mtime
+    except OSError:
+        return None
+    cache = get_icon_disk_cache()
+    key = (filename, mtime, size, scale, theme)
+    pixbuf = cache.get(key)
+    if pixbuf is None:
+        pixbuf = decode_icon_file(filename, size)
+        if pixbuf is not None:
+            cache.put(key, pixbuf)
+    return pixbuf
+
+
+class IconDiskCache(object):
+    """
+    Rendered icons stored on disk. The file consists of a header, the pixel
+    data of every icon and a marshalled index mapping each key to a record of
+    (offset, length, width, height, rowstride, has_alpha, last_used).
+
+    Icons rendered since the file was loaded are kept in memory and written
+    out together with the icons still in the mapped file by save(), which
+    runs in a background thread a few seconds after icons were added. All
+    methods are safe to call from worker threads.
+    """
+    def __init__(self, filename=None, max_bytes=DEFAULT_MAX_BYTES):
+        if filename is None:
+            filename = default_icon_disk_cache_path()
+        self.filename = filename
+        self._max_bytes = max_bytes
+        self._map = None
+        self._index = {}
+        self._new = {}      # key -> (record, pixels) not written yet
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._save_id = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._index) + len(self._new)
+
+    def load(self):
+        """
+        Map the cache file. A missing, corrupt or outdated file results in an
+        empty cache, never an exception.
+        """
+        index = {}
+        data = None
+        try:
+            with open(self.filename, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if data[:len(_HEADER)] != _HEADER:
+                raise ValueError("unknown header")
+            offset, length = _TRAILER.unpack_from(data, len(data) -
+                                                  _TRAILER.size)
+            index = marshal.loads(data[offset:offset + length])
+            if not isinstance(index, dict):
+                raise ValueError("unexpected type %s" % type(index))
+            for record in index.itervalues():
+                if record[0] + record[1] > offset:
+                    raise ValueError("icon outside the pixel data")
+        except (IOError, OSError):
+            pass # no cache yet
+        except (ValueError, EOFError, TypeError, IndexError, struct.error), e:
+            logger.warn("Discarding corrupt icon cache %s: %s" %
+                        (self.filename, e))
+            index = {}
+        if not index and data is not None:
+            data.close()
+            data = None
+        with self._lock:
+            self._map = data
+            self._index = index
+        logger.debug("Loaded %d rendered icons from %s" % (len(index),
+                                                           self.filename))
+
+    def get(self, key):
+        """
+        Return a new pixbuf for key, or None if it is not cached.
+        """
+        with self._lock:
+            item = self._new.get(key)
+            if item is not None:
+                record, pixels = item
+            else:
+                record = self._index.get(key)
+                if record is None:
+                    self.misses += 1
+                    return None
+                offset, length = record[:2]
+                pixels = self._map[offset:offset + length]
+                # remembered when the file is next written for other reasons
+                self._index[key] = record[:6] + (int(time.time()),)
+            self.hits += 1
+        offset, length, width, height, rowstride, has_alpha = record[:6]
+        return GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(pixels),
+                                               GdkPixbuf.Colorspace.RGB,
+                                               has_alpha, 8, width, height,
+                                               rowstride)
+
+    def put(self, key, pixbuf):
+        """
+        Add the pixbuf rendered for key to the cache.
+        """
+        if (pixbuf.get_colorspace() != GdkPixbuf.Colorspace.RGB or
+            pixbuf.get_bits_per_sample() != 8):
+            return
+        pixels = pixbuf.get_pixels()
+        record = (0, len(pixels), pixbuf.get_width(), pixbuf.get_height(),
+                  pixbuf.get_rowstride(), pixbuf.get_has_alpha(),
+                  int(time.time()))
+        if record[1] > self._max_bytes:
+            return
+        with self._lock:
+            self._new[key] = (record, pixels)
+            self._dirty = True
+        self._queue_save()
+
+    def _queue_save(self):
+        with self._lock:
+            if self._save_id is not None:
+                return
+            self._save_id = GLib.timeout_add_seconds(SAVE_DELAY,
+                                                     self._on_save_timeout)
+
+    def _on_save_timeout(self):
+        with self._lock:
+            self._save_id = None
+        thread = threading.Thread(target=self.save)
+        thread.daemon = True
+        thread.start()
+        return False
+
+    def set_max_bytes(self, max_bytes):
+        """
+        Change the size budget, which is applied the next time the file is
+        written.
+        """
+        with self._lock:
+            if max_bytes != self._max_bytes:
+                self._max_bytes = max_bytes
+                self._dirty = True
+
+    def _select(self):
+        """
+        Return [(key, record, pixels)] for the most recently used icons that
+        fit the budget, pixels being a string or the offset in the old map.
+        Must hold the lock.
+        """
+        items = [(key, record, record[0]) for key, record in
+                 self._index.iteritems() if key not in self._new]
+        items.extend((key, record, pixels) for key, (record, pixels) in
+                     self._new.iteritems())
+        items.sort(key=lambda item: item[1][6], reverse=True)
+        total = 0
+        selected = []
+        for item in items:
+            total += item[1][1]
+            if total > self._max_bytes:
+                break
+            selected.append(item)
+        return selected
+
+    def save(self):
+        """
+        Write the cache file if icons were added since it was loaded, dropping
+        the least recently used icons if it would not fit the budget. The file
+        is replaced atomically and then mapped again.
+        """
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                selected = self._select()
+                written = dict((key, item[0]) for key, item in
+                               self._new.iteritems())
+                old_map = self._map
+                self._dirty = False
+            tmp_filename = self.filename + ".tmp"
+            path = os.path.dirname(self.filename)
+            index = {}
+            try:
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                with open(tmp_filename, "wb") as f:
+                    f.write(_HEADER)
+                    offset = len(_HEADER)
+                    for key, record, pixels in selected:
+                        if not isinstance(pixels, str):
+                            pixels = old_map[pixels:pixels + record[1]]
+                        f.write(pixels)
+                        index[key] = (offset,) + record[1:]
+                        offset += record[1]
+                    data = marshal.dumps(index)
+                    f.write(data)
+                    f.write(_TRAILER.pack(offset, len(data)))
+                os.rename(tmp_filename, self.filename)
+                with open(self.filename, "rb") as f:
+                    new_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (IOError, OSError, ValueError), e:
+                logger.warn("Could not save icon cache %s: %s" %
+                            (self.filename, e))
+                return
+            with self._lock:
+                # icons rendered while the file was written stay in memory
+                for key, record in written.iteritems():
+                    item = self._new.get(key)
+                    if item is not None and item[0] is record:
+                        del self._new[key]
+                self._index = index
+                self._map = new_map
+            if old_map is not None:
+                old_map.close()
+            logger.debug("Saved %d rendered icons to %s" % (len(index),
+                                                            self.filename))
+
+    def clear(self):
+        with self._lock:
+            self._index = {}
+            self._new.clear()
+            self._dirty = True
+        logger.debug("Icon disk cache cleared")
+
+    def stats(self):
+        """
+        Return a dict of counters for debugging.
+        """
+        with self._lock:
+            return {
+                'items': len(self._index) + len(self._new),
+                'unsaved': len(self._new),
+                'max_bytes': self._max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
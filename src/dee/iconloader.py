@@ -0,0 +1,147 @@
+"""
+Asynchronous loading of icons for the launcher list.
+
+Icons are only loaded when a row is actually drawn. The icon file is resolved
+from the icon theme caches and rendered, from the disk cache if possible, on a
+worker thread; only icons the resolver cannot find are left to the GTK+ icon
+theme on the main thread. Rendered pixbufs go into the shared PixbufCache so
+that pixbufs for rows scrolled out of view can be evicted.
+
+The loader also remembers which icons it loaded most recently, so that an icon
+the cache could not keep is not requested again every time the list is
+redrawn. The smallest allowed cache budget holds many more icons than that, so
+only icons the cache refused are affected.
+"""
+import os
+import logging
+import threading
+import Queue
+from collections import OrderedDict
+
+from gi.repository import GLib, Gtk
+
+from dee.entry import get_icon_pixbuf, get_icon_cache_key, get_pixbuf_cache
+from dee.icondiskcache import render_icon_file
+from dee.icontheme import get_icon_resolver
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 2
+# number of loaded icons remembered so that they are not loaded again
+MAX_LOADED = 256
+
+
+def _icon_mtime(icon):
+    """
+    Return the mtime of icon if it is the absolute path of a file, or None.
+    Icon names are not looked at, as a stat() for each of them every time a
+    row is drawn would be too expensive.
+    """
+    if icon and os.path.isabs(icon):
+        try:
+            return os.stat(icon).st_mtime
+        except OSError:
+            pass
+    return None
+
+
+class IconLoader(object):
+    """
+    Loads icons at a fixed size in the background. lookup() returns a cached
+    pixbuf or None, in which case request() schedules the icon to be loaded
+    and callback() is called from the main loop once one or more icons are
+    ready.
+    """
+    def __init__(self, size, callback, workers=DEFAULT_WORKERS):
+        self.size = size
+        self._callback = callback
+        self._pending = set()
+        self._loaded = OrderedDict()    # cache key -> mtime of the file
+        self._queue = Queue.Queue()
+        self._done = []
+        self._lock = threading.Lock()
+        self._flush_pending = False
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+        icon_theme = Gtk.IconTheme.get_default()
+        if icon_theme:
+            icon_theme.connect("changed", self._on_icon_theme_changed)
+
+    def lookup(self, icon):
+        """
+        Return the cached pixbuf for icon, or None if it has not been loaded
+        or its file changed since.
+        """
+        key = get_icon_cache_key(icon, self.size)
+        if icon and os.path.isabs(icon):
+            return get_pixbuf_cache().get(key, _icon_mtime(icon))
+        return get_pixbuf_cache().peek(key)
+
+    def request(self, icon):
+        """
+        Load icon in the background unless it is already being loaded or was
+        loaded recently, in which case the cache could not keep it.
+        """
+        if icon in self._pending:
+            return
+        key = get_icon_cache_key(icon, self.size)
+        if key in self._loaded and self._loaded[key] == _icon_mtime(icon):
+            return
+        if not icon:
+            # the missing icon is cheap to render right here
+            get_icon_pixbuf(icon, self.size)
+            self._add_loaded(key, None)
+            return
+        self._pending.add(icon)
+        self._queue.put((icon, key))
+
+    def _add_loaded(self, key, mtime):
+        self._loaded.pop(key, None)
+        self._loaded[key] = mtime
+        while len(self._loaded) > MAX_LOADED:
+            self._loaded.popitem(last=False)
+
+    def _on_icon_theme_changed(self, icon_theme):
+        self._loaded.clear()
+
+    def _work(self):
+        while True:
+            icon, key = self._queue.get()
+            theme = key[2]
+            mtime = None
+            filename = get_icon_resolver(theme).lookup(icon, self.size)
+            if filename == icon:
+                try:
+                    mtime = os.stat(filename).st_mtime
+                except OSError:
+                    pass
+            pixbuf = None
+            if filename:
+                pixbuf = render_icon_file(filename, self.size, theme)
+            with self._lock:
+                self._done.append((icon, key, pixbuf, mtime))
+                if not self._flush_pending:
+                    self._flush_pending = True
+                    GLib.idle_add(self._flush)
+
+    def _flush(self):
+        """
+        Idle callback which moves the decoded pixbufs into the cache.
+        """
+        with self._lock:
+            done = self._done
+            self._done = []
+            self._flush_pending = False
+        cache = get_pixbuf_cache()
+        for icon, key, pixbuf, mtime in done:
+            self._pending.discard(icon)
+            if pixbuf is None:
+                # let get_icon_pixbuf() fall back to the GTK+ icon theme
+                get_icon_pixbuf(icon, self.size)
+            else:
+                cache.put(key, pixbuf, mtime)
+            self._add_loaded(key, mtime)
+        self._callback()
+        return False
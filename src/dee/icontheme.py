@@ -0,0 +1,399 @@
+"""
+Icon file lookup following the Icon Theme Specification, without GTK+.
+
+Most themes ship an icon-theme.cache written by gtk-update-icon-cache, which
+maps every icon name to the theme subdirectories containing it. The caches are
+memory-mapped and searched in place, so finding the file behind an icon costs
+a hash and a few reads instead of a stat() per directory and extension.
+Theme directories without a valid cache are listed once instead. Nothing here
+needs a display, so the scanner and the benchmarks can resolve icons too, and
+lookups are safe from worker threads.
+"""
+import os
+import mmap
+import struct
+import logging
+import threading
+
+from xdg.BaseDirectory import xdg_data_dirs
+from xdg.Exceptions import ParsingError
+from xdg.IconTheme import IconTheme
+
+logger = logging.getLogger(__name__)
+
+CACHE_NAME = "icon-theme.cache"
+CACHE_MAJOR_VERSION = 1
+FALLBACK_THEME = "hicolor"
+
+# flags of an image in the cache
+FLAG_XPM = 1
+FLAG_SVG = 2
+FLAG_PNG = 4
+FLAG_HAS_ICON_FILE = 8
+
+# in order of preference
+EXTENSIONS = ("png", "svg", "xpm")
+_FLAG_EXTENSIONS = ((FLAG_PNG, "png"), (FLAG_SVG, "svg"), (FLAG_XPM, "xpm"))
+
+_NO_OFFSET = 0xffffffff
+
+_icon_resolver = None
+
+
+def get_icon_resolver(theme=None):
+    """
+    Return the IconResolver for theme shared by everything loading icons,
+    creating it the first time or when the theme changed.
+    """
+    global _icon_resolver
+    resolver = _icon_resolver
+    if resolver is None or resolver.theme != (theme or FALLBACK_THEME):
+        resolver = _icon_resolver = IconResolver(theme)
+    return resolver
+
+
+def icon_base_dirs():
+    """
+    Return the directories searched for icon themes and unthemed icons, in
+    order of precedence.
+    """
+    dirs = [os.path.expanduser("~/.icons")]
+    dirs.extend(os.path.join(path, "icons") for path in xdg_data_dirs)
+    dirs.append("/usr/share/pixmaps")
+    return dirs
+
+
+def icon_name_hash(name):
+    """
+    Return the hash gtk-update-icon-cache uses for the UTF-8 encoded name,
+    which treats the bytes as signed chars.
+    """
+    h = 0
+    for i, c in enumerate(bytearray(name)):
+        if c > 127:
+            c -= 256
+        if i == 0:
+            h = c & 0xffffffff
+        else:
+            h = ((h << 5) - h + c) & 0xffffffff
+    return h
+
+
+class IconCache(object):
+    """
+    A memory-mapped icon-theme.cache. Raises EnvironmentError if the file
+    cannot be mapped and ValueError if it is not a cache this code can read.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            major, minor, self._hash_offset, dir_list_offset = \
+                struct.unpack_from(">HHII", self._map, 0)
+            if major != CACHE_MAJOR_VERSION:
+                raise ValueError("Unsupported icon cache version %d.%d in %s" %
+                                 (major, minor, filename))
+            self._n_buckets = self._card32(self._hash_offset)
+            n_dirs = self._card32(dir_list_offset)
+            self.directories = []
+            for i in range(n_dirs):
+                offset = self._card32(dir_list_offset + 4 + 4 * i)
+                self.directories.append(self._string(offset))
+        except struct.error:
+            self._map.close()
+            raise ValueError("Truncated icon cache %s" % filename)
+        except ValueError:
+            self._map.close()
+            raise
+
+    def _card32(self, offset):
+        return struct.unpack_from(">I", self._map, offset)[0]
+
+    def _string(self, offset):
+        end = self._map.find("\0", offset)
+        if end < 0:
+            raise ValueError("Unterminated string in icon cache %s" %
+                             self.filename)
+        return self._map[offset:end]
+
+    def _name_equals(self, offset, name):
+        end = offset + len(name)
+        return (self._map[offset:end] == name and
+                end < len(self._map) and self._map[end] == "\0")
+
+    def lookup(self, name):
+        """
+        Return a list of (directory, flags) for every image of the UTF-8
+        encoded icon name.
+        """
+        if not self._n_buckets:
+            return []
+        bucket = icon_name_hash(name) % self._n_buckets
+        try:
+            offset = self._card32(self._hash_offset + 4 + 4 * bucket)
+            while offset != _NO_OFFSET:
+                chain, name_offset, images_offset = \
+                    struct.unpack_from(">III", self._map, offset)
+                if self._name_equals(name_offset, name):
+                    images = []
+                    n_images = self._card32(images_offset)
+                    for i in range(n_images):
+                        dir_index, flags = struct.unpack_from(
+                            ">HH", self._map, images_offset + 4 + 8 * i)
+                        images.append((self.directories[dir_index], flags))
+                    return images
+                offset = chain
+        except (struct.error, IndexError):
+            logger.warning("Corrupt icon cache %s" % self.filename)
+        return []
+
+
+class DirectoryScan(object):
+    """
+    Stand-in for an IconCache listing the theme directories of a theme
+    location which has no usable cache. Every directory is listed once, the
+    first time an icon is looked up.
+    """
+    def __init__(self, path, directories):
+        self.path = path
+        self.directories = directories
+        self._icons = None
+
+    def _scan(self):
+        icons = {}
+        for directory in self.directories:
+            try:
+                names = os.listdir(os.path.join(self.path, directory))
+            except OSError:
+                continue
+            for filename in names:
+                name, ext = os.path.splitext(filename)
+                for flag, extension in _FLAG_EXTENSIONS:
+                    if ext == "." + extension:
+                        images = icons.setdefault(name, {})
+                        images[directory] = images.get(directory, 0) | flag
+        self._icons = dict((name, images.items())
+                           for name, images in icons.iteritems())
+
+    def lookup(self, name):
+        if self._icons is None:
+            self._scan()
+        return self._icons.get(name, [])
+
+
+def open_theme_location(path, directories):
+    """
+    Return an IconCache for the theme location path if it has one that is not
+    older than the directory, or a DirectoryScan of directories otherwise.
+    """
+    filename = os.path.join(path, CACHE_NAME)
+    try:
+        # like GTK+, whole seconds, as the cache is written into the directory
+        if int(os.stat(filename).st_mtime) >= int(os.stat(path).st_mtime):
+            return IconCache(filename)
+        logger.debug("Icon cache %s is out of date" % filename)
+    except EnvironmentError:
+        pass
+    except ValueError, e:
+        logger.warning(str(e))
+    return DirectoryScan(path, directories)
+
+
+class ThemeDirectory(object):
+    """
+    The size attributes of a theme subdirectory from its index.theme.
+    """
+    __slots__ = ('name', 'size', 'type', 'min_size', 'max_size', 'threshold',
+                 'scale')
+
+    def __init__(self, theme, name):
+        def get_int(key, default):
+            try:
+                return int(theme.get(key, group=name))
+            except ValueError:
+                return default
+        self.name = name
+        self.size = get_int("Size", 0)
+        self.type = theme.get("Type", group=name) or "Threshold"
+        self.min_size = get_int("MinSize", self.size)
+        self.max_size = get_int("MaxSize", self.size)
+        self.threshold = get_int("Threshold", 2)
+        self.scale = get_int("Scale", 1)
+
+    def distance(self, size, scale=1):
+        """
+        Return how far this directory is from size, 0 for a match, following
+        the algorithm of the Icon Theme Specification.
+        """
+        if self.scale != scale:
+            return abs(self.size * self.scale - size * scale) + 1
+        if self.type == "Fixed":
+            return abs(self.size - size)
+        elif self.type == "Scalable":
+            if size < self.min_size:
+                return self.min_size - size
+            if size > self.max_size:
+                return size - self.max_size
+            return 0
+        if size < self.size - self.threshold:
+            return self.min_size - size
+        if size > self.size + self.threshold:
+            return size - self.max_size
+        return 0
+
+
+class Theme(object):
+    """
+    An icon theme: its index.theme, and a cache or scan for every base dir
+    containing the theme.
+    """
+    def __init__(self, name, base_dirs):
+        self.name = name
+        self.inherits = []
+        self.directories = {}
+        self.locations = []
+        index = None
+        paths = [os.path.join(path, name) for path in base_dirs]
+        paths = [path for path in paths if os.path.isdir(path)]
+        for path in paths:
+            filename = os.path.join(path, "index.theme")
+            if os.path.isfile(filename):
+                index = IconTheme()
+                try:
+                    index.parse(filename)
+                except ParsingError, e:
+                    logger.warning("Invalid icon theme %s: %s" % (filename, e))
+                    index = None
+                    continue
+                break
+        if index is None:
+            return
+        self.inherits = [n.encode("utf-8") for n in index.getInherits() if n]
+        names = [d.encode("utf-8") for d in
+                 index.getDirectories() + index.getScaledDirectories()]
+        for directory in names:
+            if directory and directory not in self.directories:
+                self.directories[directory] = ThemeDirectory(index, directory)
+        self.locations = [(path, open_theme_location(path, names))
+                          for path in paths]
+
+    def lookup(self, name, size, scale=1):
+        """
+        Return the file of the UTF-8 encoded icon name closest to size, or
+        None if the theme does not have the icon.
+        """
+        best = None
+        for position, (path, location) in enumerate(self.locations):
+            for directory, flags in location.lookup(name):
+                info = self.directories.get(directory)
+                if info is None:
+                    continue
+                for preference, (flag, ext) in enumerate(_FLAG_EXTENSIONS):
+                    if flags & flag:
+                        rank = (info.distance(size, scale), preference,
+                                position)
+                        if best is None or rank < best[0]:
+                            best = (rank, path, directory, ext)
+                        break
+        if best is None:
+            return None
+        rank, path, directory, ext = best
+        return os.path.join(path, directory, "%s.%s" % (name, ext))
+
+
+class IconResolver(object):
+    """
+    Finds the file backing an icon name at a size in theme, the themes it
+    inherits from and hicolor, falling back to unthemed icons in the base
+    dirs. Themes are loaded and results remembered until invalidate() is
+    called, e.g. when the icon theme changed.
+    """
+    def __init__(self, theme=None, base_dirs=None):
+        self.theme = theme or FALLBACK_THEME
+        self.base_dirs = list(base_dirs or icon_base_dirs())
+        self._themes = None
+        self._unthemed = None
+        self._resolved = {}
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """
+        Return the themes to search in order, loading them the first time.
+        """
+        themes = self._themes
+        if themes is not None:
+            return themes
+        with self._lock:
+            if self._themes is not None:
+                return self._themes
+            themes = []
+            names = [self.theme]
+            while names:
+                name = names.pop(0)
+                if name in [t.name for t in themes]:
+                    continue
+                theme = Theme(name, self.base_dirs)
+                themes.append(theme)
+                names = theme.inherits + names
+            if FALLBACK_THEME not in [t.name for t in themes]:
+                themes.append(Theme(FALLBACK_THEME, self.base_dirs))
+            unthemed = []
+            for path in self.base_dirs:
+                try:
+                    unthemed.append((path, frozenset(os.listdir(path))))
+                except OSError:
+                    pass
+            self._unthemed = unthemed
+            self._themes = themes
+            logger.debug("Loaded icon themes %s" %
+                         ", ".join(t.name for t in themes))
+        return themes
+
+    def lookup(self, icon, size, scale=1):
+        """
+        Return the file for icon, an icon name or absolute file name, at
+        size, or None if it cannot be found.
+        """
+        if not icon:
+            return None
+        if os.path.isabs(icon):
+            return icon
+        key = (icon, size, scale)
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+        themes = self._load()
+        name = icon.encode("utf-8") if isinstance(icon, unicode) else icon
+        base, ext = os.path.splitext(name)
+        if ext[1:] in EXTENSIONS:
+            # a file name instead of an icon name, still found by GTK+
+            name = base
+        filename = None
+        for theme in themes:
+            filename = theme.lookup(name, size, scale)
+            if filename:
+                break
+        else:
+            for path, names in self._unthemed:
+                for extension in EXTENSIONS:
+                    basename = "%s.%s" % (name, extension)
+                    if basename in names:
+                        filename = os.path.join(path, basename)
+                        break
+                if filename:
+                    break
+        self._resolved[key] = filename
+        return filename
+
+    def invalidate(self):
+        """
+        Forget the loaded themes and resolved icons. Caches still used by
+        another thread are unmapped once it is done with them.
+        """
+        with self._lock:
+            self._themes = None
+            self._unthemed = None
+            self._resolved = {}
+        logger.debug("Icon resolver invalidated")
@@ -0,0 +1,187 @@
+"""
+Test launching of desktop entries without blocking the user interface.
+
+The Exec key is split and its field codes expanded as described in the Desktop
+Entry Specification instead of handing the raw string to a shell. Programs are
+started with Gio.Subprocess and their output, exit status and timing are
+reported from the main loop, so any number of launches can run at once.
+"""
+import time
+import logging
+
+from gi.repository import Gio, GLib
+
+logger = logging.getLogger(__name__)
+
+# field codes which are deprecated and must be removed from the command line
+DEPRECATED_FIELD_CODES = "dDnNvm"
+# characters which have to be escaped inside a quoted argument
+QUOTED_ESCAPES = "\"`$\\"
+
+
+def split_exec(command):
+    """
+    Split the value of an Exec key into arguments, honouring the quoting rules
+    of the Desktop Entry Specification. Raises ValueError if a quote is not
+    closed.
+    """
+    args = []
+    current = None
+    quoted = False
+    i = 0
+    while i < len(command):
+        c = command[i]
+        if quoted:
+            if c == "\\" and i + 1 < len(command) and command[i + 1] in QUOTED_ESCAPES:
+                current += command[i + 1]
+                i += 1
+            elif c == '"':
+                quoted = False
+            else:
+                current += c
+        elif c in " \t\n":
+            if current is not None:
+                args.append(current)
+                current = None
+        elif c == '"':
+            quoted = True
+            if current is None:
+                current = ""
+        else:
+            current = (current or "") + c
+        i += 1
+    if quoted:
+        raise ValueError("Unterminated quote in Exec key")
+    if current is not None:
+        args.append(current)
+    return args
+
+
+def expand_exec(command, files=(), icon=None, name=None, filename=None):
+    """
+    Return the argument vector for the Exec key command, expanding its field
+    codes for the given files or URLs, the Icon and Name of the entry and the
+    desktop file it came from. Raises ValueError for an invalid command line.
+    """
+    files = list(files)
+    argv = []
+    for arg in split_exec(command):
+        if arg in ("%F", "%U"):
+            argv.extend(files)
+            continue
+        if arg == "%i":
+            if icon:
+                argv.extend(("--icon", icon))
+            continue
+        value = []
+        had_field_code = False
+        i = 0
+        while i < len(arg):
+            c = arg[i]
+            if c != "%" or i + 1 == len(arg):
+                value.append(c)
+                i += 1
+                continue
+            code = arg[i + 1]
+            i += 2
+            if code == "%":
+                value.append("%")
+                continue
+            had_field_code = True
+            if code in "fu":
+                value.append(files[0] if files else "")
+            elif code == "c":
+                value.append(name or "")
+            elif code == "k":
+                value.append(filename or "")
+            elif code in DEPRECATED_FIELD_CODES:
+                pass
+            else:
+                raise ValueError("Invalid field code %%%s in Exec key" % code)
+        value = "".join(value)
+        # an argument which was only an empty field code is dropped
+        if value or not had_field_code:
+            argv.append(value)
+    if not argv:
+        raise ValueError("Exec key is empty")
+    return argv
+
+
+class Launch(object):
+    """
+    A single program started for testing. output_callback(launch, stream, line)
+    is called for every line the program writes to "stdout" or "stderr" and
+    exit_callback(launch) once it exited. Output is read until the pipes are
+    closed, which may be after the exit when the program handed them to a
+    process of its own, such as the browser started by xdg-open. The
+    attributes startup_time (seconds until the first output, or None) and
+    elapsed (total wall-clock seconds) are set as they become known.
+    """
+    def __init__(self, argv, output_callback=None, exit_callback=None,
+                 cwd=None):
+        self.argv = list(argv)
+        self.cwd = cwd
+        self.pid = None
+        self.startup_time = None
+        self.elapsed = None
+        self.exit_status = None
+        self.term_signal = None
+        self._output_callback = output_callback
+        self._exit_callback = exit_callback
+        self._process = None
+        self._start_time = None
+
+    def start(self):
+        """
+        Start the program. Raises GLib.GError if it cannot be started.
+        """
+        launcher = Gio.SubprocessLauncher.new(Gio.SubprocessFlags.STDOUT_PIPE |
+                                              Gio.SubprocessFlags.STDERR_PIPE)
+        if self.cwd:
+            launcher.set_cwd(self.cwd)
+        self._start_time = time.time()
+        self._process = launcher.spawnv(self.argv)
+        self.pid = self._process.get_identifier()
+        for stream_name, stream in (("stdout", self._process.get_stdout_pipe()),
+                                    ("stderr", self._process.get_stderr_pipe())):
+            stream = Gio.DataInputStream.new(stream)
+            stream.read_line_async(GLib.PRIORITY_DEFAULT, None,
+                                   self._on_read_line, stream_name)
+        self._process.wait_async(None, self._on_exited)
+
+    def is_running(self):
+        return self._process is not None and self.elapsed is None
+
+    def terminate(self):
+        if self.is_running():
+            self._process.force_exit()
+
+    def _on_read_line(self, stream, result, stream_name):
+        try:
+            line, length = stream.read_line_finish(result)
+        except GLib.GError, e:
+            logger.debug("Reading %s of %s failed: %s" % (stream_name,
+                                                           self.argv[0], e))
+            line = None
+        if line is None:
+            return
+        if self.startup_time is None:
+            self.startup_time = time.time() - self._start_time
+        if self._output_callback:
+            self._output_callback(self, stream_name,
+                                  line.decode('utf-8', 'replace'))
+        stream.read_line_async(GLib.PRIORITY_DEFAULT, None,
+                               self._on_read_line, stream_name)
+
+    def _on_exited(self, process, result):
+        try:
+            process.wait_finish(result)
+        except GLib.GError, e:
+            logger.debug("Waiting for %s failed: %s" % (self.argv[0], e))
+        self.elapsed = time.time() - self._start_time
+        if process.get_if_exited():
+            self.exit_status = process.get_exit_status()
+        elif process.get_if_signaled():
+            self.term_signal = process.get_term_sig()
+        if self._exit_callback:
+            self._exit_callback(self)
@@ -0,0 +1,272 @@
+"""
+Reverse index from MIME types to the launchers which handle them.
+
+update-desktop-database parses every desktop file of a directory to write its
+mimeinfo.cache. This index is instead fed the MimeType of every launcher by the
+scanner, which parses them for the launcher list anyway, and is updated file
+by file as launchers are saved or the monitor reports changes. Only the caches
+of directories whose associations changed are written again, from memory, in
+the same format as update-desktop-database. Unless told otherwise only the
+cache of the user's applications directory is written, as the others belong
+to the package manager.
+"""
+import os
+import logging
+import threading
+
+from gi.repository import GLib
+from xdg.BaseDirectory import xdg_data_home
+
+from dee.atomicwrite import WriteBatch
+
+logger = logging.getLogger(__name__)
+
+MIME_CACHE_NAME = "mimeinfo.cache"
+MIME_CACHE_GROUP = "MIME Cache"
+# seconds between a change and writing the caches
+SAVE_DELAY = 2
+
+
+def format_mime_cache(handlers):
+    """
+    Return the UTF-8 encoded contents of a mimeinfo.cache for handlers, a dict
+    mapping each MIME type to the desktop file IDs which handle it.
+    """
+    def encode(value):
+        return value.encode('utf-8') if isinstance(value, unicode) else value
+    lines = ["[%s]\n" % MIME_CACHE_GROUP]
+    for mime_type in sorted(handlers):
+        desktop_ids = sorted(encode(i) for i in handlers[mime_type])
+        if desktop_ids:
+            lines.append("%s=%s;\n" % (encode(mime_type),
+                                        ";".join(desktop_ids)))
+    return "".join(lines)
+
+
+class MimeIndex(object):
+    """
+    Maps MIME types to the EntrySummary of every launcher handling them. The
+    DesktopFileIndex of the scan, set with set_index(), provides the desktop
+    file IDs and decides which launchers are effective. Hidden launchers
+    handle nothing.
+
+    Updates are made from the main loop. save() is safe to call from another
+    thread.
+
+    write_dirs lists the applications directories whose caches save() may
+    write, or is None for every writable one.
+    """
+    def __init__(self, index=None):
+        self._index = index
+        self.write_dirs = [os.path.join(xdg_data_home, "applications")]
+        self._summaries = {}    # filename -> EntrySummary
+        self._handlers = {}     # MIME type -> set of filenames
+        self._dirty = set()     # applications directories to write
+        self._seen = None
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._save_id = None
+
+    def __len__(self):
+        return len(self._handlers)
+
+    def set_index(self, index):
+        self._index = index
+
+    def start_scan(self):
+        """
+        Start collecting the files of a full scan. Files which are not updated
+        before finish_scan() are dropped.
+        """
+        self._seen = set()
+
+    def finish_scan(self):
+        seen, self._seen = self._seen, None
+        if seen is not None:
+            for filename in [f for f in self._summaries if f not in seen]:
+                self.remove(filename)
+
+    def _directory(self, filename):
+        """
+        Return the applications directory of filename, or None.
+        """
+        if self._index is None:
+            return None
+        rank, desktop_id = self._index.locate(filename)
+        return self._index.dirs[rank] if rank is not None else None
+
+    def _mime_types(self, summary):
+        if summary is None or summary.hidden:
+            return ()
+        return summary.mime_types
+
+    def update(self, summary):
+        """
+        Add or update the launcher of an EntrySummary. Returns True if the MIME
+        types it handles changed.
+        """
+        filename = summary.filename
+        if self._seen is not None:
+            self._seen.add(filename)
+        with self._lock:
+            old = self._summaries.get(filename)
+            self._summaries[filename] = summary
+            old_types = self._mime_types(old)
+            new_types = self._mime_types(summary)
+            if old_types == new_types:
+                return False
+            self._set_types(filename, old_types, new_types)
+        return True
+
+    def remove(self, filename):
+        """
+        Remove the launcher of filename, e.g. when the file was deleted.
+        """
+        with self._lock:
+            old = self._summaries.pop(filename, None)
+            if old is not None:
+                self._set_types(filename, self._mime_types(old), ())
+
+    def _set_types(self, filename, old_types, new_types):
+        """
+        Move filename from the handlers of old_types to those of new_types.
+        Must hold the lock.
+        """
+        for mime_type in old_types:
+            filenames = self._handlers.get(mime_type)
+            if filenames is not None:
+                filenames.discard(filename)
+                if not filenames:
+                    del self._handlers[mime_type]
+        for mime_type in new_types:
+            self._handlers.setdefault(mime_type, set()).add(filename)
+        path = self._directory(filename)
+        if path is not None and (old_types or new_types):
+            self._dirty.add(path)
+
+    def mime_types(self):
+        """
+        Return the sorted list of MIME types handled by some launcher.
+        """
+        with self._lock:
+            return sorted(self._handlers)
+
+    def lookup(self, mime_type):
+        """
+        Return (desktop file ID, EntrySummary) for every effective launcher
+        handling mime_type, in the order of precedence of their directories.
+        """
+        index = self._index
+        with self._lock:
+            summaries = [self._summaries[f] for f in
+                         self._handlers.get(mime_type, ())]
+        if index is None:
+            return sorted((os.path.basename(s.filename), s) for s in summaries)
+        handlers = []
+        for summary in summaries:
+            rank, desktop_id = index.locate(summary.filename)
+            if rank is None or index.shadowed_by(summary.filename):
+                continue # not installed or overridden
+            handlers.append((rank, desktop_id, summary))
+        handlers.sort(key=lambda item: item[:2])
+        return [(desktop_id, summary) for rank, desktop_id, summary in handlers]
+
+    def get_handlers(self, path):
+        """
+        Return a dict mapping MIME types to the desktop file IDs of the
+        launchers in the applications directory path which handle them, as
+        written to its mimeinfo.cache.
+        """
+        index = self._index
+        prefix = os.path.join(path, "")
+        handlers = {}
+        with self._lock:
+            for mime_type, filenames in self._handlers.iteritems():
+                for filename in filenames:
+                    if filename.startswith(prefix):
+                        desktop_id = index.get_id(filename)
+                        if desktop_id:
+                            handlers.setdefault(mime_type, []).append(
+                                desktop_id)
+        return handlers
+
+    def _is_complete(self, path):
+        """
+        Return True if every launcher in path was indexed. Shadowed launchers
+        are only scanned when they are shown.
+        """
+        prefix = os.path.join(path, "")
+        for filename in self._index.filenames():
+            if (filename.startswith(prefix) and filename not in
+                    self._summaries and self._index.shadowed_by(filename)):
+                return False
+        return True
+
+    def queue_save(self):
+        """
+        Write the changed caches in a background thread after a short delay,
+        so that a burst of changes results in one write.
+        """
+        if self._save_id is None:
+            self._save_id = GLib.timeout_add_seconds(SAVE_DELAY,
+                                                     self._on_save_timeout)
+
+    def _on_save_timeout(self):
+        self._save_id = None
+        thread = threading.Thread(target=self.save)
+        thread.daemon = True
+        thread.start()
+        return False
+
+    def save(self):
+        """
+        Write the mimeinfo.cache of every writable applications directory in
+        write_dirs whose associations changed and return the list of written
+        files. A cache which is already up to date is not touched.
+        """
+        if self._index is None:
+            return []
+        write_dirs = self.write_dirs
+        if write_dirs is not None:
+            write_dirs = set(os.path.realpath(p) for p in write_dirs)
+        with self._save_lock:
+            with self._lock:
+                dirty = set(p for p in self._dirty if write_dirs is None or
+                            os.path.realpath(p) in write_dirs)
+                # the others are written if they are allowed later
+                self._dirty -= dirty
+            batch = WriteBatch()
+            for path in sorted(dirty):
+                if not os.access(path, os.W_OK):
+                    logger.debug("Not writing the MIME cache of %s" % path)
+                    continue
+                if not self._is_complete(path):
+                    logger.debug("Not writing the MIME cache of %s, shadowed "
+                                 "files were not scanned" % path)
+                    continue
+                data = format_mime_cache(self.get_handlers(path))
+                filename = os.path.join(path, MIME_CACHE_NAME)
+                try:
+                    with open(filename, "rb") as f:
+                        if f.read() == data:
+                            continue
+                except IOError:
+                    pass
+                try:
+                    batch.add(filename, data)
+                except (IOError, OSError), e:
+                    logger.warn("Could not write %s: %s" % (filename, e))
+                    self._retry(path)
+            try:
+                written = batch.commit()
+            except OSError, e:
+                logger.warn("Could not write %s: %s" % (e.filename, e))
+                self._retry(os.path.dirname(e.filename))
+                return []
+            for filename in written:
+                logger.debug("Updated %s" % filename)
+            return written
+
+    def _retry(self, path):
+        with self._lock:
+            self._dirty.add(path)
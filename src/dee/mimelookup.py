@@ -0,0 +1,111 @@
+"""
+Window listing the launchers which handle a MIME type.
+"""
+from gi.repository import GObject, GdkPixbuf, Gtk
+
+from dee.entry import get_icon_pixbuf
+
+
+class MimeLookup(Gtk.Window):
+    """
+    An entry for a MIME type, completing the types some launcher handles, and
+    the launchers handling it according to a MimeIndex, looked up as the user
+    types. Activating a row calls open_callback with the desktop file.
+    """
+    COL_ICON = 0
+    COL_NAME = 1
+    COL_ID = 2
+    COL_FILENAME = 3
+
+    def __init__(self, mime_index, parent=None, open_callback=None):
+        Gtk.Window.__init__(self)
+        self.set_title("MIME Type Handlers")
+        self.set_default_size(500, 350)
+        if parent:
+            self.set_transient_for(parent)
+            self.set_destroy_with_parent(True)
+        self._mime_index = mime_index
+        self._open_callback = open_callback
+
+        self._completion_model = Gtk.ListStore(GObject.TYPE_STRING)
+        completion = Gtk.EntryCompletion()
+        completion.set_model(self._completion_model)
+        completion.set_text_column(0)
+        completion.set_minimum_key_length(1)
+        self._entry = Gtk.Entry()
+        self._entry.set_placeholder_text("text/plain")
+        self._entry.set_completion(completion)
+        self._entry.connect("changed", self.on_entry_changed)
+        label = Gtk.Label.new_with_mnemonic("_MIME type:")
+        label.set_mnemonic_widget(self._entry)
+
+        self._model = Gtk.ListStore(GdkPixbuf.Pixbuf,       # icon
+                                    GObject.TYPE_STRING,    # name
+                                    GObject.TYPE_STRING,    # desktop file ID
+                                    GObject.TYPE_STRING)    # full path
+        self._treeview = Gtk.TreeView()
+        self._treeview.set_model(self._model)
+        self._treeview.set_tooltip_column(self.COL_FILENAME)
+        self._treeview.connect("row-activated", self.on_treeview_row_activated)
+        column = Gtk.TreeViewColumn("Application")
+        cell = Gtk.CellRendererPixbuf()
+        column.pack_start(cell, False)
+        column.add_attribute(cell, "pixbuf", self.COL_ICON)
+        cell = Gtk.CellRendererText()
+        column.pack_start(cell, True)
+        column.add_attribute(cell, "text", self.COL_NAME)
+        column.set_resizable(True)
+        self._treeview.append_column(column)
+        column = Gtk.TreeViewColumn("Desktop File ID", Gtk.CellRendererText(),
+                                    text=self.COL_ID)
+        self._treeview.append_column(column)
+
+        scrolled = Gtk.ScrolledWindow()
+        scrolled.set_shadow_type(Gtk.ShadowType.IN)
+        scrolled.add(self._treeview)
+
+        self._status_label = Gtk.Label()
+        self._status_label.set_alignment(0, 0.5)
+
+        entry_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
+        entry_box.pack_start(label, False, True, 0)
+        entry_box.pack_start(self._entry, True, True, 0)
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        box.set_border_width(6)
+        box.pack_start(entry_box, False, True, 0)
+        box.pack_start(scrolled, True, True, 0)
+        box.pack_start(self._status_label, False, True, 0)
+        self.add(box)
+        box.show_all()
+        self.refresh()
+
+    def refresh(self):
+        """
+        Reload the completions and the handlers of the MIME type shown, e.g.
+        after the launchers changed.
+        """
+        self._completion_model.clear()
+        for mime_type in self._mime_index.mime_types():
+            self._completion_model.append((mime_type,))
+        self._lookup()
+
+    def _lookup(self):
+        mime_type = self._entry.get_text().strip().decode('utf-8')
+        self._model.clear()
+        if not mime_type:
+            self._status_label.set_text("%d MIME types are handled" %
+                                        len(self._mime_index))
+            return
+        handlers = self._mime_index.lookup(mime_type)
+        for desktop_id, summary in handlers:
+            self._model.append((get_icon_pixbuf(summary.icon, 16),
+                                summary.name, desktop_id, summary.filename))
+        self._status_label.set_text("%d applications handle %s" %
+                                    (len(handlers), mime_type))
+
+    def on_entry_changed(self, entry, data=None):
+        self._lookup()
+
+    def on_treeview_row_activated(self, treeview, path, column, data=None):
+        if self._open_callback:
+            self._open_callback(self._model[path][self.COL_FILENAME])
@@ -0,0 +1,141 @@
+"""
+Watch the XDG application directories for desktop entries being added, changed
+or removed.
+"""
+import os
+import logging
+
+from gi.repository import Gio, GLib
+
+from dee.fileaccess import get_access_cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COALESCE_MS = 250
+
+if hasattr(Gio.FileMonitorFlags, "WATCH_MOVES"):
+    _MONITOR_FLAGS = Gio.FileMonitorFlags.WATCH_MOVES
+else:
+    _MONITOR_FLAGS = Gio.FileMonitorFlags.SEND_MOVED
+
+# events which may report a directory appearing in a monitored directory,
+# MOVED_IN and RENAMED are only sent with WATCH_MOVES
+_NEW_FILE_EVENTS = frozenset([getattr(Gio.FileMonitorEvent, name)
+                              for name in ("CREATED", "MOVED", "MOVED_IN",
+                                           "RENAMED")
+                              if hasattr(Gio.FileMonitorEvent, name)])
+
+
+class ApplicationsMonitor(object):
+    """
+    Monitors a list of directories and their subdirectories, and reports the
+    desktop files which changed in batches. Events are coalesced for
+    coalesce_ms milliseconds so that a package upgrade touching hundreds of
+    files results in a single call to callback(filenames). The callback is
+    responsible for checking whether each file still exists. Subdirectories
+    created while monitoring are watched too, and the desktop files already in
+    them are reported.
+    """
+    def __init__(self, dirs, callback, coalesce_ms=DEFAULT_COALESCE_MS):
+        self._dirs = [os.path.normpath(d) for d in dirs]
+        self._callback = callback
+        self._coalesce_ms = coalesce_ms
+        self._monitors = {} # directory -> Gio.FileMonitor
+        self._pending = set()
+        self._timeout_id = None
+
+    def start(self):
+        """
+        Start monitoring every directory which exists, and its
+        subdirectories as they provide desktop files too.
+        """
+        self.stop()
+        for path in self._dirs:
+            self._watch(path)
+
+    def refresh(self):
+        """
+        Walk the directories again, to monitor those which were created since
+        and stop monitoring those which were removed, without dropping the
+        events which have not been reported yet.
+        """
+        for path in list(self._monitors):
+            if not os.path.isdir(path):
+                self._unwatch(path)
+        for path in self._dirs:
+            self._watch(path)
+
+    def stop(self):
+        """
+        Stop monitoring and drop any events which have not been reported yet.
+        """
+        for monitor in self._monitors.itervalues():
+            monitor.cancel()
+        self._monitors = {}
+        self._pending.clear()
+        if self._timeout_id:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
+
+    def _watch(self, top):
+        """
+        Start monitoring top and its subdirectories which are not monitored
+        yet. Returns the desktop files in the directories it started to
+        monitor.
+        """
+        found = []
+        for dirpath, dirnames, filenames in os.walk(top, followlinks=True):
+            if dirpath in self._monitors:
+                continue
+            try:
+                monitor = Gio.File.new_for_path(dirpath).monitor_directory(
+                                                        _MONITOR_FLAGS, None)
+            except GLib.GError, e:
+                logger.warn("Cannot monitor %s: %s" % (dirpath, e))
+                continue
+            monitor.connect("changed", self._on_changed)
+            self._monitors[dirpath] = monitor
+            logger.debug("Monitoring %s" % dirpath)
+            found.extend([os.path.join(dirpath, f) for f in filenames
+                          if f.endswith(".desktop")])
+        return found
+
+    def _unwatch(self, top):
+        """
+        Stop monitoring top and its subdirectories.
+        """
+        prefix = os.path.join(top, "")
+        for path in list(self._monitors):
+            if path == top or path.startswith(prefix):
+                self._monitors.pop(path).cancel()
+                logger.debug("Stopped monitoring %s" % path)
+
+    def _on_changed(self, monitor, gfile, other_file, event_type):
+        for f in (gfile, other_file):
+            if f is None:
+                continue
+            path = f.get_path()
+            if not path:
+                continue
+            # the file or the directory itself may have changed
+            get_access_cache().invalidate(path)
+            if path.endswith(".desktop"):
+                self._pending.add(path)
+            elif path in self._monitors:
+                if not os.path.isdir(path):
+                    self._unwatch(path)
+            elif (event_type in _NEW_FILE_EVENTS and
+                  os.path.dirname(path) in self._monitors and
+                  os.path.isdir(path)):
+                # files may have been put in it before it was monitored
+                self._pending.update(self._watch(path))
+        if self._pending and not self._timeout_id:
+            self._timeout_id = GLib.timeout_add(self._coalesce_ms, self._flush)
+
+    def _flush(self):
+        self._timeout_id = None
+        filenames = self._pending
+        self._pending = set()
+        logger.debug("%d desktop files changed" % len(filenames))
+        self._callback(filenames)
+        return False
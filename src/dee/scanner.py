@@ -0,0 +1,474 @@
+"""
+Background scanning of the desktop entries installed on the system.
+
+The desktop files are parsed on a pool of worker threads and the results are
+handed back to the GTK+ main loop in batches from an idle callback, so that the
+user interface stays responsive while thousands of launchers are loaded. Files
+which have not changed since the last scan are served from the Catalog.
+
+Directories are walked in order of precedence and every file is indexed by its
+desktop file ID, so a launcher overridden in a directory of higher precedence
+is only parsed once and the shadowed copies are skipped.
+"""
+import os
+import bisect
+import logging
+import threading
+import Queue
+
+from gi.repository import GLib
+from xdg.Exceptions import ParsingError
+from xdg.BaseDirectory import xdg_data_dirs
+
+from dee.entry import Entry, EntrySummary, read_entry_summary
+from dee.executables import get_executable_index
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_BATCH_SIZE = 64
+
+
+def application_dirs():
+    """
+    Return the list of XDG "applications" directories in order of precedence.
+    """
+    return [os.path.join(path, "applications") for path in xdg_data_dirs]
+
+
+def walk_desktop_files(path):
+    """
+    Generate the desktop files in path and its subdirectories.
+    """
+    for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(".desktop"):
+                yield os.path.join(dirpath, filename)
+
+
+def desktop_files(dirs=None):
+    """
+    Return every desktop file in dirs, the application_dirs() by default.
+    """
+    files = []
+    for path in dirs if dirs is not None else application_dirs():
+        files.extend(walk_desktop_files(path))
+    return files
+
+
+def desktop_file_id(path, filename):
+    """
+    Return the desktop file ID of filename in the applications directory
+    path, which is its relative path with "/" replaced by "-".
+    """
+    return os.path.relpath(filename, path).replace(os.sep, "-")
+
+
+class DesktopFileIndex(object):
+    """
+    Maps desktop file IDs to the files which provide them. When several
+    applications directories provide the same ID, the file in the directory
+    which comes first in dirs is the effective one and the others are
+    shadowed by it.
+
+    All methods are safe to call while the scanner fills the index.
+    """
+    def __init__(self, dirs):
+        self.dirs = list(dirs)
+        self._providers = {} # id -> sorted list of (rank, filename)
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._providers)
+
+    def locate(self, filename):
+        """
+        Return (rank, desktop file ID) for filename, or (None, None) if it is
+        not in one of the directories.
+        """
+        for rank, path in enumerate(self.dirs):
+            if filename.startswith(os.path.join(path, "")):
+                return rank, desktop_file_id(path, filename)
+        return None, None
+
+    def add(self, filename, rank=None, desktop_id=None):
+        """
+        Add filename, found in self.dirs[rank] with the given ID. Both are
+        worked out from the path if omitted. Returns the file which was
+        effective for the ID and is now shadowed by filename, or None.
+        """
+        if rank is None:
+            rank, desktop_id = self.locate(filename)
+            if rank is None:
+                return None
+        with self._lock:
+            if filename in self._ids:
+                return None
+            self._ids[filename] = desktop_id
+            providers = self._providers.setdefault(desktop_id, [])
+            previous = providers[0][1] if providers else None
+            if not providers or providers[-1][0] <= rank:
+                providers.append((rank, filename)) # walking in order
+            else:
+                bisect.insort(providers, (rank, filename))
+            if previous is not None and providers[0][1] == filename:
+                return previous
+        return None
+
+    def remove(self, filename):
+        """
+        Remove filename. Returns the shadowed file which becomes effective in
+        its place, or None.
+        """
+        with self._lock:
+            desktop_id = self._ids.pop(filename, None)
+            if desktop_id is None:
+                return None
+            providers = self._providers[desktop_id]
+            was_effective = providers[0][1] == filename
+            providers[:] = [p for p in providers if p[1] != filename]
+            if not providers:
+                del self._providers[desktop_id]
+                return None
+            if was_effective:
+                return providers[0][1]
+        return None
+
+    def get_id(self, filename):
+        return self._ids.get(filename)
+
+    def filenames(self):
+        """
+        Return every indexed file, effective or shadowed.
+        """
+        with self._lock:
+            return list(self._ids)
+
+    def effective(self, desktop_id):
+        """
+        Return the effective file for desktop_id, or None.
+        """
+        providers = self._providers.get(desktop_id)
+        return providers[0][1] if providers else None
+
+    def shadowed(self, desktop_id):
+        """
+        Return the files shadowed by the effective file for desktop_id.
+        """
+        with self._lock:
+            return [f for (rank, f) in self._providers.get(desktop_id, [])[1:]]
+
+    def shadowed_by(self, filename):
+        """
+        Return the file which shadows filename, or None if filename is
+        effective or not indexed.
+        """
+        desktop_id = self._ids.get(filename)
+        if desktop_id is None:
+            return None
+        effective = self.effective(desktop_id)
+        return effective if effective != filename else None
+
+
+def is_broken(summary, executables=None):
+    """
+    Return True if summary is an application whose program is not installed.
+    """
+    if executables is None:
+        executables = get_executable_index()
+    return bool(summary.type == u"Application" and summary.program and
+                not executables.is_installed(summary.program))
+
+
+def scan_file(desktop_file):
+    """
+    Parse a single desktop file into an EntrySummary with the full pyxdg
+    parser. Raises ParsingError if the file cannot be parsed.
+    """
+    return EntrySummary.from_entry(Entry(desktop_file))
+
+# functions which read an EntrySummary from a desktop file
+PARSER_HEADER = "header"
+PARSER_FULL = "full"
+PARSERS = {
+    PARSER_HEADER: read_entry_summary,
+    PARSER_FULL: scan_file,
+}
+
+
+class ScanJob(object):
+    """
+    A single run of the scanner. Create these with Scanner.scan() to scan
+    whole directories or Scanner.update() to scan a list of files.
+    """
+    def __init__(self, dirs, batch_callback, progress_callback=None,
+                 finished_callback=None, workers=DEFAULT_WORKERS,
+                 batch_size=DEFAULT_BATCH_SIZE, catalog=None, files=None,
+                 parser=PARSER_HEADER, index=None, include_shadowed=False):
+        self._dirs = list(dirs)
+        self._index = index
+        self._include_shadowed = include_shadowed
+        self._executables = get_executable_index()
+        self._parse = PARSERS[parser]
+        self._files = files
+        self._catalog = catalog
+        if catalog is not None:
+            catalog.set_parser(parser)
+        self._batch_callback = batch_callback
+        self._progress_callback = progress_callback
+        self._finished_callback = finished_callback
+        self._n_workers = max(1, workers)
+        self._batch_size = batch_size
+
+        self._paths = Queue.Queue()
+        self._results = Queue.Queue()
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._drain_pending = False
+        self._globbed = False
+        self._total = 0
+        self._processed = 0
+        self._finished = False
+
+    def start(self):
+        """
+        Start the producer and worker threads.
+        """
+        threads = [threading.Thread(target=self._produce)]
+        for i in range(self._n_workers):
+            threads.append(threading.Thread(target=self._work))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+    def cancel(self):
+        """
+        Stop the scan. No callbacks are invoked after this returns.
+        """
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def is_running(self):
+        return not (self._finished or self._cancelled.is_set())
+
+    def _glob(self):
+        """
+        Generate the desktop files in the scanned directories, adding them to
+        the index. Shadowed files are skipped unless include_shadowed is set.
+        """
+        index = self._index
+        for rank, path in enumerate(self._dirs):
+            if self._cancelled.is_set():
+                break
+            logger.debug("Loading desktop entries from %s" % path)
+            for desktop_file in walk_desktop_files(path):
+                if index is not None:
+                    index.add(desktop_file, rank,
+                              desktop_file_id(path, desktop_file))
+                    if (not self._include_shadowed and
+                            index.shadowed_by(desktop_file)):
+                        continue
+                yield desktop_file
+
+    def _produce(self):
+        """
+        Glob the directories and feed the desktop files which are not in the
+        catalog to the workers.
+        """
+        catalog = self._catalog
+        if catalog is not None:
+            catalog.ensure_loaded()
+        # one stat per $PATH directory, relisting only those which changed
+        self._executables.refresh()
+        if self._files is not None:
+            desktop_files = self._files
+        else:
+            desktop_files = self._glob()
+        seen = set()
+        for desktop_file in desktop_files:
+            if self._cancelled.is_set():
+                break
+            try:
+                st = os.stat(desktop_file)
+            except OSError:
+                continue # removed or dangling symlink
+            seen.add(desktop_file)
+            with self._lock:
+                self._total += 1
+            record = None
+            if catalog is not None:
+                record = catalog.lookup(desktop_file, st)
+            if record is None:
+                self._paths.put((desktop_file, st))
+            else:
+                self._put_result(self._result_from_record(desktop_file,
+                                                          record))
+        for i in range(self._n_workers):
+            self._paths.put(None)
+        if (catalog is not None and self._files is None and
+                not self._cancelled.is_set()):
+            for desktop_file in catalog.prune(seen):
+                logger.debug("Dropped %s from catalog" % desktop_file)
+        with self._lock:
+            self._globbed = True
+            self._schedule_drain()
+
+    def _result_from_record(self, desktop_file, record):
+        """
+        Return the EntrySummary of a catalog record, or None for a file which
+        failed to parse.
+        """
+        summary, error = record
+        if error:
+            logger.debug("%s (cached)" % error)
+        return summary
+
+    def _put_result(self, result):
+        if result is not None:
+            result.broken = is_broken(result, self._executables)
+        with self._lock:
+            self._results.put(result)
+            self._schedule_drain()
+
+    def _work(self):
+        """
+        Parse desktop files until the producer sends the sentinel.
+        """
+        catalog = self._catalog
+        while True:
+            item = self._paths.get()
+            if item is None or self._cancelled.is_set():
+                return
+            desktop_file, st = item
+            try:
+                result = self._parse(desktop_file)
+            except ParsingError, e:
+                logger.warn(e)
+                if catalog is not None:
+                    catalog.store(desktop_file, st, None, str(e))
+                result = None # skip entries with parse errors
+            except Exception, e:
+                # e.g. unreadable or removed since it was listed, not cached
+                # as the next scan may be able to read it
+                logger.warn("Could not read %s: %s" % (desktop_file, e))
+                result = None
+            else:
+                if catalog is not None:
+                    catalog.store(desktop_file, st, result)
+            # every file must produce a result for the scan to finish
+            self._put_result(result)
+
+    def _schedule_drain(self):
+        """
+        Schedule an idle callback to drain the results. Must hold the lock.
+        """
+        if not self._drain_pending and not self._cancelled.is_set():
+            self._drain_pending = True
+            GLib.idle_add(self._drain)
+
+    def _drain(self):
+        """
+        Idle callback which hands up to one batch of results to the main loop.
+        """
+        if self._cancelled.is_set():
+            return False
+
+        batch = []
+        processed = 0
+        while processed < self._batch_size:
+            try:
+                result = self._results.get_nowait()
+            except Queue.Empty:
+                break
+            processed += 1
+            if result is not None:
+                batch.append(result)
+
+        if batch:
+            self._batch_callback(batch)
+
+        with self._lock:
+            self._processed += processed
+            done = self._processed
+            total = self._total
+            finished = self._globbed and done == total
+            if not finished and self._results.empty():
+                self._drain_pending = False
+                keep_going = False
+            else:
+                keep_going = not finished
+
+        if self._progress_callback:
+            self._progress_callback(done, total)
+        if finished:
+            self._finished = True
+            if self._catalog is not None:
+                thread = threading.Thread(target=self._catalog.save)
+                thread.daemon = True
+                thread.start()
+            if self._finished_callback:
+                self._finished_callback()
+        return keep_going
+
+
+class Scanner(object):
+    """
+    Scans the XDG application directories for desktop entries in the
+    background. Starting a new scan cancels the one in progress. If a Catalog
+    is given, unchanged files are not parsed again. parser is one of PARSERS.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE,
+                 catalog=None, parser=PARSER_HEADER, include_shadowed=False):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.catalog = catalog
+        self.parser = parser
+        self.include_shadowed = include_shadowed
+        self.index = None
+        self._job = None
+
+    def cancel(self):
+        """
+        Cancel the scan in progress, if any.
+        """
+        if self._job:
+            self._job.cancel()
+            self._job = None
+
+    def is_running(self):
+        return self._job is not None and self._job.is_running()
+
+    def scan(self, batch_callback, progress_callback=None,
+             finished_callback=None, dirs=None):
+        """
+        Start scanning dirs (defaults to application_dirs()). The callbacks are
+        invoked from the main loop: batch_callback(results) with a list of
+        EntrySummary, progress_callback(done, total) and finished_callback().
+        self.index is replaced by a DesktopFileIndex of dirs which is filled in
+        as the scan goes.
+        """
+        self.cancel()
+        if dirs is None:
+            dirs = application_dirs()
+        self.index = DesktopFileIndex(dirs)
+        self._job = ScanJob(dirs, batch_callback, progress_callback,
+                            finished_callback, self.workers, self.batch_size,
+                            self.catalog, None, self.parser, self.index,
+                            self.include_shadowed)
+        self._job.start()
+        return self._job
+
+    def update(self, files, batch_callback, finished_callback=None):
+        """
+        Scan only the given desktop files, for example those reported by a
+        file monitor. Unlike scan(), this does not cancel the scan in progress.
+        """
+        job = ScanJob([], batch_callback, None, finished_callback,
+                      self.workers, self.batch_size, self.catalog, files,
+                      self.parser)
+        job.start()
+        return job
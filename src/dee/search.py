@@ -0,0 +1,208 @@
+"""
+In-memory full text index of the launcher list for type-ahead search.
+
+The searchable text of every launcher is split into words. A query word
+matches launchers with a word containing it anywhere: each distinct word maps
+to the set of launchers using it, and the vocabulary itself is indexed by
+every substring of up to three characters. A query word of one to three
+characters is looked up directly, a longer one intersects the words of its
+trigrams. As the vocabulary is much smaller than the launcher list, a lookup
+only intersects small sets of words before collecting their launchers. Single
+characters, used by almost every launcher, also map straight to the launchers
+so they are not collected from thousands of words. The result of each query
+word is kept until the index changes, and query results are frozensets that
+callers may keep.
+"""
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+# how many keys a query word may match, per candidate left, before checking
+# the words of the candidates is cheaper than collecting those keys
+FILTER_RATIO = 8
+
+
+def split_words(text):
+    """
+    Return the lower case words in text.
+    """
+    return _WORD_RE.findall(text.lower())
+
+
+def _trigrams(word):
+    return set(word[i:i + 3] for i in range(len(word) - 2))
+
+
+def _grams(word):
+    """
+    Return the substrings of one to three characters of word.
+    """
+    return set(word[i:i + n] for n in (1, 2, 3)
+               for i in range(len(word) - n + 1))
+
+
+class SearchIndex(object):
+    """
+    Maps the words of each key's text to the keys, and substrings of up to
+    three characters to the words. Keys are added, replaced and removed one at
+    a time as the launcher list changes.
+    """
+    def __init__(self):
+        self._keys = {}     # key -> frozenset of words
+        self._words = {}    # word -> set of keys
+        self._grams = {}    # one to three characters -> set of words
+        self._chars = {}    # character -> set of keys
+        self._matches = {}  # query word -> frozenset of keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def add(self, key, text):
+        """
+        Index text under key, replacing what was indexed for key before.
+        """
+        words = frozenset(split_words(text))
+        if self._keys.get(key) == words:
+            return
+        self.remove(key)
+        self._keys[key] = words
+        for word in words:
+            keys = self._words.get(word)
+            if keys is None:
+                self._words[word] = set([key])
+                for gram in _grams(word):
+                    self._grams.setdefault(gram, set()).add(word)
+            else:
+                keys.add(key)
+        for char in set("".join(words)):
+            self._chars.setdefault(char, set()).add(key)
+        self._matches.clear()
+
+    def remove(self, key):
+        words = self._keys.pop(key, None)
+        if words is None:
+            return
+        for word in words:
+            keys = self._words[word]
+            keys.discard(key)
+            if not keys:
+                del self._words[word]
+                for gram in _grams(word):
+                    vocabulary = self._grams[gram]
+                    vocabulary.discard(word)
+                    if not vocabulary:
+                        del self._grams[gram]
+        for char in set("".join(words)):
+            keys = self._chars[char]
+            keys.discard(key)
+            if not keys:
+                del self._chars[char]
+        self._matches.clear()
+
+    def clear(self):
+        self._keys.clear()
+        self._words.clear()
+        self._grams.clear()
+        self._chars.clear()
+        self._matches.clear()
+
+    def _vocabulary(self, query_word):
+        """
+        Return the indexed words containing query_word.
+        """
+        vocabularies = []
+        grams = _trigrams(query_word) if len(query_word) > 3 else [query_word]
+        for gram in grams:
+            vocabulary = self._grams.get(gram)
+            if not vocabulary:
+                return ()
+            vocabularies.append(vocabulary)
+        vocabularies.sort(key=len)
+        words = vocabularies[0]
+        if len(vocabularies) > 1:
+            words = words.intersection(*vocabularies[1:])
+        if len(query_word) > 3:
+            # the trigrams may come from different places in the word
+            words = [w for w in words if query_word in w]
+        return words
+
+    def _match_word(self, query_word, vocabulary=None):
+        """
+        Return the frozenset of keys matching a single query word, whose
+        vocabulary() may be passed if it is known.
+        """
+        keys = self._matches.get(query_word)
+        if keys is not None:
+            return keys
+        if vocabulary is None:
+            vocabulary = self._vocabulary(query_word)
+        postings = sorted([self._words[w] for w in vocabulary], key=len,
+                          reverse=True)
+        if not postings:
+            keys = frozenset()
+        elif len(postings) == 1 or len(postings[0]) == len(self._keys):
+            keys = frozenset(postings[0])
+        else:
+            keys = set(postings[0])
+            for word_keys in postings[1:]:
+                keys.update(word_keys)
+            keys = frozenset(keys)
+        self._matches[query_word] = keys
+        return keys
+
+    def search(self, query):
+        """
+        Return the frozenset of keys matching every word of query, or None if
+        query has no words, meaning everything matches.
+
+        The query words expected to match the fewest keys are looked at first
+        and the search stops once nothing is left. Once few candidates are
+        left, checking their words is cheaper than collecting every key
+        matching a common query word only to intersect it.
+        """
+        words = split_words(query)
+        if not words:
+            return None
+        plans = []
+        for word in set(words):
+            if len(word) == 1:
+                keys = self._chars.get(word, frozenset())
+                plans.append((len(keys), word, keys, None))
+                continue
+            keys = self._matches.get(word)
+            if keys is not None:
+                plans.append((len(keys), word, keys, None))
+                continue
+            vocabulary = self._vocabulary(word)
+            # an upper bound of the number of keys matching word
+            cost = sum([len(self._words[w]) for w in vocabulary])
+            plans.append((cost, word, None, vocabulary))
+        plans.sort(key=lambda plan: plan[0])
+        total = len(self._keys)
+        keys = None
+        for cost, word, matches, vocabulary in plans:
+            if matches is None:
+                if keys is not None and cost > FILTER_RATIO * len(keys):
+                    vocabulary = set(vocabulary)
+                    words_of = self._keys
+                    keys = [key for key in keys
+                            if not words_of[key].isdisjoint(vocabulary)]
+                    if not keys:
+                        break
+                    continue
+                matches = self._match_word(word, vocabulary)
+            if keys is None:
+                keys = matches
+            elif len(matches) < total:
+                # words matching every key do not narrow the result
+                keys = matches.intersection(keys)
+            if not keys:
+                break
+        if isinstance(keys, frozenset):
+            return keys
+        return frozenset(keys)
@@ -0,0 +1,227 @@
+"""
+Undo and redo of the changes made to the open desktop entry.
+
+The history stores what changed, not copies of the entry: every step is a
+short list of (group, key, old value, new value) deltas, so it costs the same
+for a launcher with a handful of keys as for one with hundreds of
+translations, and undoing or redoing a step only touches the keys it changed.
+Consecutive changes to the same key, such as typing in one field, are merged
+into a single step.
+"""
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEPTH = 100
+
+
+class KeyDelta(object):
+    """
+    A change of key in group from old to new, None meaning the key is absent.
+    """
+    __slots__ = ('group', 'key', 'old', 'new')
+
+    def __init__(self, group, key, old, new):
+        self.group = group
+        self.key = key
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return "KeyDelta(%r, %r, %r, %r)" % (self.group, self.key, self.old,
+                                             self.new)
+
+
+class UndoStep(object):
+    """
+    The deltas made by one change in the editor. field is the (group, key)
+    that was edited, which decides whether the next change can be merged.
+    """
+    __slots__ = ('field', 'deltas', 'mergeable')
+
+    def __init__(self, field, deltas, mergeable):
+        self.field = field
+        self.deltas = deltas
+        self.mergeable = mergeable
+
+    def merge(self, deltas):
+        """
+        Fold the later deltas into this step, keeping the oldest value of
+        every key, and drop the keys which are back to their old value.
+        """
+        by_key = dict(((d.group, d.key), d) for d in self.deltas)
+        for delta in deltas:
+            previous = by_key.get((delta.group, delta.key))
+            if previous is None:
+                self.deltas.append(delta)
+            else:
+                previous.new = delta.new
+        self.deltas = [d for d in self.deltas if d.old != d.new]
+
+
+def _apply(entry, deltas, undo=False):
+    """
+    Set the keys of entry to the new values of deltas, or the old ones when
+    undoing.
+    """
+    for delta in (reversed(deltas) if undo else deltas):
+        value = delta.old if undo else delta.new
+        group = entry.content.get(delta.group)
+        if value is None:
+            if group is not None:
+                group.pop(delta.key, None)
+        else:
+            if group is None:
+                entry.addGroup(delta.group)
+                group = entry.content[delta.group]
+            group[delta.key] = value
+    entry.tainted = True
+
+
+class UndoHistory(object):
+    """
+    The undo and redo stacks of an entry being edited, holding at most depth
+    steps. The oldest steps are dropped once the depth is reached.
+    """
+    def __init__(self, depth=DEFAULT_DEPTH):
+        self._undo = deque(maxlen=max(1, depth))
+        self._redo = []
+        # the top undo step when the entry was saved, None if the undo stack
+        # was empty and False if the saved state was dropped
+        self._saved = None
+        self._sealed = True
+
+    def __len__(self):
+        return len(self._undo)
+
+    def set_depth(self, depth):
+        """
+        Change the number of steps kept, dropping the oldest if needed.
+        """
+        depth = max(1, depth)
+        steps = list(self._undo)
+        if len(steps) > depth:
+            self._drop_oldest(steps[:-depth])
+        self._undo = deque(steps, maxlen=depth)
+        if len(self._redo) > depth:
+            self._drop_redo(self._redo[:-depth])
+            del self._redo[:-depth]
+
+    def _drop_oldest(self, steps):
+        """
+        Forget where the saved state is if it is lost with the oldest undo
+        steps.
+        """
+        if self._saved is steps[-1]:
+            # the state after the last dropped step is still reachable
+            self._saved = None
+        elif self._saved is None or any(s is self._saved for s in steps):
+            self._saved = False
+
+    def _drop_redo(self, steps):
+        if any(s is self._saved for s in steps):
+            self._saved = False
+
+    def clear(self):
+        """
+        Forget every step, e.g. when another entry is opened.
+        """
+        self._undo.clear()
+        del self._redo[:]
+        self._saved = None
+        self._sealed = True
+
+    def seal(self):
+        """
+        Make the next change a step of its own even if it changes the same
+        key as the last one.
+        """
+        self._sealed = True
+
+    def mark_saved(self):
+        """
+        Remember the current state as the one on disk.
+        """
+        self._saved = self._undo[-1] if self._undo else None
+        self._sealed = True
+
+    def is_saved(self):
+        """
+        Return True if undo or redo returned the entry to its saved state.
+        """
+        return self._saved is (self._undo[-1] if self._undo else None)
+
+    def can_undo(self):
+        return bool(self._undo)
+
+    def can_redo(self):
+        return bool(self._redo)
+
+    def change(self, entry, key, value, group=None, merge=True):
+        """
+        Set key of entry to value, or remove it and its translations if value
+        is empty, recording the change. Unless merge is False, a change of
+        the same key as the last step is merged into it. Returns False if
+        nothing changed.
+        """
+        group = group or entry.defaultGroup
+        content = entry.content.get(group, {})
+        if value:
+            old = content.get(key)
+            if old == value:
+                return False
+            deltas = [KeyDelta(group, key, old, value)]
+        else:
+            prefix = key + "["
+            deltas = [KeyDelta(group, name, content[name], None)
+                      for name in content
+                      if name == key or name.startswith(prefix)]
+            if not deltas:
+                return False
+        _apply(entry, deltas)
+        self._drop_redo(self._redo)
+        del self._redo[:]
+
+        field = (group, key)
+        last = self._undo[-1] if self._undo else None
+        if (merge and not self._sealed and last is not None and
+            last.mergeable and last.field == field and last is not self._saved):
+            last.merge(deltas)
+            if not last.deltas:
+                self._undo.pop()
+                self._sealed = True
+        else:
+            if len(self._undo) == self._undo.maxlen:
+                self._drop_oldest([self._undo[0]])
+            self._undo.append(UndoStep(field, deltas, merge))
+            self._sealed = not merge
+        return True
+
+    def undo(self, entry):
+        """
+        Revert the last step on entry and return it, or None if there is
+        nothing to undo.
+        """
+        if not self._undo:
+            return None
+        step = self._undo.pop()
+        _apply(entry, step.deltas, undo=True)
+        self._redo.append(step)
+        self._sealed = True
+        logger.debug("Undid %d keys of %s" % (len(step.deltas), step.field))
+        return step
+
+    def redo(self, entry):
+        """
+        Apply the last undone step to entry again and return it, or None if
+        there is nothing to redo.
+        """
+        if not self._redo:
+            return None
+        step = self._redo.pop()
+        _apply(entry, step.deltas)
+        self._undo.append(step)
+        self._sealed = True
+        logger.debug("Redid %d keys of %s" % (len(step.deltas), step.field))
+        return step
@@ -0,0 +1,102 @@
+"""
+Window listing the problems found by validating every installed launcher.
+"""
+import os
+
+from gi.repository import GObject, Gtk
+
+SEVERITY_ERROR = "Error"
+SEVERITY_WARNING = "Warning"
+
+
+class ValidationReport(Gtk.Window):
+    """
+    A sortable list of (file, severity, message) rows which is filled in as the
+    BulkValidator streams results. Activating a row calls open_callback with
+    the desktop file.
+    """
+    COL_NAME = 0
+    COL_SEVERITY = 1
+    COL_MESSAGE = 2
+    COL_FILENAME = 3
+
+    def __init__(self, parent=None, open_callback=None):
+        Gtk.Window.__init__(self)
+        self.set_title("Validation Report")
+        self.set_default_size(700, 400)
+        if parent:
+            self.set_transient_for(parent)
+            self.set_destroy_with_parent(True)
+        self._open_callback = open_callback
+        self.files = 0
+        self.invalid = 0
+        self.problems = 0
+
+        self._model = Gtk.ListStore(GObject.TYPE_STRING,    # file name
+                                    GObject.TYPE_STRING,    # severity
+                                    GObject.TYPE_STRING,    # message
+                                    GObject.TYPE_STRING)    # full path
+        self._treeview = Gtk.TreeView()
+        self._treeview.set_model(self._model)
+        self._treeview.set_tooltip_column(self.COL_FILENAME)
+        self._treeview.connect("row-activated", self.on_treeview_row_activated)
+        for title, column_id in (("File", self.COL_NAME),
+                                 ("Severity", self.COL_SEVERITY),
+                                 ("Message", self.COL_MESSAGE)):
+            cell = Gtk.CellRendererText()
+            column = Gtk.TreeViewColumn(title, cell, text=column_id)
+            column.set_sort_column_id(column_id)
+            column.set_resizable(True)
+            self._treeview.append_column(column)
+        self._model.set_sort_column_id(self.COL_NAME, Gtk.SortType.ASCENDING)
+
+        scrolled = Gtk.ScrolledWindow()
+        scrolled.set_shadow_type(Gtk.ShadowType.IN)
+        scrolled.add(self._treeview)
+
+        self._progressbar = Gtk.ProgressBar()
+        self._progressbar.set_show_text(True)
+
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        box.set_border_width(6)
+        box.pack_start(scrolled, True, True, 0)
+        box.pack_start(self._progressbar, False, True, 0)
+        self.add(box)
+        box.show_all()
+
+    def add_results(self, results):
+        """
+        Add a batch of ValidationResult objects to the report.
+        """
+        model = self._model
+        # appending to a sorted model re-sorts on every row
+        column_id, order = model.get_sort_column_id()
+        model.set_sort_column_id(Gtk.TREE_SORTABLE_UNSORTED_SORT_COLUMN_ID,
+                                 Gtk.SortType.ASCENDING)
+        for result in results:
+            self.files += 1
+            if result.is_valid():
+                continue
+            self.invalid += 1
+            name = os.path.basename(result.filename)
+            for severity, messages in ((SEVERITY_ERROR, result.errors),
+                                       (SEVERITY_WARNING, result.warnings)):
+                for message in messages:
+                    self.problems += 1
+                    model.append((name, severity, message, result.filename))
+        if column_id is not None:
+            model.set_sort_column_id(column_id, order)
+
+    def set_progress(self, done, total):
+        if total:
+            self._progressbar.set_fraction(float(done) / total)
+        self._progressbar.set_text("Validated %d of %d files" % (done, total))
+
+    def set_finished(self):
+        self._progressbar.set_fraction(1.0)
+        self._progressbar.set_text("%d problems in %d of %d files" %
+                                   (self.problems, self.invalid, self.files))
+
+    def on_treeview_row_activated(self, treeview, path, column, data=None):
+        if self._open_callback:
+            self._open_callback(self._model[path][self.COL_FILENAME])
@@ -0,0 +1,572 @@
+"""
+Validation of desktop entries, one at a time or in bulk across every installed
+launcher.
+
+Bulk validation runs Entry.validate() in a pool of processes across all cores
+and streams the results to the main loop as they finish. Results are cached by
+the content hash of each file so that re-runs only validate changed files.
+
+A process forked while other threads hold locks can deadlock, and the
+application runs threads from the start. So a single helper process is forked
+before any thread is started, and the helper forks the pool the first time
+files are validated.
+
+The entry being edited is re-validated on a background thread shortly after
+the user stops typing, memoized on its serialized contents.
+"""
+import os
+import hashlib
+import functools
+import logging
+import marshal
+import multiprocessing
+import multiprocessing.util
+import threading
+import zlib
+import Queue
+from collections import OrderedDict, deque
+
+from gi.repository import GLib
+from xdg.BaseDirectory import xdg_cache_home
+from xdg.Exceptions import ParsingError, ValidationError
+
+from dee.entry import Entry
+
+logger = logging.getLogger(__name__)
+
+CACHE_MAGIC = "DEEVAL"
+CACHE_VERSION = 2
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_DELAY_MS = 300
+DEFAULT_MEMO_SIZE = 64
+
+
+def validate_entry(entry):
+    """
+    Validate an Entry and return (errors, warnings), two lists of messages.
+    Unlike Entry.validate(), this collects every problem instead of raising.
+    """
+    try:
+        entry.validate()
+    except ValidationError:
+        pass
+    return (list(entry.errors), list(entry.warnings))
+
+
+def _parsing_error_message(e):
+    """
+    Return the message of a ParsingError without the name of the file, which
+    pyxdg puts in front of it.
+    """
+    message = e.msg
+    prefix = "ParsingError in file '%s', " % e.file
+    if message.startswith(prefix):
+        message = message[len(prefix):]
+    return "Parsing error: %s" % message
+
+
+def validate_file(filename):
+    """
+    Parse and validate a desktop file and return (filename, errors, warnings).
+    This runs in the worker processes, so it must not touch GTK+. Messages
+    must not name the file as they are cached for every file with the same
+    contents.
+    """
+    try:
+        entry = Entry(filename)
+        errors, warnings = validate_entry(entry)
+    except ParsingError, e:
+        return (filename, [_parsing_error_message(e)], [])
+    except Exception, e:
+        logger.exception("Could not validate %s" % filename)
+        return (filename, ["%s: %s" % (e.__class__.__name__, e)], [])
+    return (filename, errors, warnings)
+
+
+def validate_files(filenames):
+    """
+    Return the validate_file() results of a chunk of files.
+    """
+    return [validate_file(filename) for filename in filenames]
+
+
+def _validate_chunk(filenames):
+    """
+    Return (results, error) for a chunk of files, where results is the list of
+    validate_file() results or None if validating them failed with error.
+    """
+    try:
+        return (validate_files(filenames), None)
+    except Exception, e:
+        return (None, str(e))
+
+
+def _serve(conn, parent_conn, processes):
+    """
+    Main function of the helper process. Validates the chunks received on
+    conn as (chunk ID, filenames) in a pool of processes created for the
+    first chunk and sends back (chunk ID, results, error), until None is
+    received or the application exits.
+    """
+    # only the application's end is left open, so its exit ends the helper
+    parent_conn.close()
+    pool = None
+    lock = threading.Lock()
+    def reply(chunk_id, result):
+        results, error = result
+        with lock:
+            conn.send((chunk_id, results, error))
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, IOError):
+            break
+        if request is None:
+            break
+        chunk_id, filenames = request
+        if pool is None:
+            pool = multiprocessing.Pool(processes)
+        pool.apply_async(_validate_chunk, (filenames,),
+                         callback=functools.partial(reply, chunk_id))
+    if pool is not None:
+        pool.terminate()
+
+
+class ValidationPool(object):
+    """
+    The main process's end of the helper process validating files. Chunks are
+    submitted from any thread and their results claimed by chunk ID.
+    """
+    def __init__(self, processes):
+        self.processes = processes
+        self._conn, child_conn = multiprocessing.Pipe()
+        # daemonic processes cannot have children, so the helper is stopped
+        # when the application exits instead
+        self._process = multiprocessing.Process(target=_serve,
+                                                args=(child_conn, self._conn,
+                                                      processes))
+        self._process.start()
+        child_conn.close()
+        multiprocessing.util.Finalize(self, self.close, exitpriority=10)
+        self._send_lock = threading.Lock()
+        self._receive_lock = threading.Lock()
+        self._next_id = 0
+        self._received = {}     # chunk ID -> (results, error)
+
+    def close(self):
+        """
+        Stop the helper process and its pool.
+        """
+        try:
+            with self._send_lock:
+                self._conn.send(None)
+        except IOError:
+            pass # already gone
+
+    def submit(self, filenames):
+        """
+        Validate filenames in the pool and return the ID to claim the results
+        with.
+        """
+        with self._send_lock:
+            chunk_id = self._next_id
+            self._next_id += 1
+            self._conn.send((chunk_id, filenames))
+        return chunk_id
+
+    def receive(self, chunk_id):
+        """
+        Wait for the chunk chunk_id and return (results, error) as returned by
+        _validate_chunk(). Raises EOFError or IOError if the helper process
+        died.
+        """
+        with self._receive_lock:
+            while chunk_id not in self._received:
+                other_id, results, error = self._conn.recv()
+                self._received[other_id] = (results, error)
+            return self._received.pop(chunk_id)
+
+
+def content_key(data, filename):
+    """
+    Return the key under which the validation result for a file with contents
+    data is cached. The extension is part of the key as it is validated too.
+    """
+    return (hashlib.sha1(data).hexdigest(), os.path.splitext(filename)[1])
+
+
+class ValidationResult(object):
+    """
+    The errors and warnings found in a single desktop file.
+    """
+    __slots__ = ('filename', 'errors', 'warnings')
+
+    def __init__(self, filename, errors, warnings):
+        self.filename = filename
+        self.errors = errors
+        self.warnings = warnings
+
+    def is_valid(self):
+        return not (self.errors or self.warnings)
+
+
+class ValidationCache(object):
+    """
+    Validation results keyed by content_key(), persisted under the XDG cache
+    dir in the same versioned, compressed format as the Catalog.
+    """
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(xdg_cache_home, "desktop-entry-editor",
+                                    "validation.cache")
+        self.filename = filename
+        self._results = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._dirty = False
+
+    def load(self):
+        """
+        Load the cache from disk, starting empty if it is missing or corrupt.
+        """
+        results = {}
+        try:
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+            header = CACHE_MAGIC + chr(CACHE_VERSION)
+            if not data.startswith(header):
+                raise ValueError("unknown header")
+            results = marshal.loads(zlib.decompress(data[len(header):]))
+            if not isinstance(results, dict):
+                raise ValueError("unexpected type %s" % type(results))
+        except IOError:
+            pass # no cache yet
+        except (ValueError, EOFError, TypeError, zlib.error), e:
+            logger.warn("Discarding corrupt cache %s: %s" % (self.filename, e))
+            results = {}
+        with self._lock:
+            self._results = results
+            self._loaded = True
+            self._dirty = False
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def save(self):
+        """
+        Atomically write the cache to disk if it changed.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            data = marshal.dumps(self._results)
+            self._dirty = False
+        path = os.path.dirname(self.filename)
+        tmp_filename = self.filename + ".tmp"
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            with open(tmp_filename, 'wb') as f:
+                f.write(CACHE_MAGIC + chr(CACHE_VERSION))
+                f.write(zlib.compress(data))
+            os.rename(tmp_filename, self.filename)
+        except (IOError, OSError), e:
+            logger.warn("Could not save cache %s: %s" % (self.filename, e))
+
+    def lookup(self, key):
+        """
+        Return the cached (errors, warnings) for key, or None.
+        """
+        return self._results.get(key)
+
+    def store(self, key, errors, warnings):
+        with self._lock:
+            self._results[key] = (tuple(errors), tuple(warnings))
+            self._dirty = True
+
+
+class BulkValidationJob(object):
+    """
+    A single run of the BulkValidator.
+    """
+    def __init__(self, filenames, result_callback, progress_callback,
+                 finished_callback, cache, pool, batch_size):
+        self._filenames = list(OrderedDict.fromkeys(filenames))
+        self._result_callback = result_callback
+        self._progress_callback = progress_callback
+        self._finished_callback = finished_callback
+        self._cache = cache
+        self._pool = pool
+        self._batch_size = batch_size
+
+        self._results = Queue.Queue()
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._drain_pending = False
+        self._processed = 0
+        self._finished = False
+        self.cached = 0
+
+    def start(self):
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def cancel(self):
+        """
+        Stop validating. No callbacks are invoked after this returns. The
+        chunks already handed to the pool are still validated, and their
+        results claimed, but no more are submitted.
+        """
+        self._cancelled.set()
+
+    def is_running(self):
+        return not (self._finished or self._cancelled.is_set())
+
+    def _run(self):
+        """
+        Serve unchanged files from the cache and validate the others in the
+        process pool.
+        """
+        cache = self._cache
+        if cache is not None:
+            cache.ensure_loaded()
+        todo = {}
+        for filename in self._filenames:
+            if self._cancelled.is_set():
+                return
+            try:
+                with open(filename, 'rb') as f:
+                    key = content_key(f.read(), filename)
+            except IOError, e:
+                self._put(ValidationResult(filename, [str(e)], []))
+                continue
+            cached = cache.lookup(key) if cache is not None else None
+            if cached is None:
+                todo[filename] = key
+            else:
+                self.cached += 1
+                self._put(ValidationResult(filename, list(cached[0]),
+                                           list(cached[1])))
+        logger.debug("Validating %d files, %d cached" % (len(todo), self.cached))
+
+        if todo and not self._cancelled.is_set():
+            self._validate(todo)
+        if cache is not None and not self._cancelled.is_set():
+            cache.save()
+        with self._lock:
+            self._schedule_drain() # in case there was nothing to validate
+
+    def _validate(self, todo):
+        """
+        Validate the files in todo, a dict mapping filenames to their cache
+        keys, in the pool. Only a few chunks per process are submitted at a
+        time so that a cancelled job stops using the pool quickly.
+        """
+        cache = self._cache
+        pool = self._pool
+        filenames = todo.keys()
+        chunksize = max(1, min(32, len(filenames) / (4 * pool.processes)))
+        chunks = deque(filenames[i:i + chunksize]
+                       for i in range(0, len(filenames), chunksize))
+        running = deque()
+        while chunks or running:
+            while (chunks and len(running) < 2 * pool.processes and
+                   not self._cancelled.is_set()):
+                chunk = chunks.popleft()
+                running.append((chunk, pool.submit(chunk)))
+            if not running:
+                break
+            chunk, chunk_id = running.popleft()
+            try:
+                results, error = pool.receive(chunk_id)
+            except (EOFError, IOError), e:
+                results, error = None, "validation process died: %s" % e
+            if self._cancelled.is_set():
+                continue # claim the chunks still being validated
+            keys = todo
+            if results is None:
+                logger.warn("Could not validate %d files: %s" % (len(chunk),
+                                                                  error))
+                results = [(filename, [error], []) for filename in chunk]
+                keys = {} # do not cache the failure
+            for filename, errors, warnings in results:
+                key = keys.get(filename)
+                if cache is not None and key is not None:
+                    cache.store(key, errors, warnings)
+                self._put(ValidationResult(filename, errors, warnings))
+
+    def _put(self, result):
+        with self._lock:
+            self._results.put(result)
+            self._schedule_drain()
+
+    def _schedule_drain(self):
+        """
+        Schedule an idle callback to drain the results. Must hold the lock.
+        """
+        if not self._drain_pending and not self._cancelled.is_set():
+            self._drain_pending = True
+            GLib.idle_add(self._drain)
+
+    def _drain(self):
+        """
+        Idle callback which hands up to one batch of results to the main loop.
+        """
+        if self._cancelled.is_set():
+            return False
+        batch = []
+        while len(batch) < self._batch_size:
+            try:
+                batch.append(self._results.get_nowait())
+            except Queue.Empty:
+                break
+        if batch:
+            self._result_callback(batch)
+
+        with self._lock:
+            self._processed += len(batch)
+            done = self._processed
+            finished = done == len(self._filenames)
+            if not finished and self._results.empty():
+                self._drain_pending = False
+                keep_going = False
+            else:
+                keep_going = not finished
+
+        if self._progress_callback:
+            self._progress_callback(done, len(self._filenames))
+        if finished:
+            self._finished = True
+            if self._finished_callback:
+                self._finished_callback()
+        return keep_going
+
+
+class BulkValidator(object):
+    """
+    Validates many desktop files in a pool of processes. Starting a new run
+    cancels the one in progress.
+
+    The helper process which forks the pool is started here, so construct the
+    BulkValidator before starting any other thread.
+    """
+    def __init__(self, cache=None, processes=None,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        self.cache = cache
+        self.processes = processes or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self._pool = ValidationPool(self.processes)
+        self._job = None
+
+    def cancel(self):
+        if self._job:
+            self._job.cancel()
+            self._job = None
+
+    def is_running(self):
+        return self._job is not None and self._job.is_running()
+
+    def validate(self, filenames, result_callback, progress_callback=None,
+                 finished_callback=None):
+        """
+        Validate filenames. The callbacks are invoked from the main loop:
+        result_callback(results) with a list of ValidationResult,
+        progress_callback(done, total) and finished_callback().
+        """
+        self.cancel()
+        self._job = BulkValidationJob(filenames, result_callback,
+                                      progress_callback, finished_callback,
+                                      self.cache, self._pool,
+                                      self.batch_size)
+        self._job.start()
+        return self._job
+
+
+class LiveValidator(object):
+    """
+    Validates the entry being edited in a background thread once it has not
+    changed for delay milliseconds, then calls callback(result) with a
+    ValidationResult from the main loop. Results are remembered by the
+    content_key() of Entry.toString(), so returning to a state which was
+    already validated calls back without validating again.
+    """
+    def __init__(self, callback, delay=DEFAULT_DELAY_MS,
+                 memo_size=DEFAULT_MEMO_SIZE):
+        self._callback = callback
+        self._delay = delay
+        self._memo_size = memo_size
+        self._memo = OrderedDict()
+        self._entry = None
+        self._timeout_id = None
+        self._generation = 0
+        self._requests = Queue.Queue()
+        self._thread = None
+
+    def schedule(self, entry):
+        """
+        Validate entry after the delay, restarting the delay if a validation
+        was already scheduled. A result for an earlier state is never
+        delivered once this has been called.
+        """
+        self._entry = entry
+        self._generation += 1
+        if self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+        self._timeout_id = GLib.timeout_add(self._delay, self._on_timeout)
+
+    def cancel(self):
+        """
+        Forget the scheduled and running validations.
+        """
+        self._entry = None
+        self._generation += 1
+        if self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
+
+    def _on_timeout(self):
+        self._timeout_id = None
+        entry = self._entry
+        if entry is None:
+            return False
+        filename = entry.filename or ""
+        key = content_key(entry.toString(), filename)
+        result = self._memo.get(key)
+        if result is not None:
+            del self._memo[key]
+            self._memo[key] = result
+            self._callback(ValidationResult(filename, *result))
+            return False
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work)
+            self._thread.daemon = True
+            self._thread.start()
+        self._requests.put((self._generation, key, entry.copy()))
+        return False
+
+    def _work(self):
+        """
+        Validate the snapshots put in the queue, skipping any which were
+        superseded while waiting.
+        """
+        while True:
+            request = self._requests.get()
+            try:
+                while True:
+                    request = self._requests.get_nowait()
+            except Queue.Empty:
+                pass
+            generation, key, entry = request
+            errors, warnings = validate_entry(entry)
+            GLib.idle_add(self._deliver, generation, key, entry.filename,
+                          errors, warnings)
+
+    def _deliver(self, generation, key, filename, errors, warnings):
+        self._memo[key] = (errors, warnings)
+        while len(self._memo) > self._memo_size:
+            self._memo.popitem(last=False)
+        if generation == self._generation:
+            self._callback(ValidationResult(filename, errors, warnings))
+        return False